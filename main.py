@@ -1,19 +1,36 @@
 import os
+import math
+import asyncio
 import uvicorn
 from pathlib import Path
 from contextlib import asynccontextmanager
 import redis.asyncio as redis
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi_limiter import FastAPILimiter
 
 
-from src.database.db import get_db
-from src.routes import  auth, users, photos, comments, posts
+from src.database.db import get_db, sessionmanager
+from src.database.queries import QueryBudgetMiddleware
+from src.routes import  auth, users, photos, comments, posts, admin, tags, storage, uploads
 from src.conf.config import config
+from src.services.downloads import downloader
+from src.services.idempotency import IdempotencyMiddleware
+from src.services.invalidation import invalidation_bus
+from src.services.metrics import MetricsMiddleware, registry, start_metrics_server
+from src.services.placeholders import placeholders
+from src.services.profiler import ProfilerMiddleware
+from src.services.recommendations import recommendation_index
+from src.services.resilience import DeadlineMiddleware, Unavailable
+from src.services.similarity import similarity_index
+from src.services.tag_graph import tag_graph
+from src.services.tag_index import tag_index
+from src.services.tracing import TracingMiddleware
+from src.services.uploads import upload_store
+from src.services.views import view_counter
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -24,13 +41,32 @@ async def lifespan(app: FastAPI):
         password=config.REDIS_PASSWORD,
     )
     await FastAPILimiter.init(r)
+    invalidation_bus.start(asyncio.get_running_loop())
+    async with sessionmanager.session() as db:
+        await similarity_index.load(db)
+        await tag_graph.load(db)
+        await tag_index.load(db)
+        await recommendation_index.rebuild(db)
+    view_counter.start()
+    upload_store.start()
+    registry.start(config.METRICS_FLUSH_INTERVAL)
+    if config.METRICS_PORT:
+        start_metrics_server(config.METRICS_PORT)
     yield
+    await view_counter.stop()
+    upload_store.stop()
+    await downloader.close()
+    placeholders.shutdown()
+    registry.stop()
+    invalidation_bus.stop()
     await r.close()
 
 app = FastAPI(lifespan=lifespan)
 
 origins = ["*"]
 
+app.add_middleware(DeadlineMiddleware, seconds=config.REQUEST_DEADLINE)
+app.add_middleware(IdempotencyMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -38,6 +74,24 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(TracingMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(QueryBudgetMiddleware)
+app.add_middleware(ProfilerMiddleware)
+
+
+@app.exception_handler(Unavailable)
+async def unavailable_handler(request: Request, exc: Unavailable):
+    """
+    The unavailable_handler function answers 503 when a remote service is failing or the request deadline passed,
+    with a Retry-After header when the circuit breaker knows when it will try the service again.
+
+    :param request: Request: The request that failed
+    :param exc: Unavailable: The error
+    :return: A JSONResponse with status 503
+    """
+    headers = {"retry-after": str(math.ceil(exc.retry_after))} if exc.retry_after else None
+    return JSONResponse(status_code=503, content={"detail": "Service temporarily unavailable"}, headers=headers)
 
 
 BASE_DIR = Path(__file__).parent
@@ -49,6 +103,10 @@ app.include_router(users.router, prefix="/api")
 app.include_router(photos.router, prefix="/api")
 app.include_router(comments.router, prefix="/api")
 app.include_router(posts.router, prefix="/api")
+app.include_router(tags.router, prefix="/api")
+app.include_router(admin.router, prefix="/api")
+app.include_router(storage.router, prefix="/api")
+app.include_router(uploads.router, prefix="/api")
 
 templates = Jinja2Templates(directory=BASE_DIR / "src" / "templates")
 
@@ -66,6 +124,16 @@ def index(request: Request):
     )
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def metrics():
+    """
+    The metrics function exposes the metrics of all workers in the Prometheus text format.
+
+    :return: The metrics as plain text
+    """
+    return PlainTextResponse(registry.exposition(), media_type="text/plain; version=0.0.4")
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8000)), log_level="info")
     
\ No newline at end of file
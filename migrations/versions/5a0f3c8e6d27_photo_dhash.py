@@ -0,0 +1,26 @@
+"""Photo perceptual hash
+
+Revision ID: 5a0f3c8e6d27
+Revises: e2b8d5a1f937
+Create Date: 2026-10-19 20:05:12.664871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5a0f3c8e6d27'
+down_revision: Union[str, None] = 'e2b8d5a1f937'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('dhash', sa.String(length=16), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('photos', 'dhash')
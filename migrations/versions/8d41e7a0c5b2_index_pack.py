@@ -0,0 +1,53 @@
+"""Index pack for foreign keys and hot lookups
+
+Revision ID: 8d41e7a0c5b2
+Revises: 3f6b2c1d9e4a
+Create Date: 2026-10-19 15:03:27.517940
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8d41e7a0c5b2'
+down_revision: Union[str, None] = '3f6b2c1d9e4a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# photos of a user newest first (get_photos, get_posts), comments of a photo in order (get_comments_by_photo),
+# photos of a tag (the primary key of photo_tags only serves photo_id lookups), comments of a user
+# and the photo feed by date; the foreign keys also make deleting a photo or a user cheap.
+# The ids of the photos of a user (get_photo_tag_ids) are covered on postgresql; the other lookups load whole rows,
+# which no INCLUDE list can make index-only
+INDEXES = [
+    ('ix_photos_user_id_created_at', 'photos', ['user_id', 'created_at'], ['id']),
+    ('ix_photos_created_at', 'photos', ['created_at'], []),
+    ('ix_comments_photo_id_created_at', 'comments', ['photo_id', 'created_at'], []),
+    ('ix_comments_user_id', 'comments', ['user_id'], []),
+    ('ix_photo_tags_tag_id_photo_id', 'photo_tags', ['tag_id', 'photo_id'], []),
+]
+
+
+def upgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        # CREATE INDEX CONCURRENTLY does not lock writes but cannot run inside a transaction
+        with op.get_context().autocommit_block():
+            for name, table, columns, include in INDEXES:
+                op.create_index(name, table, columns, unique=False, postgresql_include=include,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, table, columns, _ in INDEXES:
+            op.create_index(name, table, columns, unique=False)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, _, _ in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table)
@@ -0,0 +1,33 @@
+"""Photo stats
+
+Revision ID: 9c4e1f7a3b58
+Revises: 5a0f3c8e6d27
+Create Date: 2026-10-19 21:40:27.118304
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e1f7a3b58'
+down_revision: Union[str, None] = '5a0f3c8e6d27'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('photo_stats',
+    sa.Column('photo_id', sa.Integer(), nullable=False),
+    sa.Column('views', sa.BigInteger(), nullable=False),
+    sa.Column('unique_views', sa.BigInteger(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['photo_id'], ['photos.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('photo_id')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('photo_stats')
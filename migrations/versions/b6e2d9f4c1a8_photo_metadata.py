@@ -0,0 +1,36 @@
+"""Photo metadata
+
+Revision ID: b6e2d9f4c1a8
+Revises: 9c4e1f7a3b58
+Create Date: 2026-10-19 23:12:45.508213
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b6e2d9f4c1a8'
+down_revision: Union[str, None] = '9c4e1f7a3b58'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('photos', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('photos', sa.Column('format', sa.String(length=10), nullable=True))
+    op.add_column('photos', sa.Column('size', sa.BigInteger(), nullable=True))
+    op.add_column('photos', sa.Column('taken_at', sa.DateTime(), nullable=True))
+    op.create_index('ix_photos_taken_at', 'photos', ['taken_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_photos_taken_at', table_name='photos')
+    op.drop_column('photos', 'taken_at')
+    op.drop_column('photos', 'size')
+    op.drop_column('photos', 'format')
+    op.drop_column('photos', 'height')
+    op.drop_column('photos', 'width')
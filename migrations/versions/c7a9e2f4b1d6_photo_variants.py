@@ -0,0 +1,40 @@
+"""Photo variants
+
+Revision ID: c7a9e2f4b1d6
+Revises: 8d41e7a0c5b2
+Create Date: 2026-10-19 16:47:05.802113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c7a9e2f4b1d6'
+down_revision: Union[str, None] = '8d41e7a0c5b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('photo_variants',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('source_url', sa.String(length=255), nullable=False),
+    sa.Column('preset', sa.String(length=50), nullable=True),
+    sa.Column('params_hash', sa.String(length=16), nullable=False),
+    sa.Column('url', sa.String(length=255), nullable=False),
+    sa.Column('photo_id', sa.Integer(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['photo_id'], ['photos.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('source_url', 'params_hash', name='uq_photo_variants_source_url_params_hash')
+    )
+    op.create_index(op.f('ix_photo_variants_photo_id'), 'photo_variants', ['photo_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_photo_variants_photo_id'), table_name='photo_variants')
+    op.drop_table('photo_variants')
@@ -0,0 +1,26 @@
+"""Photo blurhash
+
+Revision ID: d1f5a8c3e7b2
+Revises: b6e2d9f4c1a8
+Create Date: 2026-10-20 00:31:09.847162
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd1f5a8c3e7b2'
+down_revision: Union[str, None] = 'b6e2d9f4c1a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('photos', sa.Column('blurhash', sa.String(length=64), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('photos', 'blurhash')
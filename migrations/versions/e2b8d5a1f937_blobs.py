@@ -0,0 +1,41 @@
+"""Blobs
+
+Revision ID: e2b8d5a1f937
+Revises: c7a9e2f4b1d6
+Create Date: 2026-10-19 18:21:44.390215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e2b8d5a1f937'
+down_revision: Union[str, None] = 'c7a9e2f4b1d6'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('blobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('sha256', sa.String(length=64), nullable=False),
+    sa.Column('size', sa.BigInteger(), nullable=False),
+    sa.Column('url', sa.String(length=255), nullable=False),
+    sa.Column('refcount', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('sha256')
+    )
+    op.add_column('photos', sa.Column('blob_id', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_photos_blob_id'), 'photos', ['blob_id'], unique=False)
+    op.create_foreign_key('photos_blob_id_fkey', 'photos', 'blobs', ['blob_id'], ['id'])
+
+
+def downgrade() -> None:
+    op.drop_constraint('photos_blob_id_fkey', 'photos', type_='foreignkey')
+    op.drop_index(op.f('ix_photos_blob_id'), table_name='photos')
+    op.drop_column('photos', 'blob_id')
+    op.drop_table('blobs')
@@ -0,0 +1,26 @@
+"""Drop users refresh_token
+
+Revision ID: f3c6a9d2e8b4
+Revises: d1f5a8c3e7b2
+Create Date: 2026-10-21 09:12:44.305918
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f3c6a9d2e8b4'
+down_revision: Union[str, None] = 'd1f5a8c3e7b2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.drop_column('users', 'refresh_token')
+
+
+def downgrade() -> None:
+    op.add_column('users', sa.Column('refresh_token', sa.String(length=255), nullable=True))
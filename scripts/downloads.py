@@ -0,0 +1,82 @@
+"""
+Benchmark of the streaming downloads.
+
+    python -m scripts.downloads --clients 32 --size 64
+
+benchmarks concurrent downloads of a large file from an S3 stand-in: throughput and memory growth.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+
+from scripts.storage import serve_standin
+from src.conf.config import config
+from src.services.downloads import Downloader
+from src.services.storage import S3Storage, object_key
+
+
+def _max_rss() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def _download(target: Downloader, url: str, range_header: str | None) -> int:
+    source = await target.open(url)
+    response = target.response(source, range_header)
+    received = 0
+
+    async def receive():
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal received
+        received += len(message.get("body", b""))
+
+    await response({"type": "http", "method": "GET", "headers": []}, receive, send)
+    return received
+
+
+def benchmark(clients: int, size: int, rounds: int, max_connections: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        server, thread, port = serve_standin(tmp)
+        store = S3Storage(f"http://127.0.0.1:{port}", "benchmark", "standin", "standin")
+        key = object_key("0" * 64, "image/jpeg")
+        with tempfile.TemporaryFile() as f:
+            for _ in range(size):
+                f.write(os.urandom(1024 * 1024))
+            f.seek(0)
+            store.put(f, key, "image/jpeg")
+        target = Downloader(store, max_connections=max_connections, chunk_size=config.DOWNLOAD_CHUNK_SIZE)
+
+        async def run(range_header):
+            before = _max_rss()
+            start = time.perf_counter()
+            for _ in range(rounds):
+                received = await asyncio.gather(*(_download(target, store.url(key), range_header)
+                                                  for _ in range(clients)))
+            elapsed = time.perf_counter() - start
+            total = sum(received) * rounds
+            print(f"{clients} concurrent downloads of {size} MiB ({range_header or 'whole file'}): "
+                  f"{total / elapsed / 2 ** 20:.0f} MiB/s, {elapsed / rounds:.2f} s per round, "
+                  f"peak memory +{_max_rss() - before:.0f} MiB for {sum(received) / 2 ** 20:.0f} MiB sent per round")
+
+        async def main():
+            await run(None)
+            await run(f"bytes=0-1048575,{size * 2 ** 20 // 2}-")
+            await target.close()
+
+        asyncio.run(main())
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark concurrent streaming downloads of large photos.")
+    parser.add_argument("--clients", type=int, default=32, help="number of concurrent downloads")
+    parser.add_argument("--size", type=int, default=64, help="file size in MiB")
+    parser.add_argument("--rounds", type=int, default=2, help="number of rounds of concurrent downloads")
+    parser.add_argument("--connections", type=int, default=16, help="size of the upstream connection pool")
+    args = parser.parse_args()
+    benchmark(args.clients, args.size, args.rounds, args.connections)
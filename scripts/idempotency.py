@@ -0,0 +1,55 @@
+"""
+Benchmark of the idempotency keys.
+
+    python -m scripts.idempotency --requests 2000
+
+benchmarks the overhead per request of the executed and replayed paths against requests without a key.
+"""
+import argparse
+import asyncio
+import secrets
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from src.services.auth import auth_service
+from src.services.idempotency import IdempotencyMiddleware, idempotent
+
+
+def benchmark(requests: int) -> None:
+    app = FastAPI()
+
+    @app.post("/items")
+    @idempotent
+    async def create_item(item: dict):
+        return item
+
+    app.add_middleware(IdempotencyMiddleware)
+    token = asyncio.run(auth_service.create_access_token({"sub": "benchmark@example.com"}))
+    headers = {"authorization": f"Bearer {token}"}
+    body = {"name": "photo", "tags": ["a", "b", "c"]}
+
+    async def run(label: str, key) -> float:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            start = time.perf_counter()
+            for i in range(requests):
+                extra = {"idempotency-key": key(i)} if key else {}
+                response = await client.post("/items", json=body, headers={**headers, **extra})
+                assert response.status_code == 200, response.text
+            elapsed = (time.perf_counter() - start) / requests
+        print(f"{label:<28} {elapsed * 1e6:8.0f} us/request")
+        return elapsed
+
+    run_id = secrets.token_hex(4)
+    baseline = asyncio.run(run("without key", None))
+    executed = asyncio.run(run("new key (executed)", lambda i: f"{run_id}-{i}"))
+    replayed = asyncio.run(run("same key (replayed)", lambda i: f"{run_id}-0"))
+    print(f"overhead: {(executed - baseline) * 1e6:+.0f} us executed, {(replayed - baseline) * 1e6:+.0f} us replayed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the overhead of idempotency keys per request.")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per scenario")
+    args = parser.parse_args()
+    benchmark(args.requests)
@@ -0,0 +1,40 @@
+"""
+Backfill of the image metadata of the existing photos.
+
+    python -m scripts.metadata --batch 500 --workers 16
+
+backfills the photos without metadata in batches, a batch downloading its images concurrently. Progress is
+checkpointed after every batch, so an interrupted run resumes where it stopped; ``--restart`` starts over.
+"""
+import argparse
+import asyncio
+
+from src.database.db import sessionmanager
+from src.entity.models import Photo
+from src.services.backfill import Backfill
+from src.services.downloads import Downloader
+from src.services.metadata import fetch_metadata
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the image metadata of the existing photos.")
+    parser.add_argument("--batch", type=int, default=500, help="photos per batch, committed together")
+    parser.add_argument("--workers", type=int, default=16, help="concurrent image downloads")
+    parser.add_argument("--checkpoint", default=".metadata-backfill", help="file storing the last photo processed")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    args = parser.parse_args()
+
+    async def main():
+        downloader = Downloader(max_connections=args.workers)
+
+        async def process(photo_id: int, url: str) -> dict | None:
+            metadata = await fetch_metadata(url, downloader)
+            return metadata._asdict() if metadata else None
+
+        backfill = Backfill(Photo.width.is_(None), process, args.checkpoint, args.batch, args.workers)
+        async with sessionmanager.session() as db:
+            done, failed = await backfill.run(db, args.restart)
+        await downloader.close()
+        print(f"{done} photos processed, {failed} unreadable")
+
+    asyncio.run(main())
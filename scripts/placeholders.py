@@ -0,0 +1,133 @@
+"""
+BlurHash placeholders: benchmark of the encoder and backfill of the existing photos.
+
+    python -m scripts.placeholders benchmark --count 200
+    python -m scripts.placeholders backfill --batch 500 --workers 8
+
+benchmarks the encodes per second against a pure Python encoder, or computes the placeholders of the photos
+uploaded before; the backfill resumes from its checkpoint when interrupted.
+"""
+import argparse
+import asyncio
+import io
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from src.conf.config import config
+from src.database.db import sessionmanager
+from src.entity.models import Photo
+from src.services.backfill import Backfill
+from src.services.downloads import Downloader
+from src.services.placeholders import PlaceholderStore, THUMBNAIL_SIZE, _base83, blurhash, encode_image, placeholders
+
+
+def _blurhash_reference(pixels: np.ndarray, x_components: int = 4, y_components: int = 3) -> str:
+    # the loops of the reference implementation, for the benchmark and to check the vectorized encoder
+    def to_linear(value):
+        value = value / 255
+        return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+    def to_srgb(value):
+        value = max(0.0, min(1.0, value))
+        return int((value * 12.92 if value <= 0.0031308 else 1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+    height, width = pixels.shape[:2]
+    rows = [[[to_linear(float(c)) for c in pixels[y, x]] for x in range(width)] for y in range(height)]
+    components = []
+    for j in range(y_components):
+        for i in range(x_components):
+            normalisation = 1 if i == 0 and j == 0 else 2
+            factor = [0.0, 0.0, 0.0]
+            for y in range(height):
+                for x in range(width):
+                    basis = math.cos(math.pi * i * x / width) * math.cos(math.pi * j * y / height)
+                    for c in range(3):
+                        factor[c] += basis * rows[y][x][c]
+            components.append([f * normalisation / (width * height) for f in factor])
+    dc, ac = components[0], components[1:]
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if ac:
+        quantised_max = int(max(0, min(82, math.floor(max(abs(v) for c in ac for v in c) * 166 - 0.5))))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    result += _base83(quantised_max, 1)
+    result += _base83((to_srgb(dc[0]) << 16) + (to_srgb(dc[1]) << 8) + to_srgb(dc[2]), 4)
+    for component in ac:
+        r, g, b = (int(max(0, min(18, math.floor(math.copysign(abs(v / max_value) ** 0.5, v) * 9 + 9.5))))
+                   for v in component)
+        result += _base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def benchmark(count: int, size: int) -> None:
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(count):
+        # smooth random images, like photos, rather than noise
+        small = rng.integers(0, 256, (6, 8, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((size * 4 // 3, size), Image.BILINEAR)
+        data = io.BytesIO()
+        image.save(data, "JPEG", quality=90)
+        images.append(data.getvalue())
+    thumbnails = []
+    for data in images:
+        with Image.open(io.BytesIO(data)) as image:
+            image = image.convert("RGB")
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            thumbnails.append(np.asarray(image))
+
+    start = time.perf_counter()
+    hashes = [blurhash(pixels) for pixels in thumbnails]
+    vectorized = time.perf_counter() - start
+    start = time.perf_counter()
+    expected = [_blurhash_reference(pixels) for pixels in thumbnails[:max(count // 10, 1)]]
+    loops = (time.perf_counter() - start) / len(expected) * count
+    mismatches = sum(a != b for a, b in zip(hashes, expected))
+    print(f"encode of {THUMBNAIL_SIZE}x{THUMBNAIL_SIZE} thumbnails: {count / vectorized:.0f}/s vectorized, "
+          f"{count / loops:.0f}/s with Python loops, {mismatches} mismatches")
+
+    for workers in (1, placeholders.workers):
+        with ThreadPoolExecutor(workers) as executor:
+            start = time.perf_counter()
+            list(executor.map(encode_image, images))
+            elapsed = time.perf_counter() - start
+        print(f"decode and encode of {size * 4 // 3}x{size} JPEG images with {workers} threads: "
+              f"{count / elapsed:.0f}/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BlurHash placeholders: benchmark and backfill.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("benchmark", help="measure the encodes per second")
+    bench.add_argument("--count", type=int, default=200, help="number of images")
+    bench.add_argument("--size", type=int, default=1080, help="image height in pixels")
+    backfill = commands.add_parser("backfill", help="compute the placeholders of the existing photos")
+    backfill.add_argument("--batch", type=int, default=500, help="photos per batch, committed together")
+    backfill.add_argument("--workers", type=int, default=config.PLACEHOLDER_WORKERS, help="concurrent photos")
+    backfill.add_argument("--checkpoint", default=".placeholders-backfill", help="file storing the last photo")
+    backfill.add_argument("--restart", action="store_true", help="ignore the checkpoint")
+    args = parser.parse_args()
+
+    if args.command == "benchmark":
+        benchmark(args.count, args.size)
+    else:
+        async def main():
+            store = PlaceholderStore(Downloader(max_connections=args.workers), workers=args.workers)
+
+            async def process(photo_id: int, url: str) -> dict | None:
+                placeholder = await store.compute(url)
+                return {"blurhash": placeholder} if placeholder else None
+
+            job = Backfill(Photo.blurhash.is_(None), process, args.checkpoint, args.batch, args.workers)
+            async with sessionmanager.session() as db:
+                done, failed = await job.run(db, args.restart)
+            await store.reader.close()
+            store.shutdown()
+            print(f"{done} photos processed, {failed} failed")
+
+        asyncio.run(main())
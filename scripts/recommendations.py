@@ -0,0 +1,44 @@
+"""
+Benchmark of the tag recommendations.
+
+    python -m scripts.recommendations --photos 1000000
+
+benchmarks the top-k latency on random tag vectors.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.services.recommendations import RecommendationIndex, build_arrays
+
+
+def benchmark(photos: int, tags: int, queries: int, limit: int) -> None:
+    rng = np.random.default_rng(0)
+    photo_ids = np.repeat(np.arange(photos), rng.integers(1, 6, photos))
+    tag_ids = np.minimum(rng.zipf(1.3, len(photo_ids)) - 1, tags - 1)
+    links = np.unique(np.stack([photo_ids, tag_ids], axis=1), axis=0)
+    start = time.perf_counter()
+    index = RecommendationIndex()
+    index.arrays = build_arrays(links)
+    print(f"built index of {photos} photos and {len(links)} links in {time.perf_counter() - start:.2f} s")
+
+    by_photo = np.split(links[:, 1], np.flatnonzero(np.diff(links[:, 0])) + 1)
+    latencies = []
+    for photo_id in rng.integers(0, photos, queries):
+        start = time.perf_counter()
+        index.recommend([by_photo[photo_id].tolist()], {int(photo_id)}, limit)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    print(f"{queries} top-{limit} queries: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the top-k latency of the recommendation index.")
+    parser.add_argument("--photos", type=int, default=1_000_000, help="number of photos")
+    parser.add_argument("--tags", type=int, default=100_000, help="number of distinct tags")
+    parser.add_argument("--queries", type=int, default=200, help="number of queries")
+    parser.add_argument("--limit", type=int, default=20, help="number of photos per query")
+    args = parser.parse_args()
+    benchmark(args.photos, args.tags, args.queries, args.limit)
@@ -0,0 +1,54 @@
+"""
+Benchmark of the near-duplicate photo search.
+
+    python -m scripts.similarity --size 1000000 --distance 10
+
+benchmarks the query latency on random hashes and checks the recall against a brute-force search.
+"""
+import argparse
+import random
+import time
+
+from src.services.similarity import HASH_BITS, SimilarityIndex
+
+
+def benchmark(size: int, distance: int, queries: int) -> None:
+    index = SimilarityIndex()
+    rng = random.Random(0)
+    start = time.perf_counter()
+    for photo_id in range(size):
+        index.add(photo_id, rng.getrandbits(HASH_BITS))
+    print(f"indexed {size} hashes in {time.perf_counter() - start:.1f} s")
+
+    # near duplicates of random photos, up to the search distance away
+    targets = []
+    for query in range(queries):
+        value = index.hashes[rng.randrange(size)]
+        for copy in range(5):
+            flipped = value
+            for bit in rng.sample(range(HASH_BITS), rng.randint(0, distance)):
+                flipped ^= 1 << bit
+            index.add(size + query * 5 + copy, flipped)
+        targets.append(value)
+
+    latencies, expected, returned = [], 0, 0
+    for value in targets:
+        start = time.perf_counter()
+        found = {photo_id for photo_id, _ in index.search(value, distance)}
+        latencies.append(time.perf_counter() - start)
+        brute = {photo_id for photo_id, h in index.hashes.items() if (h ^ value).bit_count() <= distance}
+        expected += len(brute)
+        returned += len(found & brute)
+    latencies.sort()
+    print(f"{queries} queries at distance {distance}: "
+          f"p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms, "
+          f"recall {returned / expected:.3f} ({returned}/{expected})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the similarity index against a brute-force search.")
+    parser.add_argument("--size", type=int, default=1_000_000, help="number of random hashes")
+    parser.add_argument("--distance", type=int, default=10, help="search distance in bits")
+    parser.add_argument("--queries", type=int, default=50, help="number of queries")
+    args = parser.parse_args()
+    benchmark(args.size, args.distance, args.queries)
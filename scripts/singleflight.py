@@ -0,0 +1,47 @@
+"""
+Simulation of a burst of cache misses with and without single flight.
+
+    python -m scripts.singleflight --callers 200 --latency 0.05
+
+simulates a burst of concurrent cache misses with and without single flight.
+"""
+import argparse
+import asyncio
+import time
+
+from src.services.singleflight import SingleFlight
+
+
+def simulate(callers: int, latency: float, keys: int) -> None:
+    async def burst(flight: SingleFlight | None) -> tuple[int, float]:
+        executions = 0
+
+        async def load(key: int) -> int:
+            nonlocal executions
+            executions += 1
+            await asyncio.sleep(latency)
+            return key
+
+        async def request(i: int) -> float:
+            start = time.perf_counter()
+            key = i % keys
+            value = await (flight.do(key, load, key) if flight else load(key))
+            assert value == key
+            return time.perf_counter() - start
+
+        latencies = await asyncio.gather(*(request(i) for i in range(callers)))
+        return executions, max(latencies)
+
+    for label, flight in (("without single flight", None), ("with single flight", SingleFlight("simulation"))):
+        executions, slowest = asyncio.run(burst(flight))
+        print(f"{label:<22} {callers} concurrent misses on {keys} keys: {executions} loads, "
+              f"slowest caller {slowest * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a thundering herd of cache misses.")
+    parser.add_argument("--callers", type=int, default=200, help="concurrent callers")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per load")
+    parser.add_argument("--keys", type=int, default=1, help="distinct keys")
+    args = parser.parse_args()
+    simulate(args.callers, args.latency, args.keys)
@@ -0,0 +1,257 @@
+"""
+S3-compatible stand-in of the storage service, benchmark of the drivers and fault injection.
+
+    python -m scripts.storage standin --port 9000
+    python -m scripts.storage benchmark --drivers local s3
+
+runs an S3-compatible stand-in backed by a local directory (it does not check signatures), and compares the
+latency and throughput of the drivers; without S3_ENDPOINT the benchmark starts its own stand-in.
+
+    python -m scripts.storage faults --error-rate 0.3 --outage 3
+
+injects failures and latency into the stand-in and compares the S3 driver with and without its policy.
+"""
+import argparse
+import hashlib
+import io
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+
+import anyio
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from src.conf.config import config
+from src.services.resilience import CircuitBreaker, CircuitOpenError, ResiliencePolicy, deadline
+from src.services.storage import CHUNK_SIZE, LocalStorage, RangeFileResponse, S3Storage, create_storage, object_key
+
+
+@dataclass
+class Faults:
+    """
+    Faults injected into the stand-in: every request is delayed by latency seconds, then fails with 503
+    during an outage, if failures is positive (the next failures requests) or with probability error_rate.
+    Requests counts the requests received.
+    """
+    error_rate: float = 0.0
+    latency: float = 0.0
+    outage: bool = False
+    failures: int = 0
+    requests: int = 0
+
+
+def standin_app(root: str, faults: Faults | None = None) -> Starlette:
+    """
+    The standin_app function builds an S3-compatible stand-in serving path-style object requests
+    (PUT, GET with Range, HEAD, DELETE) from a local directory. Signatures are not checked.
+
+    :param root: str: The directory of the objects, one subdirectory per bucket
+    :param faults: Faults: The faults to inject, changeable while serving
+    :return: The ASGI application
+    """
+    local = LocalStorage(root, "")
+
+    async def endpoint(request: Request) -> Response:
+        if faults is not None:
+            faults.requests += 1
+            if faults.latency:
+                await anyio.sleep(faults.latency)
+            if faults.failures > 0:
+                faults.failures -= 1
+                return Response(status_code=503)
+            if faults.outage or random.random() < faults.error_rate:
+                return Response(status_code=503)
+        key = f"{request.path_params['bucket']}/{request.path_params['key']}"
+        try:
+            path = local.path(key)
+        except ValueError:
+            return Response(status_code=400)
+        if request.method == "PUT":
+            with tempfile.SpooledTemporaryFile(CHUNK_SIZE) as f:
+                async for chunk in request.stream():
+                    f.write(chunk)
+                f.seek(0)
+                await anyio.to_thread.run_sync(local.delete, key)
+                await anyio.to_thread.run_sync(local.put, f, key)
+            stat = local.stat(key)
+            return Response(status_code=200, headers={"etag": stat.etag})
+        if request.method == "DELETE":
+            await anyio.to_thread.run_sync(local.delete, key)
+            return Response(status_code=204)
+        stat = local.stat(key)
+        if stat is None:
+            return Response(status_code=404)
+        return RangeFileResponse(path, stat, request.headers.get("range"), request.method)
+
+    return Starlette(routes=[Route("/{bucket}/{key:path}", endpoint, methods=["GET", "HEAD", "PUT", "DELETE"])])
+
+
+def serve_standin(root: str, faults: Faults | None = None):
+    import uvicorn
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(standin_app(root, faults), port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, thread, port
+
+
+def benchmark(drivers: list[str], size: int, count: int) -> None:
+    payloads = [os.urandom(size) for _ in range(count)]
+    with tempfile.TemporaryDirectory() as tmp:
+        for driver in drivers:
+            server = None
+            if driver == "local":
+                target = LocalStorage(os.path.join(tmp, "local"), "/api/storage")
+            elif driver == "s3" and not config.S3_ENDPOINT:
+                server, thread, port = serve_standin(os.path.join(tmp, "s3"))
+                target = S3Storage(f"http://127.0.0.1:{port}", "benchmark", "standin", "standin")
+                driver = "s3 (stand-in)"
+            else:
+                target = create_storage(driver)
+            timings = {"put": [], "stat": [], "get": [], "range": [], "delete": []}
+            keys = []
+            for payload in payloads:
+                key = object_key(hashlib.sha256(payload).hexdigest(), "application/octet-stream", "benchmark")
+                keys.append(key)
+                start = time.perf_counter()
+                target.put(io.BytesIO(payload), key, "application/octet-stream")
+                timings["put"].append(time.perf_counter() - start)
+            for key in keys:
+                start = time.perf_counter()
+                target.stat(key)
+                timings["stat"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                b"".join(target.get(key))
+                timings["get"].append(time.perf_counter() - start)
+                start = time.perf_counter()
+                b"".join(target.get(key, size // 2, 4096))
+                timings["range"].append(time.perf_counter() - start)
+            for key in keys:
+                start = time.perf_counter()
+                target.delete(key)
+                timings["delete"].append(time.perf_counter() - start)
+            print(f"{driver}: {count} objects of {size} bytes")
+            for operation, values in timings.items():
+                values.sort()
+                line = (f"  {operation:<7} p50 {values[len(values) // 2] * 1000:8.2f} ms"
+                        f"  p99 {values[int(len(values) * 0.99)] * 1000:8.2f} ms")
+                if operation in ("put", "get"):
+                    line += f"  {size * count / sum(values) / 2 ** 20:8.1f} MiB/s"
+                print(line)
+            if server is not None:
+                server.should_exit = True
+                thread.join()
+
+
+def fault_injection(error_rate: float, latency: float, outage: float, request_deadline: float, count: int) -> None:
+    faults = Faults()
+    payload = os.urandom(64 * 1024)
+    key = object_key(hashlib.sha256(payload).hexdigest(), "application/octet-stream", "faults")
+
+    def calls(target: S3Storage, seconds: float | None = None) -> tuple[int, int, int, float]:
+        # count stat calls, or one every 10 ms for seconds; returns calls, successes, calls failed fast, slowest call
+        done = succeeded = fast = 0
+        slowest = 0.0
+        end = time.monotonic() + seconds if seconds is not None else None
+        while (done < count) if end is None else (time.monotonic() < end):
+            start = time.perf_counter()
+            try:
+                target.stat(key)
+                succeeded += 1
+            except CircuitOpenError:
+                fast += 1
+            except Exception:
+                pass
+            done += 1
+            slowest = max(slowest, time.perf_counter() - start)
+            if end is not None:
+                time.sleep(max(0.0, 0.01 - (time.perf_counter() - start)))
+        return done, succeeded, fast, slowest
+
+    with tempfile.TemporaryDirectory() as tmp:
+        server, thread, port = serve_standin(tmp, faults)
+        endpoint = f"http://127.0.0.1:{port}"
+        S3Storage(endpoint, "faults", None, None).put(io.BytesIO(payload), key, "application/octet-stream")
+
+        def driver(resilient: bool) -> S3Storage:
+            policy = ResiliencePolicy("s3", timeout=2.0, retries=2, backoff=0.05, breaker=CircuitBreaker(
+                "s3", failure_rate=0.5, min_calls=10, window=10.0, open_for=1.0)) if resilient else None
+            return S3Storage(endpoint, "faults", None, None, timeout=2.0, policy=policy)
+
+        print(f"{count} stat calls, {error_rate:.0%} of the requests failing with 503")
+        faults.error_rate = error_rate
+        for label, resilient in (("without policy", False), ("with policy", True)):
+            done, succeeded, _, slowest = calls(driver(resilient))
+            print(f"  {label:<15} {succeeded}/{done} succeeded, slowest {slowest * 1000:.0f} ms")
+        faults.error_rate = 0.0
+
+        print(f"outage of {outage:.1f} s, requests failing with 503 after {latency:.2f} s")
+        for label, resilient in (("without policy", False), ("with policy", True)):
+            target = driver(resilient)
+            faults.outage, faults.latency, faults.requests = True, latency, 0
+            done, _, fast, _ = calls(target, outage)
+            faults.outage, faults.latency, reached = False, 0.0, faults.requests
+            start = time.monotonic()
+            while True:
+                try:
+                    target.stat(key)
+                    break
+                except CircuitOpenError:
+                    time.sleep(0.01)
+            print(f"  {label:<15} {done} calls, {reached} requests to the store, {fast} calls failed fast; "
+                  f"recovered {time.monotonic() - start:.2f} s after the outage")
+
+        print(f"requests slowed to {request_deadline * 4:.2f} s, deadline of {request_deadline:.2f} s")
+        faults.latency = request_deadline * 4
+        for label, seconds in (("without deadline", None), ("with deadline", request_deadline)):
+            start = time.perf_counter()
+            try:
+                with deadline(seconds):
+                    driver(True).stat(key)
+                outcome = "succeeded"
+            except Exception as err:
+                outcome = f"failed with {type(err).__name__}"
+            print(f"  {label:<16} {outcome} after {(time.perf_counter() - start) * 1000:.0f} ms")
+        faults.latency = 0.0
+
+        server.should_exit = True
+        thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Storage drivers: S3 stand-in and benchmark.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    standin = commands.add_parser("standin", help="serve an S3-compatible stand-in from a local directory")
+    standin.add_argument("--root", default="s3-standin", help="directory of the objects")
+    standin.add_argument("--port", type=int, default=9000, help="port to listen on")
+    bench = commands.add_parser("benchmark", help="compare the latency and throughput of the drivers")
+    bench.add_argument("--drivers", nargs="+", default=["local", "s3"], choices=["local", "s3", "cloudinary"])
+    bench.add_argument("--size", type=int, default=256 * 1024, help="object size in bytes")
+    bench.add_argument("--count", type=int, default=200, help="number of objects")
+    inject = commands.add_parser("faults", help="compare the S3 driver with and without its policy under faults")
+    inject.add_argument("--error-rate", type=float, default=0.3, help="share of requests failing with 503")
+    inject.add_argument("--latency", type=float, default=0.05, help="seconds before a request fails in an outage")
+    inject.add_argument("--outage", type=float, default=3.0, help="outage duration in seconds")
+    inject.add_argument("--deadline", type=float, default=0.25, help="request deadline in seconds")
+    inject.add_argument("--count", type=int, default=200, help="calls per run")
+    args = parser.parse_args()
+    if args.command == "standin":
+        import uvicorn
+
+        uvicorn.run(standin_app(args.root), port=args.port)
+    elif args.command == "faults":
+        fault_injection(args.error_rate, args.latency, args.outage, args.deadline, args.count)
+    else:
+        benchmark(args.drivers, args.size, args.count)
@@ -0,0 +1,34 @@
+"""
+Benchmark of the tag co-occurrence graph.
+
+    python -m scripts.tag_graph --links 10000000
+
+benchmarks the build of the matrix from random links.
+"""
+import argparse
+import time
+
+import numpy as np
+
+from src.services.tag_graph import cooccurrence
+
+
+def benchmark(links: int, tags: int) -> None:
+    rng = np.random.default_rng(0)
+    photos = links // 3
+    # 1 to 5 tags per photo, popular tags drawn more often
+    photo_ids = np.repeat(np.arange(photos), rng.integers(1, 6, photos))[:links]
+    tag_ids = np.minimum(rng.zipf(1.3, len(photo_ids)) - 1, tags - 1)
+    data = np.unique(np.stack([photo_ids, tag_ids], axis=1), axis=0)
+    start = time.perf_counter()
+    matrix, tagged = cooccurrence(data, tags)
+    print(f"built {tags}x{tags} matrix from {len(data)} links of {tagged} photos "
+          f"in {time.perf_counter() - start:.2f} s, {matrix.nnz} non-zero entries")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the build of the tag co-occurrence matrix.")
+    parser.add_argument("--links", type=int, default=10_000_000, help="number of photo-tag links")
+    parser.add_argument("--tags", type=int, default=100_000, help="number of distinct tags")
+    args = parser.parse_args()
+    benchmark(args.links, args.tags)
@@ -0,0 +1,62 @@
+"""
+Benchmark of the tag prefix index.
+
+    python -m scripts.tag_index --tags 1000000
+
+benchmarks the build, the memory footprint and the query latency on random names.
+"""
+import argparse
+import random
+import string
+import sys
+import time
+
+import numpy as np
+
+from src.services.tag_index import CACHE_DEPTH, TagPrefixIndex
+
+
+def _footprint(index: TagPrefixIndex) -> int:
+    arrays = (index._ids, index._counts, index._positions)
+    return len(index._blob) + len(index._offsets) * index._offsets.itemsize + sum(a.nbytes for a in arrays)
+
+
+def benchmark(tags: int, queries: int) -> None:
+    rng = random.Random(0)
+    names = {"".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 12))) for _ in range(tags)}
+    counts = np.random.default_rng(0).zipf(1.5, len(names))
+    start = time.perf_counter()
+    index = TagPrefixIndex()
+    index._build([(name.encode(), tag_id, int(count)) for tag_id, (name, count) in enumerate(zip(names, counts))])
+    print(f"built index of {len(index)} tags in {time.perf_counter() - start:.2f} s")
+    as_strings = sys.getsizeof(list(names)) + sum(sys.getsizeof(name) for name in names)
+    print(f"memory: {_footprint(index) / 2 ** 20:.1f} MiB "
+          f"(a sorted list of the names alone takes {as_strings / 2 ** 20:.1f} MiB)")
+
+    names = list(names)
+    for length in (1, 2, 3, 4, 6):
+        prefixes = [rng.choice(names)[:length] for _ in range(queries)]
+        # short prefixes are measured with an empty cache, then with the cache filled
+        for cold in (True, False) if length <= CACHE_DEPTH else (True,):
+            latencies = []
+            if not cold:
+                for prefix in prefixes:
+                    index.top(prefix, 10)
+            for prefix in prefixes:
+                if cold:
+                    index._cache.clear()
+                start = time.perf_counter()
+                index.top(prefix, 10)
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            print(f"prefix of {length}{' (cached)' if not cold else ''}: "
+                  f"p50 {latencies[len(latencies) // 2] * 1e6:.1f} us, "
+                  f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tag prefix index.")
+    parser.add_argument("--tags", type=int, default=1_000_000, help="number of distinct random tag names")
+    parser.add_argument("--queries", type=int, default=1000, help="number of queries per prefix length")
+    args = parser.parse_args()
+    benchmark(args.tags, args.queries)
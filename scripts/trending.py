@@ -0,0 +1,44 @@
+"""
+Benchmark of the trending scores.
+
+    python -m scripts.trending --events 1000000 --days 30
+
+benchmarks the entries written per event, including the rescales.
+"""
+import argparse
+import random
+import time
+
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.services.trending import Trending
+
+
+def benchmark(events: int, photos: int, days: float, use_redis: bool) -> None:
+    index = Trending(redis_client if use_redis else None, config.TRENDING_HALF_LIFE, maxsize=config.TRENDING_MAX_SIZE)
+    index.key = "trending:benchmark"
+    if use_redis:
+        index.cache.delete(index.key, f"{index.key}:epoch")
+    rng = random.Random(0)
+    start_time = time.time()
+    span = days * 86400
+    start = time.perf_counter()
+    for i in range(events):
+        # popular photos get most of the events
+        photo_id = min(int(rng.paretovariate(1.2)), photos)
+        index.record(photo_id, "comment" if rng.random() < 0.2 else "view", start_time + span * i / events)
+    elapsed = time.perf_counter() - start
+    print(f"{events} events over {days:g} days ({'redis' if use_redis else 'in-process'}): "
+          f"{elapsed / events * 1e6:.1f} us per event, {index.writes / events:.4f} entries written per event")
+    if use_redis:
+        index.cache.delete(index.key, f"{index.key}:epoch")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the write amplification of the trending scores.")
+    parser.add_argument("--events", type=int, default=1_000_000, help="number of comments and views")
+    parser.add_argument("--photos", type=int, default=1_000_000, help="number of photos")
+    parser.add_argument("--days", type=float, default=30, help="time span of the events")
+    parser.add_argument("--redis", action="store_true", help="use the configured Redis instead of memory")
+    args = parser.parse_args()
+    benchmark(args.events, args.photos, args.days, args.redis)
@@ -0,0 +1,83 @@
+"""
+Simulation of resumable uploads over a dropping connection.
+
+    python -m scripts.uploads --size 20 --chunk 2 --drop-rate 0.1
+
+simulates an upload over a connection dropping 0.1 times per MiB on average and compares the bytes transferred
+with restarting the upload from zero after every drop.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+
+from src.services.uploads import Upload, UploadStore
+
+
+def simulate(size: int, chunk: int, drop_rate: float, seed: int) -> None:
+    rng = random.Random(seed)
+    data = os.urandom(size)
+    # the connection drops after an exponentially distributed number of bytes, drop_rate times per MiB on average
+    def until_drop() -> int:
+        return int(rng.expovariate(drop_rate) * 2 ** 20) if drop_rate > 0 else size
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = UploadStore(directory, max_size=size)
+
+        async def patch(upload: Upload, offset: int, end: int, cut: int) -> None:
+            async def body():
+                for start in range(offset, cut, 64 * 1024):
+                    yield data[start:min(start + 64 * 1024, cut)]
+                if cut < end:
+                    raise ConnectionResetError("connection dropped")
+
+            await store.append(upload, offset, body())
+
+        async def main():
+            upload = store.create(1, size, {"filename": "simulated.jpg"})
+            sent = requests = drops = 0
+            remaining = until_drop()
+            while upload.offset < size:
+                # after every request the client asks for the offset, as a HEAD request
+                upload = store.get(upload.id)
+                offset, end = upload.offset, min(upload.offset + chunk, size)
+                cut = min(end, offset + remaining)
+                requests += 1
+                sent += cut - offset
+                remaining -= cut - offset
+                try:
+                    await patch(upload, offset, end, cut)
+                except ConnectionResetError:
+                    drops += 1
+                    remaining = until_drop()
+                upload = store.get(upload.id)
+            with store.claim(upload) as f:
+                intact = hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest()
+            store.delete(upload.id)
+            return sent, requests, drops, intact
+
+        sent, requests, drops, intact = asyncio.run(main())
+
+    restarted = attempts = 0
+    while attempts < 10000:
+        attempts += 1
+        remaining = until_drop()
+        restarted += min(remaining, size)
+        if remaining >= size:
+            break
+    print(f"resumable: {size / 2 ** 20:.0f} MiB sent as {requests} requests of up to {chunk / 2 ** 20:.1f} MiB, "
+          f"{drops} dropped, {sent / 2 ** 20:.1f} MiB transferred, file intact: {intact}")
+    print(f"restarting from zero: {attempts} attempts, {restarted / 2 ** 20:.1f} MiB transferred"
+          + ("" if attempts < 10000 else ", gave up"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a resumable upload over a flaky connection.")
+    parser.add_argument("--size", type=int, default=20, help="file size in MiB")
+    parser.add_argument("--chunk", type=float, default=2, help="bytes per PATCH request in MiB")
+    parser.add_argument("--drop-rate", type=float, default=0.1, help="connection drops per MiB transferred")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    simulate(args.size * 2 ** 20, int(args.chunk * 2 ** 20), args.drop_rate, args.seed)
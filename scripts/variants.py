@@ -0,0 +1,81 @@
+"""
+Benchmark of the variant transforms of a feed.
+
+    python -m scripts.variants --photos 50 --latency 0.05 --deadline 0.5
+
+benchmarks the transforms of a feed without stored variants against a backend with injected latency: one after
+another for every post, or deduplicated and concurrent under the feed deadline.
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+from starlette.concurrency import run_in_threadpool
+
+from src.conf.config import config
+from src.services.singleflight import SingleFlight
+from src.services.storage import LocalStorage
+from src.services.variants import AVATAR_PRESETS, VariantStore, params_hash
+
+
+class SlowBackend(LocalStorage):
+    # a transforming storage answering after an injected latency, with a few much slower calls
+    transforms = True
+
+    def __init__(self, latency: float, stragglers: float):
+        super().__init__(tempfile.gettempdir(), "")
+        self.latency = latency
+        self.stragglers = stragglers
+        self.calls = 0
+
+    def _transform(self, url: str, params: dict) -> str | None:
+        self.calls += 1
+        slow = random.random() < self.stragglers
+        time.sleep(self.latency * (10 if slow else random.uniform(0.5, 1.5)))
+        return f"{url}?{params_hash(params)}"
+
+
+def benchmark(photos: int, latency: float, stragglers: float, concurrency: int, deadline: float) -> None:
+    random.seed(0)
+    avatar = "https://example.com/avatar.png"
+    feed = [(avatar, preset) for preset in AVATAR_PRESETS] + [(f"https://example.com/{i}.jpg", "post")
+                                                              for i in range(photos)]
+
+    async def sequential(backend: SlowBackend) -> int:
+        # every post transforms its image and the avatar presets one after another
+        done = 0
+        for source_url, preset in feed[len(AVATAR_PRESETS):]:
+            for source, name in [(avatar, name) for name in AVATAR_PRESETS] + [(source_url, preset)]:
+                done += bool(await run_in_threadpool(backend.transform, source, config.TRANSFORM_PRESETS[name]))
+        return done
+
+    async def concurrent(backend: SlowBackend) -> int:
+        store = VariantStore(config.TRANSFORM_PRESETS, backend=backend)
+        store.flight = SingleFlight("transform")
+        pending = store.fan_out({key: None for key in feed}, concurrency)
+        done = len(await pending.wait(deadline))
+        await asyncio.wait(pending._tasks.values())
+        return done
+
+    for label, run in (("sequential, per post", sequential), ("deduplicated, concurrent", concurrent)):
+        backend = SlowBackend(latency, stragglers)
+        start = time.perf_counter()
+        done = asyncio.run(run(backend))
+        elapsed = time.perf_counter() - start
+        print(f"{label:<25} {photos} posts: {backend.calls} transforms, {done} in the response, "
+              f"{elapsed * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the transforms of a feed against a slow backend.")
+    parser.add_argument("--photos", type=int, default=50, help="posts in the feed")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per transform")
+    parser.add_argument("--stragglers", type=float, default=0.05, help="share of transforms 10 times slower")
+    parser.add_argument("--concurrency", type=int, default=config.FEED_TRANSFORM_CONCURRENCY,
+                        help="transforms at once")
+    parser.add_argument("--deadline", type=float, default=config.FEED_TRANSFORM_DEADLINE,
+                        help="seconds the feed waits for transforms")
+    args = parser.parse_args()
+    benchmark(args.photos, args.latency, args.stragglers, args.concurrency, args.deadline)
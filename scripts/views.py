@@ -0,0 +1,34 @@
+"""
+Benchmark of the write-behind view counters.
+
+    python -m scripts.views --views 1000000
+
+benchmarks the overhead of counting a view on the read path.
+"""
+import argparse
+import random
+import time
+
+from src.services.views import ViewCounter
+
+
+def benchmark(views: int, photos: int, viewers: int) -> None:
+    counter = ViewCounter(cache=None)
+    rng = random.Random(0)
+    hits = [(min(int(rng.paretovariate(1.2)), photos), str(rng.randrange(viewers))) for _ in range(views)]
+    start = time.perf_counter()
+    for photo_id, viewer in hits:
+        counter.record(photo_id, viewer)
+    elapsed = time.perf_counter() - start
+    buffered, unique = counter._take()
+    print(f"{views} views of {len(buffered)} photos: {elapsed / views * 1e6:.2f} us per view on the read path, "
+          f"{sum(len(v) for v in unique.values())} (photo, viewer) pairs buffered")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the read-path overhead of counting photo views.")
+    parser.add_argument("--views", type=int, default=1_000_000, help="number of views")
+    parser.add_argument("--photos", type=int, default=100_000, help="number of photos")
+    parser.add_argument("--viewers", type=int, default=100_000, help="number of distinct viewers")
+    args = parser.parse_args()
+    benchmark(args.views, args.photos, args.viewers)
@@ -24,10 +24,87 @@ class Settings(BaseSettings):
     REDIS_PORT: int
     REDIS_PASSWORD: str | None = None
 
-    CLOUDINARY_NAME: str
-    CLOUDINARY_API_KEY: int
-    CLOUDINARY_API_SECRET: str
-  
+    CLOUDINARY_NAME: str | None = None
+    CLOUDINARY_API_KEY: int | None = None
+    CLOUDINARY_API_SECRET: str | None = None
+
+    REFRESH_SESSION_TTL: int = 7 * 24 * 60 * 60
+
+    TRACE_SAMPLE_RATE: float = 0.01
+    TRACE_DEBUG_TOKEN: str | None = None
+    TRACE_EXPORT_PATH: str | None = None
+    TRACE_OTLP_ENDPOINT: str | None = None
+    TRACE_SERVICE_NAME: str = "photoshare"
+
+    METRICS_PORT: int | None = None
+    METRICS_MULTIPROC_DIR: str | None = None
+    METRICS_FLUSH_INTERVAL: float = 5.0
+
+    QUERY_BUDGET_MODE: str = "off"
+    QUERY_DUPLICATE_THRESHOLD: int = 3
+    SLOW_QUERY_MS: float = 200.0
+    SLOW_QUERY_EXPLAIN: bool = True
+
+    PROFILER_INTERVAL: float = 0.005
+    PROFILER_MAX_SECONDS: float = 60.0
+
+    RECOMMENDATIONS_DIR: str | None = None
+    RECOMMENDATIONS_MAX_OVERLAY: int = 10000
+
+    TRENDING_HALF_LIFE: float = 6 * 3600
+    TRENDING_COMMENT_WEIGHT: float = 1.0
+    TRENDING_VIEW_WEIGHT: float = 0.1
+    TRENDING_MAX_SIZE: int = 10000
+
+    VIEW_FLUSH_INTERVAL: float = 10.0
+    VIEW_FLUSH_BATCH: int = 1000
+
+    STORAGE_DRIVER: str = "cloudinary"
+    LOCAL_STORAGE_ROOT: str = "storage"
+    LOCAL_STORAGE_URL: str = "/api/storage"
+    S3_ENDPOINT: str | None = None
+    S3_BUCKET: str = "photoshare"
+    S3_ACCESS_KEY: str | None = None
+    S3_SECRET_KEY: str | None = None
+    S3_REGION: str = "us-east-1"
+    S3_PUBLIC_URL: str | None = None
+
+    DOWNLOAD_MAX_CONNECTIONS: int = 100
+    DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+    DOWNLOAD_MAX_RANGES: int = 16
+    DOWNLOAD_TIMEOUT: float = 30.0
+
+    PLACEHOLDER_WORKERS: int = 4
+
+    UPLOAD_STAGING_DIR: str | None = None
+    UPLOAD_MAX_SIZE: int = 100 * 2 ** 20
+    UPLOAD_TTL: float = 24 * 3600
+    UPLOAD_GC_INTERVAL: float = 600
+
+    IDEMPOTENCY_TTL: int = 24 * 60 * 60
+    IDEMPOTENCY_LOCK_TTL: int = 300
+    IDEMPOTENCY_WAIT: float = 30.0
+    IDEMPOTENCY_MAX_BODY: int = 2 ** 20
+
+    SINGLEFLIGHT_LOCK_TTL: float = 10.0
+
+    FEED_TRANSFORM_CONCURRENCY: int = 8
+    FEED_TRANSFORM_DEADLINE: float = 0.5
+
+    REQUEST_DEADLINE: float = 30.0
+    STORAGE_TIMEOUT: float = 10.0
+    STORAGE_RETRIES: int = 2
+    STORAGE_RETRY_BACKOFF: float = 0.1
+    BREAKER_FAILURE_RATE: float = 0.5
+    BREAKER_MIN_CALLS: int = 10
+    BREAKER_WINDOW: float = 30.0
+    BREAKER_OPEN_FOR: float = 15.0
+
+    TRANSFORM_PRESETS: dict[str, dict] = {
+        "avatar_35": {"width": 35, "height": 35, "crop": "fill"},
+        "avatar_200": {"width": 200, "height": 200, "crop": "fill"},
+        "post": {"width": 300, "height": 300, "crop": "fill"},
+    }
 
 
     model_config = ConfigDict(
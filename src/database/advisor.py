@@ -0,0 +1,238 @@
+"""
+Schema advisor: compares the statements the application issues with the indexes of the database
+and reports the lookups no index serves.
+
+    python -m src.database.advisor                          # statements from pg_stat_statements
+    python -m src.database.advisor --statements slow.json   # output of GET /api/admin/slow-queries
+    python -m src.database.advisor --statements queries.sql --benchmark
+
+``--statements`` also accepts a text file with one statement per line. ``--benchmark`` times a lookup on every
+missing index before and after creating it, then drops it again: run it against a copy of the database.
+"""
+import argparse
+import asyncio
+import json
+import re
+import time
+from collections import defaultdict
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
+
+from src.conf.config import config
+from src.database.queries import fingerprint
+
+
+_tables = re.compile(r"\b(?:FROM|JOIN)\s+\(?\s*(\w+)(?:\s+AS\s+(\w+))?", re.IGNORECASE)
+_predicates = re.compile(r"(\w+)\.(\w+)\s*(?:=|<=|>=|<|>|\bIN\b|\bIS\b)", re.IGNORECASE)
+_join_targets = re.compile(r"=\s*(\w+)\.(\w+)", re.IGNORECASE)
+_order_by = re.compile(r"\bORDER BY\s+(\w+)\.(\w+)", re.IGNORECASE)
+
+
+class Candidate:
+    """
+    An index the statements would use: the columns of one table, equality columns first.
+    """
+    __slots__ = ("table", "columns", "statements", "calls", "total_ms", "example")
+
+    def __init__(self, table: str, columns: tuple[str, ...]):
+        self.table = table
+        self.columns = columns
+        self.statements = 0
+        self.calls = 0
+        self.total_ms = 0.0
+        self.example = None
+
+    @property
+    def name(self) -> str:
+        return f"ix_{self.table}_{'_'.join(self.columns)}"
+
+    def ddl(self, dialect: str) -> str:
+        concurrently = " CONCURRENTLY" if dialect == "postgresql" else ""
+        return f"CREATE INDEX{concurrently} {self.name} ON {self.table} ({', '.join(self.columns)})"
+
+
+def candidates(statement: str) -> set[tuple[str, tuple[str, ...]]]:
+    """
+    The candidates function lists the (table, columns) lookups of a statement: filtered and joined columns,
+    and filtered columns followed by the sort column of the same table.
+
+    >>> sorted(candidates("SELECT comments.id FROM comments WHERE comments.photo_id = ? ORDER BY comments.created_at"))
+    [('comments', ('photo_id',)), ('comments', ('photo_id', 'created_at'))]
+
+    :param statement: str: The SQL statement
+    :return: A set of (table, columns) pairs
+    """
+    aliases = {}
+    for table, alias in _tables.findall(statement):
+        aliases[table] = table
+        if alias:
+            aliases[alias] = table
+    columns = defaultdict(list)
+    for alias, column in (*_predicates.findall(statement), *_join_targets.findall(statement)):
+        table = aliases.get(alias)
+        if table is not None and column not in columns[table]:
+            columns[table].append(column)
+    found = {(table, (column,)) for table, names in columns.items() for column in names}
+    for alias, column in _order_by.findall(statement):
+        table = aliases.get(alias)
+        if table is None:
+            continue
+        for leading in columns.get(table, ()):
+            if leading != column:
+                found.add((table, (leading, column)))
+        if not columns.get(table):
+            found.add((table, (column,)))
+    return found
+
+
+async def load_statements(conn: AsyncConnection, path: str | None, limit: int) -> list[tuple[str, int, float]]:
+    """
+    The load_statements function reads the statements to analyze with their call count and total time.
+
+    :param conn: AsyncConnection: The database connection, used for pg_stat_statements
+    :param path: str: A slow query JSON dump or a file with one statement per line, or None
+    :param limit: int: The number of statements to read from pg_stat_statements
+    :return: A list of (statement, calls, total_ms)
+    """
+    if path is None:
+        result = await conn.execute(text(
+            "SELECT query, calls, total_exec_time FROM pg_stat_statements "
+            "WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database()) "
+            "ORDER BY total_exec_time DESC LIMIT :limit"
+        ), {"limit": limit})
+        return [(query, calls, total) for query, calls, total in result]
+
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    try:
+        data = json.loads(content)
+    except ValueError:
+        return [(line.strip(), 1, 0.0) for line in content.splitlines() if line.strip()]
+    entries = data["statements"] if isinstance(data, dict) else data
+    return [(entry["statement"], entry.get("count", 1), entry.get("total_ms", 0.0)) for entry in entries]
+
+
+async def existing_indexes(conn: AsyncConnection) -> tuple[dict[str, list[tuple[str, ...]]], dict[str, set[str]]]:
+    """
+    The existing_indexes function reads the column lists of the indexes, primary keys and unique constraints.
+
+    :param conn: AsyncConnection: The database connection
+    :return: The indexed column lists and the columns of every table
+    """
+    def read(sync_conn):
+        inspector = inspect(sync_conn)
+        indexes, columns = {}, {}
+        for table in inspector.get_table_names():
+            columns[table] = {column["name"] for column in inspector.get_columns(table)}
+            found = [tuple(index["column_names"]) for index in inspector.get_indexes(table)]
+            found += [tuple(unique["column_names"]) for unique in inspector.get_unique_constraints(table)]
+            primary = inspector.get_pk_constraint(table)["constrained_columns"]
+            if primary:
+                found.append(tuple(primary))
+            indexes[table] = found
+        return indexes, columns
+
+    return await conn.run_sync(read)
+
+
+def missing(statements, indexes, columns) -> list[Candidate]:
+    """
+    The missing function keeps the candidates whose columns are not a prefix of an existing index.
+
+    :param statements: list: The (statement, calls, total_ms) to analyze
+    :param indexes: dict: The indexed column lists by table
+    :param columns: dict: The columns by table
+    :return: The missing indexes, the ones of the most expensive statements first
+    """
+    found: dict[tuple, Candidate] = {}
+    for statement, calls, total_ms in statements:
+        statement = fingerprint(statement)
+        for table, cols in candidates(statement):
+            if table not in columns or not set(cols) <= columns[table]:
+                continue
+            if any(index[:len(cols)] == cols for index in indexes.get(table, ())):
+                continue
+            candidate = found.setdefault((table, cols), Candidate(table, cols))
+            candidate.statements += 1
+            candidate.calls += calls
+            candidate.total_ms += total_ms
+            candidate.example = candidate.example or statement
+    # a composite index also serves the lookups on its leading column
+    for (table, cols), candidate in list(found.items()):
+        if len(cols) == 1 and any(t == table and c[0] == cols[0] and len(c) > 1 for t, c in found):
+            del found[(table, cols)]
+    return sorted(found.values(), key=lambda c: (c.total_ms, c.calls), reverse=True)
+
+
+async def _time(conn: AsyncConnection, statement, value, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        (await conn.execute(statement, {"value": value})).fetchall()
+    return (time.perf_counter() - start) * 1000 / repeat
+
+
+async def benchmark(conn: AsyncConnection, candidate: Candidate, repeat: int) -> tuple[float, float] | None:
+    """
+    The benchmark function times a lookup served by the candidate index without and with the index.
+    The index is dropped again afterwards.
+
+    :param conn: AsyncConnection: The database connection
+    :param candidate: Candidate: The missing index
+    :param repeat: int: How many times to run the lookup
+    :return: The mean time in milliseconds before and after, or None if the table is empty
+    """
+    leading = candidate.columns[0]
+    value = (await conn.execute(text(
+        f"SELECT {leading} FROM {candidate.table} WHERE {leading} IS NOT NULL LIMIT 1"
+    ))).scalar()
+    await conn.commit()
+    if value is None:
+        return None
+    order = f" ORDER BY {candidate.columns[1]}" if len(candidate.columns) > 1 else ""
+    lookup = text(f"SELECT * FROM {candidate.table} WHERE {leading} = :value{order}")
+    before = await _time(conn, lookup, value, repeat)
+    await conn.execute(text(candidate.ddl("").replace(candidate.name, f"advisor_{candidate.name}", 1)))
+    await conn.commit()
+    try:
+        after = await _time(conn, lookup, value, repeat)
+    finally:
+        await conn.execute(text(f"DROP INDEX advisor_{candidate.name}"))
+        await conn.commit()
+    return before, after
+
+
+async def main(args) -> None:
+    engine = create_async_engine(args.url)
+    try:
+        async with engine.connect() as conn:
+            statements = await load_statements(conn, args.statements, args.limit)
+            indexes, columns = await existing_indexes(conn)
+            found = missing(statements, indexes, columns)
+            print(f"{len(statements)} statements analyzed, {len(found)} missing indexes")
+            for candidate in found:
+                print()
+                print(f"{candidate.ddl(engine.dialect.name)};")
+                print(f"  used by {candidate.statements} statements, {candidate.calls} calls, "
+                      f"{candidate.total_ms:.1f} ms in total")
+                print(f"  e.g. {candidate.example[:200]}")
+                if args.benchmark:
+                    timings = await benchmark(conn, candidate, args.repeat)
+                    if timings is None:
+                        print("  benchmark skipped, the table is empty")
+                    else:
+                        before, after = timings
+                        print(f"  lookup {before:.3f} ms -> {after:.3f} ms ({before / max(after, 1e-9):.1f}x)")
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report the indexes missing for the statements the app issues.")
+    parser.add_argument("--url", default=config.DATABASE_URL, help="database URL, defaults to DATABASE_URL")
+    parser.add_argument("--statements", help="slow query JSON dump or file with one statement per line; "
+                                             "defaults to pg_stat_statements")
+    parser.add_argument("--limit", type=int, default=200, help="number of pg_stat_statements entries to read")
+    parser.add_argument("--benchmark", action="store_true", help="time a lookup before and after each index")
+    parser.add_argument("--repeat", type=int, default=50, help="lookups per benchmark")
+    asyncio.run(main(parser.parse_args()))
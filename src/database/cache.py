@@ -0,0 +1,13 @@
+import redis
+
+from src.conf.config import config
+from src.services.tracing import instrument_redis
+
+
+redis_client = redis.Redis(
+    host=config.REDIS_DOMAIN,
+    port=config.REDIS_PORT,
+    db=0,
+    password=config.REDIS_PASSWORD,
+)
+instrument_redis(redis_client)
@@ -2,11 +2,19 @@ import contextlib
 from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 
 from src.conf.config import config
+from src.database.queries import install_query_recorder
+from src.database.slow_queries import slow_query_log
+from src.services.metrics import instrument_pool
+from src.services.tracing import instrument_engine
 
 
 class DatabaseSessionManager:
     def __init__(self, url: str):
         self._engine: AsyncEngine = create_async_engine(url)
+        instrument_engine(self._engine)
+        instrument_pool(self._engine.sync_engine.pool)
+        install_query_recorder(self._engine)
+        slow_query_log.install(self._engine)
         self._session_maker: async_sessionmaker = async_sessionmaker(
             autoflush=False, autocommit=False, bind=self._engine
         )
@@ -0,0 +1,230 @@
+import logging
+import os
+import re
+import sys
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from greenlet import getcurrent
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.conf.config import config
+
+
+logger = logging.getLogger(__name__)
+
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATABASE_DIR = os.path.join(SRC_DIR, "database")
+ROUTES_DIR = os.path.join(SRC_DIR, "routes")
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b|\$\d+|%\(\w+\)s|:\w+")
+_lists = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+_spaces = re.compile(r"\s+")
+
+
+def fingerprint(statement: str) -> str:
+    """
+    The fingerprint function normalizes a SQL statement into its shape: literals and bind parameters become ``?``,
+    IN lists collapse to ``(?...)`` and whitespace is squeezed, so repeated statements compare equal.
+
+    >>> fingerprint("SELECT * FROM tags WHERE tags.name = $1 AND id IN ($2, $3,  $4)")
+    'SELECT * FROM tags WHERE tags.name = ? AND id IN (?...)'
+
+    :param statement: str: The SQL statement
+    :return: The normalized statement
+    """
+    statement = _literals.sub("?", statement)
+    statement = _lists.sub("(?...)", statement)
+    return _spaces.sub(" ", statement).strip()
+
+
+def _frames():
+    frame = sys._getframe(2)
+    current = getcurrent()
+    while True:
+        while frame is not None:
+            yield frame
+            frame = frame.f_back
+        current = current.parent if current is not None else None
+        if current is None:
+            return
+        frame = current.gr_frame
+
+
+def call_site() -> str | None:
+    """
+    The call_site function finds the application code (outside ``src/database``) that issued the current statement.
+    Statements of an AsyncSession run in a greenlet, so the frames of the parent greenlet are searched as well.
+
+    :return: A string like ``src/repository/photos.py:181 in get_or_create_tags`` or None
+    """
+    for frame in _frames():
+        filename = frame.f_code.co_filename
+        if filename.startswith(SRC_DIR) and not filename.startswith(DATABASE_DIR):
+            path = os.path.relpath(filename, os.path.dirname(SRC_DIR))
+            return f"{path}:{frame.f_lineno} in {frame.f_code.co_name}"
+    return None
+
+
+def route_function() -> str | None:
+    """
+    The route_function function finds the route function serving the current statement, e.g. ``get_posts``.
+
+    :return: The function name or None outside of a route
+    """
+    for frame in _frames():
+        if frame.f_code.co_filename.startswith(ROUTES_DIR):
+            return frame.f_code.co_name
+    return None
+
+
+class QueryRecorder:
+    """
+    Counts the statements, the rows and the repeated statement shapes issued while it is active, until stopped.
+    """
+
+    def __init__(self, capture_sites: bool = False):
+        self.capture_sites = capture_sites
+        self.stopped = False
+        self.statements = 0
+        self.rows = 0
+        self.shapes: Counter = Counter()
+        self.sites: dict[str, set[str]] = {}
+
+    def record(self, statement: str, rowcount: int) -> None:
+        if self.stopped:
+            return
+        shape = fingerprint(statement)
+        self.statements += 1
+        self.rows += max(rowcount, 0)
+        self.shapes[shape] += 1
+        if self.capture_sites:
+            site = call_site()
+            if site:
+                self.sites.setdefault(shape, set()).add(site)
+
+    def duplicates(self, threshold: int = 2) -> list[tuple[str, int]]:
+        """
+        The duplicates function lists the statement shapes executed at least threshold times, the usual N+1 symptom.
+
+        :param threshold: int: The minimal number of executions
+        :return: A list of (shape, count) pairs, most frequent first
+        """
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+
+current_recorder: ContextVar[QueryRecorder | None] = ContextVar("current_recorder", default=None)
+
+
+@contextmanager
+def record_queries(capture_sites: bool = False):
+    """
+    The record_queries function records the statements issued inside its block.
+
+        with record_queries() as recorder:
+            ...
+        assert recorder.statements <= 2
+
+    :param capture_sites: bool: Whether to remember the call site of every statement shape
+    :return: A context manager yielding the QueryRecorder
+    """
+    recorder = QueryRecorder(capture_sites)
+    token = current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        current_recorder.reset(token)
+
+
+def install_query_recorder(engine: AsyncEngine) -> None:
+    """
+    The install_query_recorder function feeds the statements of the engine to the active QueryRecorder.
+
+    :param engine: AsyncEngine: The engine to watch
+    :return: None
+    """
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        recorder = current_recorder.get()
+        if recorder is not None:
+            recorder.record(statement, getattr(cursor, "rowcount", -1))
+
+
+def query_budget(max_queries: int):
+    """
+    The query_budget function declares how many statements one request to the decorated endpoint may issue.
+    Put it below the route decorator:
+
+        @router.get("/")
+        @query_budget(2)
+        async def get_posts(...):
+
+    :param max_queries: int: The maximal number of statements
+    :return: The decorator
+    """
+    def decorator(func):
+        func.__query_budget__ = max_queries
+        return func
+
+    return decorator
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudgets:
+    """
+    Settings of the query budget check.
+
+    ``mode`` is "off", "warn" (log budget overruns and repeated statements with their call sites, for dev mode)
+    or "raise" (raise QueryBudgetExceeded, for tests).
+    """
+
+    def __init__(self, mode: str = "off", duplicate_threshold: int = 3):
+        self.mode = mode
+        self.duplicate_threshold = duplicate_threshold
+
+    def check(self, request: str, endpoint, recorder: QueryRecorder) -> None:
+        budget = getattr(endpoint, "__query_budget__", None)
+        if budget is not None and recorder.statements > budget:
+            message = f"{request} issued {recorder.statements} queries, budget is {budget}"
+            if self.mode == "raise":
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        if self.mode != "warn":
+            return
+        for shape, count in recorder.duplicates(self.duplicate_threshold):
+            sites = ", ".join(sorted(recorder.sites.get(shape, ()))) or "unknown call site"
+            logger.warning("%s repeated %d times in %s from %s", shape, count, request, sites)
+
+
+budgets = QueryBudgets(config.QUERY_BUDGET_MODE, config.QUERY_DUPLICATE_THRESHOLD)
+
+
+class QueryBudgetMiddleware:
+    """
+    ASGI middleware recording the statements of every request and checking them against the endpoint budget.
+    Recording stops once the response is sent, so the background tasks of the request are not counted.
+    It does nothing while ``budgets.mode`` is "off".
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or budgets.mode == "off":
+            await self.app(scope, receive, send)
+            return
+
+        with record_queries(capture_sites=budgets.mode == "warn") as recorder:
+            async def send_and_stop(message):
+                await send(message)
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    recorder.stopped = True
+
+            await self.app(scope, receive, send_and_stop)
+        budgets.check(f'{scope["method"]} {scope["path"]}', scope.get("endpoint"), recorder)
@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.conf.config import config
+from src.database.queries import call_site, fingerprint, route_function
+
+
+logger = logging.getLogger(__name__)
+
+
+def redact(parameters) -> list[str] | dict[str, str] | None:
+    """
+    The redact function replaces the values of statement parameters by their type names,
+    so slow query entries never leak emails, hashes or tokens.
+
+    :param parameters: The DBAPI parameters of the statement
+    :return: The parameter types, in the shape of the parameters
+    """
+    if parameters is None:
+        return None
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return [type(parameters).__name__]
+
+
+class SlowQuery:
+    """
+    The aggregated executions of one statement shape that exceeded the threshold.
+    """
+    __slots__ = ("shape", "count", "total_ms", "max_ms", "last_seen", "parameters", "sites", "routes", "plan")
+
+    def __init__(self, shape: str):
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_seen = 0.0
+        self.parameters = None
+        self.sites: set[str] = set()
+        self.routes: set[str] = set()
+        self.plan: list[str] | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "statement": self.shape,
+            "count": self.count,
+            "total_ms": round(self.total_ms, 2),
+            "mean_ms": round(self.total_ms / self.count, 2) if self.count else 0.0,
+            "max_ms": round(self.max_ms, 2),
+            "last_seen": self.last_seen,
+            "parameters": self.parameters,
+            "call_sites": sorted(self.sites),
+            "routes": sorted(self.routes),
+            "plan": self.plan,
+        }
+
+
+class SlowQueryLog:
+    """
+    Logs the statements slower than ``threshold_ms`` and aggregates them by fingerprint.
+
+    The first slow execution of a SELECT shape also captures its plan, ``EXPLAIN`` on PostgreSQL and
+    ``EXPLAIN QUERY PLAN`` on SQLite. The plan runs on its own connection in a background task,
+    so the request that hit the slow statement does not wait for it. The statement is planned, never executed
+    (no ANALYZE): it may take locks, e.g. ``FOR UPDATE`` or ``pg_advisory_xact_lock``, or call functions with
+    side effects.
+    """
+    explain_prefixes = {
+        "postgresql": "EXPLAIN ",
+        "sqlite": "EXPLAIN QUERY PLAN ",
+    }
+
+    def __init__(self, threshold_ms: float = 200.0, explain: bool = True, maxsize: int = 500):
+        self.threshold_ms = threshold_ms
+        self.explain = explain
+        self.maxsize = maxsize
+        self.entries: dict[str, SlowQuery] = {}
+        self._engine: AsyncEngine | None = None
+        self._explaining: set[str] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def install(self, engine: AsyncEngine) -> None:
+        """
+        The install function starts timing the statements of the engine.
+
+        :param engine: AsyncEngine: The engine to watch
+        :return: None
+        """
+        self._engine = engine
+
+        @event.listens_for(engine.sync_engine, "before_cursor_execute")
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+        @event.listens_for(engine.sync_engine, "after_cursor_execute")
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            starts = conn.info.get("slow_query_start")
+            if not starts:
+                return
+            duration_ms = (time.perf_counter() - starts.pop()) * 1000
+            if duration_ms >= self.threshold_ms and not conn.info.get("slow_query_explain"):
+                self.record(statement, parameters, duration_ms, conn.dialect.name)
+
+        @event.listens_for(engine.sync_engine, "handle_error")
+        def handle_error(context):
+            # a failed statement gets no after_cursor_execute: drop its start time
+            starts = context.connection.info.get("slow_query_start") if context.connection is not None else None
+            if starts:
+                starts.pop()
+
+    def record(self, statement: str, parameters, duration_ms: float, dialect: str) -> None:
+        """
+        The record function logs one slow execution and adds it to the entry of its fingerprint.
+
+        :param statement: str: The SQL statement
+        :param parameters: The DBAPI parameters of the statement
+        :param duration_ms: float: The execution time in milliseconds
+        :param dialect: str: The name of the database dialect
+        :return: None
+        """
+        shape = fingerprint(statement)
+        site = call_site()
+        route = route_function()
+        logger.warning(
+            "Slow query %.1f ms in %s from %s: %s parameters=%s",
+            duration_ms, route or "-", site or "-", shape, redact(parameters),
+        )
+
+        entry = self.entries.get(shape)
+        if entry is None:
+            if len(self.entries) >= self.maxsize:
+                smallest = min(self.entries.values(), key=lambda e: e.total_ms)
+                del self.entries[smallest.shape]
+            entry = self.entries[shape] = SlowQuery(shape)
+        entry.count += 1
+        entry.total_ms += duration_ms
+        entry.max_ms = max(entry.max_ms, duration_ms)
+        entry.last_seen = time.time()
+        entry.parameters = redact(parameters)
+        if site:
+            entry.sites.add(site)
+        if route:
+            entry.routes.add(route)
+
+        if self.explain and entry.plan is None and shape not in self._explaining:
+            self._schedule_explain(shape, statement, parameters, dialect)
+
+    def _schedule_explain(self, shape: str, statement: str, parameters, dialect: str) -> None:
+        prefix = self.explain_prefixes.get(dialect)
+        if prefix is None or self._engine is None or not statement.lstrip().upper().startswith("SELECT"):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._explaining.add(shape)
+        task = loop.create_task(self._explain(shape, prefix + statement, parameters))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _explain(self, shape: str, statement: str, parameters) -> None:
+        try:
+            async with self._engine.connect() as conn:
+                conn.sync_connection.info["slow_query_explain"] = True
+                try:
+                    result = await conn.exec_driver_sql(statement, parameters)
+                    rows = result.fetchall()
+                finally:
+                    conn.sync_connection.info.pop("slow_query_explain", None)
+                    await conn.rollback()
+        except Exception as err:
+            logger.error("Error explaining slow query %s: %s", shape, err)
+            return
+        finally:
+            self._explaining.discard(shape)
+        entry = self.entries.get(shape)
+        if entry is not None:
+            # PostgreSQL returns one line of plan per row, SQLite puts the plan detail in the last column
+            entry.plan = [str(row[-1]) for row in rows]
+
+    def top(self, limit: int = 20) -> list[dict]:
+        """
+        The top function returns the slow statement shapes of this worker with the largest total time.
+
+        :param limit: int: The number of entries to return
+        :return: A list of entries, slowest in total first
+        """
+        entries = sorted(self.entries.values(), key=lambda e: e.total_ms, reverse=True)
+        return [entry.to_dict() for entry in entries[:limit]]
+
+    def reset(self) -> None:
+        self.entries.clear()
+
+
+slow_query_log = SlowQueryLog(config.SLOW_QUERY_MS, config.SLOW_QUERY_EXPLAIN)
@@ -1,7 +1,7 @@
 import enum
 from datetime import date
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import String, ForeignKey, DateTime, Enum, Boolean, func, Table, Column
+from sqlalchemy import String, ForeignKey, DateTime, Enum, Boolean, func, Table, Column, Index, UniqueConstraint, Integer, BigInteger
 from sqlalchemy.orm import DeclarativeBase
 
 
@@ -22,7 +22,6 @@ class User(Base):
     email: Mapped[str] = mapped_column(String(150), nullable=False, unique=True)
     password: Mapped[str] = mapped_column(String(255), nullable=False)
     avatar: Mapped[str] = mapped_column(String(255), nullable=True)
-    refresh_token: Mapped[str] = mapped_column(String(255), nullable=True)
     created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
     updated_at: Mapped[date] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
     role: Mapped[Enum] = mapped_column(Enum(Role), default=Role.user, nullable=True)
@@ -34,15 +33,31 @@ class User(Base):
 
 class Photo(Base):
     __tablename__ = "photos"
+    __table_args__ = (
+        Index("ix_photos_user_id_created_at", "user_id", "created_at", postgresql_include=["id"]),
+        Index("ix_photos_created_at", "created_at"),
+        Index("ix_photos_taken_at", "taken_at"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, index=True)
     url: Mapped[str] = mapped_column(String, index=True, nullable=False)
     description: Mapped[str] = mapped_column(String, nullable=True)
     created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
     updated_at: Mapped[date] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), nullable=False)
+    blob_id: Mapped[int] = mapped_column(ForeignKey("blobs.id"), nullable=True, index=True)
+    dhash: Mapped[str] = mapped_column(String(16), nullable=True)
+    width: Mapped[int] = mapped_column(Integer, nullable=True)
+    height: Mapped[int] = mapped_column(Integer, nullable=True)
+    format: Mapped[str] = mapped_column(String(10), nullable=True)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    taken_at: Mapped[date] = mapped_column(DateTime, nullable=True)
+    blurhash: Mapped[str] = mapped_column(String(64), nullable=True)
     user: Mapped["User"] = relationship("User", back_populates="photos", lazy="joined")
     tags: Mapped[list["Tag"]] = relationship("Tag", secondary="photo_tags", back_populates="photos")
-    comments: Mapped["Comment"] = relationship("Comment", back_populates="photo", lazy="joined")
+    comments: Mapped[list["Comment"]] = relationship("Comment", back_populates="photo", lazy="joined",
+                                                     cascade="all, delete-orphan")
+    stats: Mapped["PhotoStats"] = relationship("PhotoStats", uselist=False, cascade="all, delete-orphan",
+                                               passive_deletes=True)
 
 
 class Tag(Base):
@@ -54,7 +69,7 @@ class Tag(Base):
     __tablename__ = "tags"
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(50), unique=True, nullable=True)
-    photos: Mapped["Photo"] = relationship("Photo", secondary="photo_tags", back_populates="tags")
+    photos: Mapped[list["Photo"]] = relationship("Photo", secondary="photo_tags", back_populates="tags")
 
 
 photo_tags = Table(
@@ -62,10 +77,15 @@ photo_tags = Table(
     Base.metadata,
     Column("photo_id", ForeignKey("photos.id"), primary_key=True),
     Column("tag_id", ForeignKey("tags.id"), primary_key=True),
+    Index("ix_photo_tags_tag_id_photo_id", "tag_id", "photo_id"),
 )
 
 class Comment(Base):
     __tablename__ = "comments"
+    __table_args__ = (
+        Index("ix_comments_photo_id_created_at", "photo_id", "created_at"),
+        Index("ix_comments_user_id", "user_id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     content: Mapped[str] = mapped_column(String(500))
     created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
@@ -74,3 +94,44 @@ class Comment(Base):
     user: Mapped["User"] = relationship("User", back_populates="comments", lazy="joined")
     photo_id: Mapped[int] = mapped_column(ForeignKey("photos.id"))
     photo: Mapped["Photo"] = relationship("Photo", back_populates="comments", lazy="joined")
+
+
+class RefreshSession(Base):
+    __tablename__ = "refresh_sessions"
+    id: Mapped[str] = mapped_column(String(32), primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id"), index=True)
+    jti: Mapped[str] = mapped_column(String(32), nullable=False)
+    revoked: Mapped[bool] = mapped_column(Boolean, default=False)
+    created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
+    expires_at: Mapped[date] = mapped_column(DateTime, nullable=False)
+
+
+class PhotoVariant(Base):
+    __tablename__ = "photo_variants"
+    __table_args__ = (UniqueConstraint("source_url", "params_hash", name="uq_photo_variants_source_url_params_hash"),)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    source_url: Mapped[str] = mapped_column(String(255), nullable=False)
+    preset: Mapped[str] = mapped_column(String(50), nullable=True)
+    params_hash: Mapped[str] = mapped_column(String(16), nullable=False)
+    url: Mapped[str] = mapped_column(String(255), nullable=False)
+    photo_id: Mapped[int] = mapped_column(ForeignKey("photos.id", ondelete="CASCADE"), nullable=True, index=True)
+    created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
+    updated_at: Mapped[date] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    sha256: Mapped[str] = mapped_column(String(64), unique=True, nullable=False)
+    size: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    url: Mapped[str] = mapped_column(String(255), nullable=False)
+    refcount: Mapped[int] = mapped_column(Integer, default=1, nullable=False)
+    created_at: Mapped[date] = mapped_column(DateTime, default=func.now())
+
+
+class PhotoStats(Base):
+    __tablename__ = "photo_stats"
+    photo_id: Mapped[int] = mapped_column(ForeignKey("photos.id", ondelete="CASCADE"), primary_key=True)
+    views: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    unique_views: Mapped[int] = mapped_column(BigInteger, default=0, nullable=False)
+    updated_at: Mapped[date] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
@@ -1,14 +1,21 @@
 import io
 import logging
 import qrcode
-from typing import Dict, List
+from typing import BinaryIO, Dict, List
 from fastapi import HTTPException, status
+from sqlalchemy import func
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
+from starlette.concurrency import run_in_threadpool
 
-from src.entity.models import Photo, Tag, User, Role
-from src.schemas.photo import PhotoCreate, PhotoUpdate
+from src.entity.models import Photo, Tag, User, Role, photo_tags
+from src.schemas.photo import PhotoCreate, PhotoFilter, PhotoUpdate
+from src.services.blobs import blob_store
+from src.services.metadata import ImageMetadata, read_metadata
+from src.services.similarity import photo_hash, similarity_index
+from src.services.singleflight import SingleFlight
+from src.services.tag_graph import tag_graph
 
 
 logging.basicConfig(level=logging.ERROR)
@@ -19,31 +26,68 @@ def is_admin(user: User) -> bool:
     return user.role == 'admin'
 
 
-async def create_photo(photo_data: PhotoCreate, user: User, db: AsyncSession):
+def tag_links(photo: Photo) -> list[tuple[int, str]]:
+    return [(tag.id, tag.name) for tag in photo.tags]
+
+
+async def create_photo(photo_data: PhotoCreate, user: User, db: AsyncSession, blob_id: int | None = None,
+                       dhash: str | None = None, metadata: ImageMetadata | None = None):
     """
     The create_photo function creates a new photo in the database.
 
     :param photo_data: PhotoCreate: The data for creating a new photo
     :param user: User: The user who is creating the photo
     :param db: AsyncSession: The database session to use for the operation
+    :param blob_id: int | None: The stored image the photo references
+    :param dhash: str | None: The perceptual hash of the image, indexed for the similarity search
+    :param metadata: ImageMetadata | None: The dimensions, format, size and capture time of the image
     :return: The newly created photo object
     """
     new_photo = Photo(
         url=photo_data.url,
         description=photo_data.description,
-        user_id=user.id
+        user_id=user.id,
+        blob_id=blob_id,
+        dhash=dhash,
+        **(metadata._asdict() if metadata else {})
     )
     if photo_data.tags:
         tags = await get_or_create_tags(photo_data.tags, db)
         new_photo.tags.extend(tags)
+    links = tag_links(new_photo)
 
     db.add(new_photo)
     await db.commit()
     await db.refresh(new_photo)
+    tag_graph.publish(new_photo.id, [], links)
+    if new_photo.dhash:
+        similarity_index.publish_added(new_photo.id, new_photo.dhash)
     logger.debug("Photo created successfully with ID: %d for user: %d", new_photo.id, user.id)
     return new_photo
 
 
+async def create_photo_from_file(file: BinaryIO, content_type: str | None, description: str | None, tags: List[str],
+                                 user: User, db: AsyncSession):
+    """
+    The create_photo_from_file function stores an uploaded image and creates its photo.
+    Bytes that were already uploaded are not stored again, the photo reuses the stored image.
+    The perceptual hash and the metadata of the image are read from the file.
+
+    :param file: BinaryIO: The image file, positioned at its start
+    :param content_type: str | None: The content type of the image
+    :param description: str | None: The description of the photo
+    :param tags: List[str]: A list of tags associated with the photo
+    :param user: User: The user who is creating the photo
+    :param db: AsyncSession: The database session to use for the operation
+    :return: The newly created photo object
+    """
+    metadata = await run_in_threadpool(read_metadata, file)
+    dhash = await run_in_threadpool(photo_hash, file)
+    blob = await blob_store.store(file, db, content_type)
+    photo_data = PhotoCreate(url=blob.url, description=description, tags=tags)
+    return await create_photo(photo_data, user, db, blob_id=blob.id, dhash=dhash, metadata=metadata)
+
+
 async def update_photo(photo_id: int, photo_data: PhotoUpdate, user: User, db: AsyncSession):
     """
     The update_photo function updates an existing photo's description in the database.
@@ -60,6 +104,7 @@ async def update_photo(photo_id: int, photo_data: PhotoUpdate, user: User, db: A
     result = await db.execute(stmt)
     photo = result.unique().scalar_one_or_none()
     if photo:
+        old_links = tag_links(photo)
         if photo_data.description is not None:
             photo.description = photo_data.description
 
@@ -75,8 +120,10 @@ async def update_photo(photo_id: int, photo_data: PhotoUpdate, user: User, db: A
                     db.add(new_tag)
                     await db.flush()
                     photo.tags.append(new_tag)
+        new_links = tag_links(photo)
         await db.commit()
         await db.refresh(photo)
+        tag_graph.publish(photo.id, old_links, new_links)
         return photo
     else:
         return None
@@ -85,45 +132,56 @@ async def update_photo(photo_id: int, photo_data: PhotoUpdate, user: User, db: A
 async def delete_photo_handler(photo_id: int, user: User, db: AsyncSession):
     """
     The delete_photo function deletes an existing photo from the database.
+    The stored image is deleted too when no other photo references it.
 
     :param photo_id: int: The ID of the photo to delete
     :param user: User: The user who owns the photo
     :param db: AsyncSession: The database session to use for the operation
     :return: The deleted photo object
     """
-    stmt = select(Photo).filter_by(id=photo_id)
+    stmt = select(Photo).filter_by(id=photo_id).options(joinedload(Photo.tags))
     if user.role != Role.admin:
         stmt = stmt.filter_by(user_id=user.id)
     result = await db.execute(stmt)
     photo = result.unique().scalar_one_or_none()
     if not photo:
         return None
+    links = tag_links(photo)
 
     await db.delete(photo)
+    # photos reference their blob: the photo row goes first, then the blob may be deleted with its last reference
+    await db.flush()
+    orphan = await blob_store.release(photo.blob_id, db) if photo.blob_id else None
     await db.commit()
+    tag_graph.publish(photo.id, links, [])
+    if photo.dhash:
+        similarity_index.publish_removed(photo.id)
+    if orphan is not None:
+        await blob_store.purge(orphan, db)
     return photo
 
 
 async def get_photo(photo_id: int, db: AsyncSession):
     """
-    The get_photo function retrieves a photo by its ID from the database.
+    The get_photo function retrieves a photo by its ID from the database, with its tags and view stats.
 
     :param photo_id: int: The ID of the photo to retrieve
     :param db: AsyncSession: The database session to use for the operation
     :return: The photo object or None if not found
     """
-    stmt = select(Photo).filter_by(id=photo_id).options(joinedload(Photo.tags))
+    stmt = select(Photo).filter_by(id=photo_id).options(joinedload(Photo.tags), joinedload(Photo.stats))
     result = await db.execute(stmt)
     photo = result.unique().scalar_one_or_none()
     return photo
 
 
-async def get_photos(user: User, db: AsyncSession):
+async def get_photos(user: User, db: AsyncSession, filters: PhotoFilter | None = None):
     """
     The get_photos function retrieves all photos for a given user from the database.
 
     :param user: User: The user whose photos are to be retrieved
     :param db: AsyncSession: The database session to use for the operation
+    :param filters: PhotoFilter | None: Bounds on the image metadata and the sort order
     :return: A list of photo objects
     """
     photos_query = select(Photo).options(joinedload(Photo.tags))
@@ -131,10 +189,63 @@ async def get_photos(user: User, db: AsyncSession):
     if user.role != Role.admin:
         photos_query= photos_query.filter_by(user_id=user.id)
 
+    if filters is not None:
+        bounds = [
+            (Photo.width, filters.min_width, filters.max_width),
+            (Photo.height, filters.min_height, filters.max_height),
+            (Photo.size, filters.min_size, filters.max_size),
+            (Photo.taken_at, filters.taken_after, filters.taken_before),
+        ]
+        for column, low, high in bounds:
+            if low is not None:
+                photos_query = photos_query.filter(column >= low)
+            if high is not None:
+                photos_query = photos_query.filter(column <= high)
+        if filters.format:
+            photos_query = photos_query.filter(func.upper(Photo.format) == filters.format.upper())
+        column = getattr(Photo, filters.sort)
+        order = column.desc() if filters.order == "desc" else column.asc()
+        photos_query = photos_query.order_by(order.nulls_last(), Photo.id)
+
     photos = await db.execute(photos_query)
     return photos.unique().scalars().all()
 
 
+async def get_photo_tag_ids(user_id: int, db: AsyncSession):
+    """
+    The get_photo_tag_ids function retrieves the tag IDs of every photo of a user in one query, without the photos.
+
+    :param user_id: int: The ID of the user who owns the photos
+    :param db: AsyncSession: The database session to use for the operation
+    :return: A dictionary mapping each photo ID to the list of its tag IDs
+    """
+    result = await db.execute(
+        select(Photo.id, photo_tags.c.tag_id)
+        .outerjoin(photo_tags, photo_tags.c.photo_id == Photo.id)
+        .filter(Photo.user_id == user_id)
+    )
+    tag_ids = {}
+    for photo_id, tag_id in result:
+        tag_ids.setdefault(photo_id, [])
+        if tag_id is not None:
+            tag_ids[photo_id].append(tag_id)
+    return tag_ids
+
+
+async def get_photos_by_ids(photo_ids: List[int], db: AsyncSession):
+    """
+    The get_photos_by_ids function retrieves several photos by their IDs in one query.
+
+    :param photo_ids: List[int]: The IDs of the photos to retrieve
+    :param db: AsyncSession: The database session to use for the operation
+    :return: A list of photo objects, in no particular order
+    """
+    if not photo_ids:
+        return []
+    result = await db.execute(select(Photo).where(Photo.id.in_(photo_ids)))
+    return result.unique().scalars().all()
+
+
 async def add_tags_to_photo(photo_id: int, tags: List[str], user: User, db: AsyncSession):
     """
     The add_tags_to_photo function adds tags to an existing photo in the database.
@@ -159,38 +270,39 @@ async def add_tags_to_photo(photo_id: int, tags: List[str], user: User, db: Asyn
         logger.error(f"Validation error for photo ID {photo_id}: {e}")
         raise e
 
+    old_links = tag_links(photo)
     tags = await get_or_create_tags(unique_new_tags, db)
     photo.tags.extend(tags)
+    new_links = tag_links(photo)
     await db.commit()
     await db.refresh(photo)
+    tag_graph.publish(photo.id, old_links, new_links)
     logger.debug("Tags added successfully to photo ID: %d for user: %d", photo_id, user.id)
     return photo
 
 
 async def get_or_create_tags(tag_names: List[str], db: AsyncSession):
     """
-    The get_or_create_tags function retrieves or creates tags based on the given list of tag names.
+    The get_or_create_tags function retrieves or creates tags based on the given list of tag names,
+    in one query for the existing tags and one flush for the new ones.
 
     :param tag_names: List[str]: The list of tag names to retrieve or create
     :param db: AsyncSession: The database session to use for the operation
     :return: A list of tag objects
     """
-    tags = []
-    for tag_name in tag_names:
-        logger.debug("Processing tag: %s", tag_name)
-        tag = await db.execute(select(Tag).filter_by(name=tag_name))
-        existing_tag = tag.scalar_one_or_none()
-        if existing_tag:
-            logger.debug("Existing tag found: %s", tag_name)
-            tags.append(existing_tag)
-        else:
-            logger.debug("Creating new tag: %s", tag_name)
-            new_tag = Tag(name=tag_name)
-            db.add(new_tag)
-            await db.flush()
-            tags.append(new_tag)
-            logger.debug("New tag created: %s", tag_name)
-    return tags
+    tag_names = list(dict.fromkeys(tag_names))
+    if not tag_names:
+        return []
+    result = await db.execute(select(Tag).where(Tag.name.in_(tag_names)))
+    tags = {tag.name: tag for tag in result.scalars()}
+    new_tags = [Tag(name=tag_name) for tag_name in tag_names if tag_name not in tags]
+    if new_tags:
+        # the callers publish the new tags with the tag links after the commit, see tag_graph.publish
+        logger.debug("Creating new tags: %s", [tag.name for tag in new_tags])
+        db.add_all(new_tags)
+        await db.flush()
+        tags.update((tag.name, tag) for tag in new_tags)
+    return [tags[tag_name] for tag_name in tag_names]
 
 
 async def validate_tags(photo: Photo, new_tags: List[str]):
@@ -239,11 +351,14 @@ async def remove_tags_from_photo(photo_id: int, tags: List[str], user: User, db:
         logger.error("No matching tags found for photo ID: %d", photo_id)
         raise ValueError("No matching tags found for this photo")
     
+    old_links = tag_links(photo)
     for tag in tags_to_remove:
         photo.tags.remove(tag)
+    new_links = tag_links(photo)
     
     await db.commit()
     await db.refresh(photo)
+    tag_graph.publish(photo.id, old_links, new_links)
     logger.debug("Tags removed successfully from photo ID: %d for user: %d", photo_id, user.id)
     return photo
 
@@ -264,3 +379,20 @@ def generate_qr_code(data: str):
     img.save(buffer)
     buffer.seek(0)
     return buffer
+
+
+qr_flight = SingleFlight("qr_code")
+
+
+async def render_qr_code(data: str) -> bytes:
+    """
+    The render_qr_code function renders the QR code of the data in a worker thread.
+    Concurrent requests for the same data share one rendering.
+
+    :param data: str: The data to encode in the QR code
+    :return: The PNG image of the QR code
+    """
+    async def render() -> bytes:
+        return (await run_in_threadpool(generate_qr_code, data)).getvalue()
+
+    return await qr_flight.do(data, render)
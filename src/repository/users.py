@@ -1,12 +1,12 @@
 import logging
 from fastapi import Depends
-from sqlalchemy import select
+from sqlalchemy import func, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from libgravatar import Gravatar
 from sqlalchemy.orm import joinedload
 
 from src.database.db import get_db
-from src.entity.models import User, Role
+from src.entity.models import Photo, PhotoStats, User, Role
 from src.schemas.user import UserSchema, UserProfileResponse,UserUpdateSchema
 
 
@@ -60,20 +60,6 @@ async def create_user(body: UserSchema, role: Role, db: AsyncSession = Depends(g
     return new_user
 
 
-async def update_token(user: User, token: str | None, db: AsyncSession):
-    """
-    The update_token function updates the user's refresh token in the database.
-    
-    :param user: User: Get the user object from the database
-    :param token: str | None: Set the refresh_token field of the user
-    :param db: AsyncSession: Commit the changes to the database
-    :return: Nothing, so it should be declared as returning none
-    :doc-author: Trelent
-    """
-    user.refresh_token = token
-    await db.commit()
-
-
 async def confirmed_email(email: str, db: AsyncSession) -> None:
     """
     The confirmed_email function marks a user as confirmed in the database.
@@ -126,6 +112,23 @@ async def get_user_by_username(username: str, db: AsyncSession) -> User:
     return user
 
 
+async def get_view_totals(user_id: int, db: AsyncSession) -> tuple[int, int]:
+    """
+    The get_view_totals function sums the stored views of all the photos of a user.
+
+    :param user_id: int: The ID of the user
+    :param db: AsyncSession: Pass the database session to the function
+    :return: A tuple of the total views and the sum of the unique views of each photo
+    """
+    stmt = (
+        select(func.coalesce(func.sum(PhotoStats.views), 0), func.coalesce(func.sum(PhotoStats.unique_views), 0))
+        .join(Photo, Photo.id == PhotoStats.photo_id)
+        .filter(Photo.user_id == user_id)
+    )
+    views, unique_views = (await db.execute(stmt)).one()
+    return int(views), int(unique_views)
+
+
 async def get_user_profile(username: str, db: AsyncSession) -> UserProfileResponse:
     """
     The get_user_profile function retrieves a user's profile based on the username provided.
@@ -141,6 +144,7 @@ async def get_user_profile(username: str, db: AsyncSession) -> UserProfileRespon
         logger.warning("User profile not found: %s", username)
         return None
     photo_count = len(user.photos) if user.photos else 0
+    views, unique_views = await get_view_totals(user.id, db)
     user_profile = UserProfileResponse(
         id=user.id,
         username=user.username,
@@ -150,7 +154,9 @@ async def get_user_profile(username: str, db: AsyncSession) -> UserProfileRespon
         updated_at=user.updated_at,
         confirmed=user.confirmed,
         role=user.role,
-        photo_count=photo_count 
+        photo_count=photo_count,
+        views=views,
+        unique_views=unique_views
     )
     logger.info("Profile fetched for user: %s", username)
     return user_profile
@@ -173,27 +179,30 @@ async def update_own_profile(body: UserUpdateSchema, user: User, db: AsyncSessio
         return None
     
     try:
-        if body.username and body.username != user.username:
-            user.username = body.username
+        if body.username and body.username != existing_user.username:
+            existing_user.username = body.username
         
         if body.password:
             from src.services.auth import auth_service
-            user.password = auth_service.get_password_hash(body.password)
+            existing_user.password = auth_service.get_password_hash(body.password)
 
         await db.commit()
-        await db.refresh(user)
+        await db.refresh(existing_user)
         
-        photo_count = len(user.photos) if user.photos else 0
+        photo_count = len(existing_user.photos) if existing_user.photos else 0
+        views, unique_views = await get_view_totals(existing_user.id, db)
         user_profile = UserProfileResponse(
-            id=user.id,
-            username=user.username,
-            email=user.email,
-            avatar=user.avatar,
-            created_at=user.created_at,
-            updated_at=user.updated_at,
-            confirmed=user.confirmed,
-            role=user.role, 
-            photo_count=photo_count 
+            id=existing_user.id,
+            username=existing_user.username,
+            email=existing_user.email,
+            avatar=existing_user.avatar,
+            created_at=existing_user.created_at,
+            updated_at=existing_user.updated_at,
+            confirmed=existing_user.confirmed,
+            role=existing_user.role, 
+            photo_count=photo_count,
+            views=views,
+            unique_views=unique_views
         )
         
         logger.info("Profile updated for user: %s", user.username)
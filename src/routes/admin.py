@@ -0,0 +1,132 @@
+import secrets
+from collections import Counter
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, status
+from fastapi.responses import Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.db import get_db
+from src.database.slow_queries import slow_query_log
+from src.entity.models import Role
+from src.services.metrics import queued
+from src.services.profiler import profiler, render
+from src.services.recommendations import recommendation_index
+from src.services.roles import RoleAccess
+from src.services.variants import variant_store
+
+
+router = APIRouter(prefix="/admin", tags=["admin"])
+
+access_to_route_admin = RoleAccess([Role.admin])
+
+PROFILE_FORMATS = "^(collapsed|speedscope)$"
+
+
+def profile_response(samples: Counter, interval: float, name: str, fmt: str) -> Response:
+    if fmt == "speedscope":
+        media_type, filename = "application/json", "profile.speedscope.json"
+    else:
+        media_type, filename = "text/plain", "profile.collapsed.txt"
+    return Response(
+        render(samples, interval, name, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/profile", dependencies=[Depends(access_to_route_admin)])
+async def profile_worker(
+    seconds: float = Query(5, gt=0),
+    format: str = Query("collapsed", pattern=PROFILE_FORMATS),
+):
+    """
+    The profile_worker function samples the worker serving this request for a few seconds
+    and returns the profile as collapsed stacks (flamegraph) or speedscope JSON.
+
+    :param seconds: float: How long to profile, capped at PROFILER_MAX_SECONDS
+    :param format: str: "collapsed" or "speedscope"
+    :return: The profile file
+    """
+    samples, duration = await profiler.profile_worker(seconds)
+    return profile_response(samples, profiler.interval, f"worker profile ({duration:.1f} s)", format)
+
+
+@router.post("/profile/requests", status_code=status.HTTP_201_CREATED, dependencies=[Depends(access_to_route_admin)])
+async def arm_request_profile():
+    """
+    The arm_request_profile function issues a token; the next request sent with it in the X-Profile-Token header
+    is profiled, and its profile can be fetched with the token afterwards.
+
+    :return: A dictionary with the token and the header to send it in
+    """
+    token = secrets.token_urlsafe(16)
+    profiler.arm(token)
+    return {"token": token, "header": "X-Profile-Token"}
+
+
+@router.get("/profile/requests/{token}", dependencies=[Depends(access_to_route_admin)])
+async def get_request_profile(token: str, format: str = Query("collapsed", pattern=PROFILE_FORMATS)):
+    """
+    The get_request_profile function returns the profile of the request flagged with the token.
+
+    :param token: str: The token issued by arm_request_profile
+    :param format: str: "collapsed" or "speedscope"
+    :return: The profile file
+    """
+    data = profiler.result(token)
+    if data is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    samples = Counter({tuple(stack): count for stack, count in data["stacks"]})
+    return profile_response(samples, data["interval"], data["request"], format)
+
+
+@router.get("/slow-queries", dependencies=[Depends(access_to_route_admin)])
+async def get_slow_queries(limit: int = Query(20, ge=1, le=500)):
+    """
+    The get_slow_queries function lists the statements of this worker that exceeded SLOW_QUERY_MS,
+    grouped by fingerprint, with the largest total time first.
+
+    :param limit: int: The number of statements to return
+    :return: A dictionary with the threshold and the statements with their call sites, routes and plan
+    """
+    return {"threshold_ms": slow_query_log.threshold_ms, "statements": slow_query_log.top(limit)}
+
+
+@router.delete("/slow-queries", status_code=status.HTTP_204_NO_CONTENT, dependencies=[Depends(access_to_route_admin)])
+async def reset_slow_queries():
+    """
+    The reset_slow_queries function clears the slow query statistics of this worker.
+
+    :return: None
+    """
+    slow_query_log.reset()
+
+
+@router.post("/variants/regenerate", dependencies=[Depends(access_to_route_admin)])
+async def regenerate_variants(background_tasks: BackgroundTasks, db: AsyncSession = Depends(get_db)):
+    """
+    The regenerate_variants function regenerates in the background the image variants made from a preset
+    whose definition changed since, and deletes the variants of removed presets.
+
+    :param background_tasks: BackgroundTasks: Add the regeneration to the background tasks queue
+    :param db: AsyncSession: The database session
+    :return: A dictionary with the number of variants scheduled for regeneration
+    """
+    stale = await variant_store.stale(db)
+    if variant_store.enabled:
+        for source_url, preset, photo_id in stale:
+            background_tasks.add_task(queued(variant_store.generate), source_url, [preset], photo_id)
+    return {"scheduled": len(stale)}
+
+
+@router.post("/recommendations/rebuild", dependencies=[Depends(access_to_route_admin)])
+async def rebuild_recommendations(db: AsyncSession = Depends(get_db)):
+    """
+    The rebuild_recommendations function rebuilds the recommendation index of this worker from the photo tags,
+    folding in the photos retagged since the last build.
+
+    :param db: AsyncSession: The database session
+    :return: A dictionary with the number of photos indexed
+    """
+    await recommendation_index.rebuild(db)
+    return {"photos": len(recommendation_index)}
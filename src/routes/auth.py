@@ -7,7 +7,9 @@ from src.database.db import get_db
 from src.repository import users as repositories_users
 from src.schemas.user import UserSchema, TokenSchema, UserResponse, RequestEmail
 from src.services.auth import auth_service
+from src.services.sessions import session_store
 from src.services.email import send_email
+from src.services.metrics import queued
 from src.conf import messages
 
 
@@ -41,7 +43,7 @@ async def signup(body: UserSchema, bt: BackgroundTasks, request: Request, db: As
     is_first_user = (await db.execute(text("SELECT COUNT(*) FROM users"))).scalar() == 0
     body.password = auth_service.get_password_hash(body.password)
     new_user = await repositories_users.create_user(body, role="admin" if is_first_user else "user", db=db)
-    bt.add_task(send_email, new_user.email, new_user.username, str(request.base_url))
+    bt.add_task(queued(send_email), new_user.email, new_user.username, str(request.base_url))
     return new_user
 
 
@@ -65,9 +67,10 @@ async def login(body: OAuth2PasswordRequestForm = Depends(), db: AsyncSession =
     if not auth_service.verify_password(body.password, user.password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid password")
 
+    sid, jti = await session_store.open(user, db)
     access_token = await auth_service.create_access_token(data={"sub": user.email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": user.email})
-    await repositories_users.update_token(user, refresh_token, db)
+    refresh_token = await auth_service.create_refresh_token(data={"sub": user.email, "sid": sid, "jti": jti},
+                                                            expires_delta=session_store.ttl)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
@@ -77,6 +80,8 @@ async def refresh_toke(credentials: HTTPAuthorizationCredentials = Depends(get_r
     """
     The refresh_token function is used to refresh the access token.
     It takes in a refresh token and returns an access_token, a new refresh_token, and the type of token (bearer).
+    The refresh token is rotated within its session; presenting an already rotated token revokes the whole session.
+    Users banned or deleted since the login get no new tokens.
     
     
     :param credentials: HTTPAuthorizationCredentials: Get the token from the authorization header
@@ -84,19 +89,37 @@ async def refresh_toke(credentials: HTTPAuthorizationCredentials = Depends(get_r
     :return: A dictionary with the access_token, refresh_token and token type
     :doc-author: Trelent
     """
-    token = credentials.credentials
-    email = await auth_service.decode_refresh_token(token)
+    payload = await auth_service.decode_refresh_token(credentials.credentials)
+    email, sid = payload["sub"], payload["sid"]
     user = await repositories_users.get_user_by_email(email, db)
-    if user.refresh_token != token:
-        await repositories_users.update_token(user, None, db)
+    if user is None or user.is_active is False:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
+    jti = await session_store.rotate(sid, payload["jti"], user, db)
+    if jti is None:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid refresh token")
 
     access_token = await auth_service.create_access_token(data={"sub": email})
-    refresh_token = await auth_service.create_refresh_token(data={"sub": email})
-    await repositories_users.update_token(user, refresh_token, db)
+    refresh_token = await auth_service.create_refresh_token(data={"sub": email, "sid": sid, "jti": jti},
+                                                            expires_delta=session_store.ttl)
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
+@router.post('/logout', status_code=status.HTTP_204_NO_CONTENT)
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(get_refresh_token),
+                 db: AsyncSession = Depends(get_db)):
+    """
+    The logout function revokes the session of the given refresh token, so that no token of its family
+    can be refreshed any more. Other sessions of the user stay open.
+
+    :param credentials: HTTPAuthorizationCredentials: Get the refresh token from the authorization header
+    :param db: AsyncSession: Get the database session
+    :return: None
+    """
+    payload = await auth_service.decode_refresh_token(credentials.credentials)
+    await session_store.revoke(payload["sid"], db)
+    return None
+
+
 @router.get('/confirmed_email/{token}')
 async def confirmed_email(token: str, db: AsyncSession = Depends(get_db)):
     """
@@ -141,5 +164,5 @@ async def request_email(body: RequestEmail, background_tasks: BackgroundTasks, r
     if user.confirmed:
         return {"message": "Your email is already confirmed"}
     if user:
-        background_tasks.add_task(send_email, user.email, user.username, str(request.base_url))
+        background_tasks.add_task(queued(send_email), user.email, user.username, str(request.base_url))
     return {"message": "Check your email for confirmation."}
@@ -3,15 +3,19 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from src.database.db import get_db
+from src.database.queries import query_budget
 from src.entity.models import Comment, Photo, User
 from src.schemas.comment import CommentCreate, CommentUpdate, CommentResponse
 from src.services.auth import auth_service
+from src.services.idempotency import idempotent
+from src.services.trending import trending
 
 
 router = APIRouter(prefix="/comments", tags=["comments"])
 
 
 @router.post("/", response_model=CommentResponse, status_code=status.HTTP_201_CREATED)
+@idempotent
 async def create_comment(
     photo_id: int,
     body: CommentCreate,
@@ -36,6 +40,7 @@ async def create_comment(
         db.add(comment)
         await db.commit()
         await db.refresh(comment)
+        trending.record(photo.id, "comment")
         return comment
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -97,6 +102,7 @@ async def delete_comment(
 
 
 @router.get("/photo/{photo_id}", response_model=list[CommentResponse])
+@query_budget(1)
 async def get_comments_by_photo(
     photo_id: int,
     db: AsyncSession = Depends(get_db)
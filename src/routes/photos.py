@@ -1,15 +1,27 @@
+import io
 import logging
-from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File
+import os
+from urllib.parse import urlsplit
+from fastapi import APIRouter, HTTPException, Depends, status, UploadFile, File, BackgroundTasks, Query, Request
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional, List
 
 from src.database.db import get_db
+from src.database.queries import query_budget
 from src.entity.models import User
-from src.schemas.photo import PhotoCreate, PhotoUpdate, PhotoResponse2, PhotoBase, PhotoResponse, TransformationParams
+from src.schemas.photo import PhotoUpdate, PhotoFilter, PhotoResponse2, PhotoBase, PhotoResponse, TransformationParams, PhotoDetailResponse, SimilarPhotoResponse, RecommendedPhotoResponse, TrendingPhotoResponse
 from src.services.auth import auth_service
-from src.services.cloudinary import upload_image, transform_image
-from src.repository.photos import create_photo, update_photo, delete_photo_handler, get_photo, get_photos, add_tags_to_photo, remove_tags_from_photo, generate_qr_code
+from src.services.downloads import downloader
+from src.services.idempotency import idempotent
+from src.services.metrics import queued
+from src.services.placeholders import placeholders
+from src.services.recommendations import recommendation_index
+from src.services.similarity import MAX_DISTANCE, similarity_index
+from src.services.trending import trending
+from src.services.views import view_counter
+from src.services.variants import PHOTO_PRESETS, variant_store
+from src.repository.photos import create_photo_from_file, update_photo, delete_photo_handler, get_photo, get_photos, get_photos_by_ids, get_photo_tag_ids, add_tags_to_photo, remove_tags_from_photo, render_qr_code
 
 
 router = APIRouter(prefix='/photos', tags=['photos'])
@@ -19,7 +31,9 @@ logger = logging.getLogger(__name__)
 
 
 @router.post("/", response_model=PhotoBase, status_code=status.HTTP_201_CREATED)
+@idempotent
 async def upload_photo(
+    background_tasks: BackgroundTasks,
     description: Optional[str] = None,
     file: UploadFile = File(...),
     tags: List[str] = [],
@@ -28,7 +42,12 @@ async def upload_photo(
 ):
     """
     The upload_photo function uploads a new photo with an optional description and tags.
+    Bytes that were already uploaded are not uploaded again, the photo reuses the stored image.
+    The perceptual hash of the image is stored for the similarity search, and its dimensions, format,
+    size and capture time are read from the headers without decoding it.
+    The preset variants and the BlurHash placeholder of the photo are generated in the background.
 
+    :param background_tasks: BackgroundTasks: Add the variant and placeholder generation to the background tasks queue
     :param description: Optional[str]: The description of the photo
     :param file: UploadFile: The file object of the photo to be uploaded
     :param tags: List[str]: A list of tags associated with the photo
@@ -37,9 +56,11 @@ async def upload_photo(
     :return: The newly created photo object
     :doc-author: Trelent
     """
-    url = upload_image(file.file)
-    photo_data = PhotoCreate(url=url, description=description, tags=tags)
-    return await create_photo(photo_data, user, db)
+    photo = await create_photo_from_file(file.file, file.content_type, description, tags, user, db)
+    if variant_store.enabled:
+        background_tasks.add_task(queued(variant_store.generate), photo.url, PHOTO_PRESETS, photo.id)
+    background_tasks.add_task(queued(placeholders.generate), photo.id, photo.url)
+    return photo
 
 
 @router.put("/{photo_id}", response_model=PhotoResponse2)
@@ -83,46 +104,193 @@ async def delete_photo(
     deleted_photo = await delete_photo_handler(photo_id, user, db)
     if not deleted_photo:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
+    trending.remove(photo_id)
+    view_counter.forget(photo_id)
     return None
 
 
-@router.get("/{photo_id}", response_model=PhotoResponse2)
+@router.get("/trending", response_model=list[TrendingPhotoResponse])
+@query_budget(1)
+async def get_trending_photos(
+    offset: int = Query(0, ge=0, le=10000),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    The get_trending_photos function lists the photos most commented and viewed lately,
+    recent events weighing more than old ones.
+
+    :param offset: int: The number of photos to skip
+    :param limit: int: The maximal number of photos to return
+    :param db: AsyncSession: The database session to use for the operation
+    :return: A list of photo objects with their score, highest first
+    :doc-author: Trelent
+    """
+    ranked = trending.top(offset, limit)
+    photos = {photo.id: photo for photo in await get_photos_by_ids([photo_id for photo_id, _ in ranked], db)}
+    return [
+        TrendingPhotoResponse(**PhotoResponse2.model_validate(photos[photo_id]).model_dump(), score=score)
+        for photo_id, score in ranked
+        if photo_id in photos
+    ]
+
+
+@router.get("/recommended", response_model=list[RecommendedPhotoResponse])
+@query_budget(3)
+async def get_recommended_photos(
+    photo_id: Optional[int] = None,
+    limit: int = Query(20, ge=1, le=100),
+    user: User = Depends(auth_service.get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    The get_recommended_photos function recommends the photos whose tags are the most similar to the tags
+    of a photo or, without a photo, to the tags of all the photos uploaded by the current user.
+    The similarity is the cosine of the tag vectors, computed by the in-memory recommendation index.
+
+    :param photo_id: int: The ID of the photo to match, if any
+    :param limit: int: The maximal number of photos to return
+    :param user: User: The current user
+    :param db: AsyncSession: The database session to use for the operation
+    :return: A list of photo objects with their score, most similar first
+    :doc-author: Trelent
+    """
+    if photo_id is not None:
+        photo = await get_photo(photo_id, db)
+        if not photo:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
+        tag_ids = {photo.id: [tag.id for tag in photo.tags]}
+    else:
+        tag_ids = await get_photo_tag_ids(user.id, db)
+    matches = recommendation_index.recommend(list(tag_ids.values()), set(tag_ids), limit)
+    photos = {match.id: match for match in await get_photos_by_ids([match_id for match_id, _ in matches], db)}
+    return [
+        RecommendedPhotoResponse(**PhotoResponse2.model_validate(photos[match_id]).model_dump(), score=score)
+        for match_id, score in matches
+        if match_id in photos
+    ]
+
+
+@router.get("/{photo_id}", response_model=PhotoDetailResponse)
+@query_budget(1)
 async def get_photo_details(
     photo_id: int,
+    request: Request,
     db: AsyncSession = Depends(get_db)
 ):
     """
-    The get_photo_details function retrieves the details of a photo by its ID.
+    The get_photo_details function retrieves the details of a photo by its ID and counts the view.
+    The view counts are the stored ones; views of the last flush interval are not included yet.
 
     :param photo_id: int: The ID of the photo to retrieve
+    :param request: Request: The request, whose client address identifies the viewer
     :param db: AsyncSession: The database session to use for the operation
-    :return: The photo object with its details
+    :return: The photo object with its details and view counts
     :doc-author: Trelent
     """
     photo = await get_photo(photo_id, db)
     if not photo:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
-    return photo
+    trending.record(photo.id, "view")
+    view_counter.record(photo.id, request.client.host if request.client else "")
+    return PhotoDetailResponse(
+        **PhotoResponse2.model_validate(photo).model_dump(),
+        views=photo.stats.views if photo.stats else 0,
+        unique_views=photo.stats.unique_views if photo.stats else 0,
+    )
+
+
+@router.get("/{photo_id}/similar", response_model=list[SimilarPhotoResponse])
+@query_budget(2)
+async def get_similar_photos(
+    photo_id: int,
+    distance: int = Query(10, ge=0, le=MAX_DISTANCE),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    The get_similar_photos function finds the visually near-duplicate photos of a photo,
+    comparing their perceptual hashes through the in-memory similarity index.
+
+    :param photo_id: int: The ID of the photo to compare with
+    :param distance: int: The maximal number of differing bits between the hashes, at most MAX_DISTANCE
+    :param limit: int: The maximal number of photos to return
+    :param db: AsyncSession: The database session to use for the operation
+    :return: A list of photo objects with their distance, closest first
+    :doc-author: Trelent
+    """
+    photo = await get_photo(photo_id, db)
+    if not photo:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
+    if not photo.dhash:
+        return []
+    matches = [
+        (match_id, match_distance)
+        for match_id, match_distance in similarity_index.search(int(photo.dhash, 16), distance, limit + 1)
+        if match_id != photo_id
+    ][:limit]
+    photos = {match.id: match for match in await get_photos_by_ids([match_id for match_id, _ in matches], db)}
+    return [
+        SimilarPhotoResponse(**PhotoResponse2.model_validate(photos[match_id]).model_dump(), distance=match_distance)
+        for match_id, match_distance in matches
+        if match_id in photos
+    ]
+
+
+@router.api_route("/{photo_id}/download", methods=["GET", "HEAD"], response_class=StreamingResponse)
+@query_budget(1)
+async def download_photo(
+    photo_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    The download_photo function streams the original image of a photo through the application.
+        The file is read and sent chunk by chunk, so memory stays constant whatever its size.
+        A Range header with one range gets 206 Partial Content, several ranges get multipart/byteranges.
+
+    :param photo_id: int: The ID of the photo to download
+    :param request: Request: The request, for its method and Range header
+    :param db: AsyncSession: The database session to use for the operation
+    :return: The image, or the requested ranges of it
+    :doc-author: Trelent
+    """
+    photo = await get_photo(photo_id, db)
+    if not photo:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
+    source = await downloader.open(photo.url)
+    if source is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    extension = os.path.splitext(urlsplit(photo.url).path)[1]
+    return downloader.response(source, request.headers.get("range"), request.method, headers={
+        "content-disposition": f'attachment; filename="photo-{photo.id}{extension}"',
+    })
 
 
 @router.get("/", response_model=list[PhotoResponse2])
+@query_budget(2)
 async def list_all_photos(
+    filters: PhotoFilter = Depends(),
     user: User = Depends(auth_service.get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     The list_all_photos function retrieves all photos uploaded by the current user.
+    They can be filtered by dimensions, byte size, format and capture time, and sorted by any of them.
+    Photos whose metadata is unknown come last.
 
+    :param filters: PhotoFilter: The bounds on the image metadata and the sort order, from the query string
     :param user: User: The current user
     :param db: AsyncSession: The database session to use for the operation
     :return: A list of photo objects
     :doc-author: Trelent
     """
-    photos = await get_photos(user, db)
+    photos = await get_photos(user, db, filters)
     return photos
 
 
 @router.post("/{photo_id}/tags", response_model=PhotoResponse, status_code=status.HTTP_200_OK)
+@idempotent
 async def add_tags(photo_id: int,
                    tags: List[str],
                    user: User = Depends(auth_service.get_current_user),
@@ -150,6 +318,7 @@ async def add_tags(photo_id: int,
 
 
 @router.delete("/{photo_id}/tags", response_model=PhotoResponse, status_code=status.HTTP_200_OK)
+@idempotent
 async def remove_tags(photo_id: int,
                       tags: List[str],
                       user: User = Depends(auth_service.get_current_user),
@@ -185,6 +354,7 @@ async def transform_photo(
 ):
     """
     The transform_photo function applies transformations to an existing photo.
+    Each set of parameters is transformed once and stored as a variant of the photo.
 
     :param photo_id: int: The ID of the photo to transform
     :param transformation_params: TransformationParams: The transformation parameters
@@ -197,7 +367,9 @@ async def transform_photo(
     if not photo or photo.user_id != user.id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found or access denied")
 
-    transformed_url = transform_image(photo.url, transformation_params.model_dump(exclude_unset=True))
+    transformed_url = await variant_store.transform(
+        photo.url, transformation_params.model_dump(exclude_unset=True), db, photo_id=photo.id
+    )
     if transformed_url == photo.url:
         logger.error(f"Transformation did not change the URL: {transformed_url}")
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Transformation failed")
@@ -224,5 +396,5 @@ async def create_qr_code(
     if not photo or photo.user_id != user.id:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found or access denied")
     
-    qr_code_image = generate_qr_code(photo.url)
-    return StreamingResponse(qr_code_image, media_type="image/jpg")
+    qr_code_image = await render_qr_code(photo.url)
+    return StreamingResponse(io.BytesIO(qr_code_image), media_type="image/jpg")
@@ -1,14 +1,17 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, BackgroundTasks
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
+from src.conf.config import config
 from src.database.db import get_db
+from src.database.queries import query_budget
 from src.entity.models import Photo, User
 from src.services.auth import auth_service
-from src.services.cloudinary import transform_image
+from src.services.metrics import queued
+from src.services.variants import AVATAR_PRESETS, PHOTO_PRESETS, variant_store
 
 
 router = APIRouter(prefix='/posts', tags=['posts'])
@@ -19,16 +22,23 @@ class PostResponse(BaseModel):
     tags: List[str]
     ava: List[str]
     post: str
+    blurhash: Optional[str] = None
 
 
 @router.get("/", response_model=List[PostResponse])
+@query_budget(3)
 async def get_posts(
+    background_tasks: BackgroundTasks,
     user: User = Depends(auth_service.get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
     """
     The get_posts function retrieves all posts (photos) uploaded by the current user along with their details.
+    Images are read from the stored preset variants. Missing variants are transformed concurrently, each once;
+    those not ready by the feed deadline are returned as the original image and stored in the background,
+    or cancelled if the request fails first.
 
+    :param background_tasks: BackgroundTasks: Add the storage of the missing variants to the background tasks queue
     :param user: User: The current user whose posts are to be retrieved
     :param db: AsyncSession: The database session to use for the operation
     :return: A list of PostResponse objects containing the post details
@@ -42,13 +52,33 @@ async def get_posts(
     result = await db.execute(stmt)
     photos = result.scalars().unique().all()
 
-    posts = []
-    for photo in photos:
-        author = photo.user.username
-        tags = [tag.name for tag in photo.tags]
-        ava_35 = transform_image(user.avatar, {"width": 35, "height": 35, "crop": "fill"})
-        ava_200 = transform_image(user.avatar, {"width": 200, "height": 200, "crop": "fill"})
-        post_img = transform_image(photo.url, {"width": 300, "height": 300, "crop": "fill"})
-        posts.append(PostResponse(author=author, tags=tags, ava=[ava_35, ava_200], post=post_img))
+    variants, missing = {}, {}
+    if variant_store.enabled:
+        variants = await variant_store.lookup(
+            [user.avatar, *(photo.url for photo in photos)], (*AVATAR_PRESETS, *PHOTO_PRESETS), db
+        )
+        # every post shows the same avatar, and a stored image may back several photos: each variant is wanted once
+        wanted = {(user.avatar, preset): None for preset in AVATAR_PRESETS if user.avatar}
+        wanted.update({(photo.url, preset): photo.id for photo in photos for preset in PHOTO_PRESETS})
+        missing = {key: photo_id for key, photo_id in wanted.items() if key not in variants}
+    pending = variant_store.fan_out(missing, config.FEED_TRANSFORM_CONCURRENCY) if missing else None
+    try:
+        if pending is not None:
+            variants.update(await pending.wait(config.FEED_TRANSFORM_DEADLINE))
 
+        ava = [variants.get((user.avatar, preset)) or user.avatar for preset in AVATAR_PRESETS]
+        posts = []
+        for photo in photos:
+            author = photo.user.username
+            tags = [tag.name for tag in photo.tags]
+            post_img = variants.get((photo.url, "post")) or photo.url
+            posts.append(PostResponse(author=author, tags=tags, ava=ava, post=post_img, blurhash=photo.blurhash))
+    except BaseException:
+        # the background tasks of a failed request never run: nothing would wait for the transforms left
+        if pending is not None:
+            pending.cancel()
+        raise
+
+    if pending is not None:
+        background_tasks.add_task(queued(pending.save))
     return posts
@@ -0,0 +1,31 @@
+from fastapi import APIRouter, HTTPException, Request, status
+from starlette.concurrency import run_in_threadpool
+
+from src.services.storage import LocalStorage, RangeFileResponse, storage
+
+router = APIRouter(prefix="/storage", tags=["storage"])
+
+
+@router.api_route("/{key:path}", methods=["GET", "HEAD"])
+async def get_stored_file(key: str, request: Request):
+    """
+    The get_stored_file function serves an image kept by the local storage driver.
+        Keys are content hashes, so the files never change and can be cached forever.
+        A single byte range is honoured with 206 Partial Content.
+
+    :param key: str: The key of the image
+    :param request: Request: The request, for its method and Range header
+    :return: The file, or the requested range of it
+    :doc-author: Trelent
+    """
+    if not isinstance(storage, LocalStorage):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    try:
+        path = storage.path(key)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    stat = await run_in_threadpool(storage.stat, key)
+    if stat is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    return RangeFileResponse(path, stat, request.headers.get("range"), request.method,
+                             headers={"cache-control": "public, max-age=31536000, immutable"})
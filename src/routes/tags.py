@@ -0,0 +1,55 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+from src.entity.models import User
+from src.schemas.tag import TagScoreResponse
+from src.services.auth import auth_service
+from src.services.tag_graph import tag_graph
+
+
+router = APIRouter(prefix='/tags', tags=['tags'])
+
+
+@router.get("/suggest", response_model=List[TagScoreResponse])
+async def suggest_tags(
+    prefix: str = Query("", max_length=50),
+    context: List[str] = Query([]),
+    limit: int = Query(10, ge=1, le=50),
+    user: User = Depends(auth_service.get_current_user)
+):
+    """
+    The suggest_tags function completes a tag being typed. Tags often used together with the tags already
+    chosen come first, then the most used tags.
+
+    :param prefix: str: The beginning of the tag
+    :param context: List[str]: The tags already chosen for the photo
+    :param limit: int: The number of tags to return
+    :param user: User: The current user
+    :return: A list of tags with their score and number of photos
+    :doc-author: Trelent
+    """
+    return tag_graph.suggest(prefix, context, limit)
+
+
+@router.get("/{name}/related", response_model=List[TagScoreResponse])
+async def get_related_tags(
+    name: str,
+    limit: int = Query(10, ge=1, le=50),
+    metric: str = Query("jaccard", pattern="^(jaccard|pmi)$"),
+    user: User = Depends(auth_service.get_current_user)
+):
+    """
+    The get_related_tags function lists the tags most often used on the same photos as a tag.
+
+    :param name: str: The name of the tag
+    :param limit: int: The number of tags to return
+    :param metric: str: The score, "jaccard" or "pmi" (pointwise mutual information)
+    :param user: User: The current user
+    :return: A list of tags with their score and number of shared photos
+    :doc-author: Trelent
+    """
+    related = tag_graph.related(name, limit, metric)
+    if related is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Tag not found")
+    return related
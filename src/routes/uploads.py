@@ -0,0 +1,172 @@
+from email.utils import formatdate
+
+from fastapi import APIRouter, HTTPException, Depends, status, BackgroundTasks, Header, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+
+from src.database.db import get_db
+from src.entity.models import User
+from src.repository.photos import create_photo_from_file
+from src.schemas.photo import PhotoBase
+from src.services.auth import auth_service
+from src.services.idempotency import idempotent
+from src.services.metrics import queued
+from src.services.placeholders import placeholders
+from src.services.uploads import Upload, parse_metadata, upload_store
+from src.services.variants import PHOTO_PRESETS, variant_store
+
+
+router = APIRouter(prefix="/uploads", tags=["uploads"])
+
+TUS_VERSION = "1.0.0"
+
+
+def _headers(upload: Upload | None = None) -> dict[str, str]:
+    headers = {"tus-resumable": TUS_VERSION, "cache-control": "no-store"}
+    if upload is not None:
+        headers["upload-offset"] = str(upload.offset)
+        headers["upload-length"] = str(upload.length)
+        headers["upload-expires"] = formatdate(upload.expires, usegmt=True)
+    return headers
+
+
+@router.options("/")
+async def upload_options():
+    """
+    The upload_options function describes the supported version and extensions of the tus protocol.
+
+    :return: An empty response with the Tus-* headers
+    :doc-author: Trelent
+    """
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={
+        "tus-resumable": TUS_VERSION,
+        "tus-version": TUS_VERSION,
+        "tus-max-size": str(upload_store.max_size),
+        "tus-extension": "creation,expiration,termination",
+    })
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    request: Request,
+    upload_length: int = Header(..., ge=0),
+    upload_metadata: str | None = Header(None),
+    user: User = Depends(auth_service.get_current_user),
+):
+    """
+    The create_upload function starts a resumable upload of a photo.
+        The metadata may carry the filename, filetype, description and comma-separated tags of the photo.
+        The bytes are then sent with PATCH requests to the URL in the Location header.
+
+    :param request: Request: The request, for the URL of the upload
+    :param upload_length: int: The size of the file in bytes
+    :param upload_metadata: str | None: The base64-encoded metadata of the file
+    :param user: User: The current user uploading the photo
+    :return: An empty response with the Location of the upload
+    :doc-author: Trelent
+    """
+    metadata = parse_metadata(upload_metadata)
+    upload = await run_in_threadpool(upload_store.create, user.id, upload_length, metadata)
+    headers = _headers(upload)
+    headers["location"] = str(request.url_for("get_upload", upload_id=upload.id))
+    return Response(status_code=status.HTTP_201_CREATED, headers=headers)
+
+
+@router.head("/{upload_id}")
+async def get_upload(upload_id: str, user: User = Depends(auth_service.get_current_user)):
+    """
+    The get_upload function returns the offset of an upload, where the client resumes sending.
+
+    :param upload_id: str: The ID of the upload
+    :param user: User: The current user, who must own the upload
+    :return: An empty response with the Upload-Offset and Upload-Length headers
+    :doc-author: Trelent
+    """
+    upload = await run_in_threadpool(upload_store.get, upload_id, user.id)
+    return Response(status_code=status.HTTP_200_OK, headers=_headers(upload))
+
+
+@router.patch("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def append_upload(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., ge=0),
+    content_type: str = Header(...),
+    user: User = Depends(auth_service.get_current_user),
+):
+    """
+    The append_upload function appends the request body to an upload, starting at Upload-Offset.
+        The bytes are written as they arrive, so an interrupted request keeps what it delivered
+        and the client resumes from the offset returned by HEAD.
+
+    :param upload_id: str: The ID of the upload
+    :param request: Request: The request, whose body is streamed to the staging file
+    :param upload_offset: int: The offset of the body in the file, the current offset of the upload
+    :param content_type: str: Must be application/offset+octet-stream
+    :param user: User: The current user, who must own the upload
+    :return: An empty response with the new Upload-Offset
+    :doc-author: Trelent
+    """
+    if content_type.split(";")[0].strip().lower() != "application/offset+octet-stream":
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail="Content-Type must be application/offset+octet-stream")
+    upload = await run_in_threadpool(upload_store.get, upload_id, user.id)
+    try:
+        await upload_store.append(upload, upload_offset, request.stream())
+    except ClientDisconnect:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Upload interrupted")
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_headers(upload))
+
+
+@router.post("/{upload_id}/finalize", response_model=PhotoBase, status_code=status.HTTP_201_CREATED)
+@idempotent
+async def finalize_upload(
+    upload_id: str,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(auth_service.get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    The finalize_upload function creates the photo of a complete upload, as the photo upload does,
+        and deletes the upload. The upload is claimed first: a concurrent finalization of it gets 409.
+
+    :param upload_id: str: The ID of the upload
+    :param background_tasks: BackgroundTasks: Add the variant and placeholder generation to the background tasks queue
+    :param user: User: The current user, who must own the upload
+    :param db: AsyncSession: The database session to use for the operation
+    :return: The newly created photo object
+    :doc-author: Trelent
+    """
+    upload = await run_in_threadpool(upload_store.get, upload_id, user.id)
+    metadata = upload.metadata
+    tags = [tag.strip() for tag in metadata.get("tags", "").split(",") if tag.strip()]
+    file = await run_in_threadpool(upload_store.claim, upload)
+    try:
+        photo = await create_photo_from_file(file, metadata.get("filetype"), metadata.get("description"), tags,
+                                             user, db)
+    except BaseException:
+        await run_in_threadpool(upload_store.restore, upload)
+        raise
+    finally:
+        file.close()
+    await run_in_threadpool(upload_store.delete, upload.id)
+    if variant_store.enabled:
+        background_tasks.add_task(queued(variant_store.generate), photo.url, PHOTO_PRESETS, photo.id)
+    background_tasks.add_task(queued(placeholders.generate), photo.id, photo.url)
+    return photo
+
+
+@router.delete("/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_upload(upload_id: str, user: User = Depends(auth_service.get_current_user)):
+    """
+    The delete_upload function abandons an upload and deletes the bytes received.
+
+    :param upload_id: str: The ID of the upload
+    :param user: User: The current user, who must own the upload
+    :return: An empty response
+    :doc-author: Trelent
+    """
+    upload = await run_in_threadpool(upload_store.get, upload_id, user.id)
+    await run_in_threadpool(upload_store.delete, upload.id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers=_headers())
@@ -1,15 +1,18 @@
-import pickle
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, status, BackgroundTasks
 from fastapi_limiter.depends import RateLimiter
 from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
 from src.database.db import get_db
 from src.entity.models import User,Role
 from src.schemas.user import UserResponse, UserProfileResponse,UserUpdateSchema
 from src.services.auth import auth_service
-from src.services.cloudinary import upload_image
+from src.services.metrics import queued
 from src.repository import users as repositories_users
 from src.services.roles import RoleAccess
+from src.services.sessions import session_store
+from src.services.storage import upload
+from src.services.variants import AVATAR_PRESETS, variant_store
 
 
 router = APIRouter(prefix="/users", tags=["users"])
@@ -37,24 +40,26 @@ async def get_current_user(user: User = Depends(auth_service.get_current_user)):
 
 
 @router.patch("/avatar", response_model=UserResponse, dependencies=[Depends(RateLimiter(times=1, seconds=60))],)
-async def update_avatar(file: UploadFile = File(), user: User = Depends(auth_service.get_current_user),
-                        db: AsyncSession = Depends(get_db)):
+async def update_avatar(background_tasks: BackgroundTasks, file: UploadFile = File(),
+                        user: User = Depends(auth_service.get_current_user), db: AsyncSession = Depends(get_db)):
     """
     The update_avatar function is used to update the avatar of a user.
         The function takes in an UploadFile object, which contains the file that will be uploaded to Cloudinary.
         It also takes in a User object, which is obtained from auth_service's get_current_user function. This ensures that only authenticated users can access this endpoint and change their own avatar image.
         Finally, it takes in an AsyncSession object for database access.
+        The avatar presets of the new image are generated in the background.
     
+    :param background_tasks: BackgroundTasks: Add the variant generation to the background tasks queue
     :param file: UploadFile: Get the file from the request
     :param user: User: Get the current user
     :param db: AsyncSession: Get the database session
     :return: A user object
     :doc-author: Trelent
     """
-    res_url = upload_image(file.file)
+    res_url = await run_in_threadpool(upload, file.file, file.content_type, "avatars")
     user = await repositories_users.update_avatar_url(user.email, res_url, db)
-    auth_service.cache.set(user.email, pickle.dumps(user))
-    auth_service.cache.expire(user.email, 300)
+    if variant_store.enabled:
+        background_tasks.add_task(queued(variant_store.generate), res_url, AVATAR_PRESETS)
     return user
 
 
@@ -111,4 +116,5 @@ async def ban_user(user_id: int, user: User = Depends(auth_service.get_current_u
     user_in_db = await repositories_users.ban_user(user_id, db)
     if user_in_db is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    await session_store.revoke_user(user_id, db)
     return user_in_db
\ No newline at end of file
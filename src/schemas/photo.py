@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional, List
+from typing import Literal, Optional, List
 from pydantic import BaseModel, ConfigDict, Field, conint
 
 
@@ -29,6 +29,7 @@ class PhotoResponse(BaseModel):
     description: Optional[str] = None
     tags: List[TagBase] = Field(default_factory=list)
     user_id: int
+    blurhash: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -37,10 +38,47 @@ class PhotoResponse2(PhotoBase):
     id: int
     created_at: datetime
     updated_at: datetime
+    width: Optional[int] = None
+    height: Optional[int] = None
+    format: Optional[str] = None
+    size: Optional[int] = None
+    taken_at: Optional[datetime] = None
+    blurhash: Optional[str] = None
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class PhotoDetailResponse(PhotoResponse2):
+    views: int = 0
+    unique_views: int = 0
+
+
+class SimilarPhotoResponse(PhotoResponse2):
+    distance: int
+
+
+class RecommendedPhotoResponse(PhotoResponse2):
+    score: float
+
+
+class TrendingPhotoResponse(PhotoResponse2):
+    score: float
+
+
+class PhotoFilter(BaseModel):
+    min_width: Optional[conint(ge=1)] = None
+    max_width: Optional[conint(ge=1)] = None
+    min_height: Optional[conint(ge=1)] = None
+    max_height: Optional[conint(ge=1)] = None
+    min_size: Optional[conint(ge=0)] = None
+    max_size: Optional[conint(ge=0)] = None
+    format: Optional[str] = None
+    taken_after: Optional[datetime] = None
+    taken_before: Optional[datetime] = None
+    sort: Literal["created_at", "width", "height", "size", "taken_at"] = "created_at"
+    order: Literal["asc", "desc"] = "desc"
+
+
 class TransformationParams(BaseModel):
     width: Optional[conint(ge=1)] = None
     height: Optional[conint(ge=1)] = None
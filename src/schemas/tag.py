@@ -0,0 +1,7 @@
+from pydantic import BaseModel
+
+
+class TagScoreResponse(BaseModel):
+    name: str
+    score: float
+    count: int
@@ -34,6 +34,8 @@ class UserProfileResponse(UserResponse):
     updated_at: datetime
     confirmed: bool
     photo_count: int
+    views: int = 0
+    unique_views: int = 0
 
 
 class UserUpdateSchema(BaseModel):
@@ -2,14 +2,17 @@ import pickle
 from datetime import datetime, timedelta, UTC
 from typing import Optional
 
-import redis
 from fastapi import Depends, HTTPException, status
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 
-from src.database.db import get_db
+from src.database.db import sessionmanager
+from src.database.cache import redis_client
+from src.services.invalidation import LocalCache, invalidation_bus
+from src.services.metrics import CACHE_REQUESTS
+from src.services.singleflight import SingleFlight
+from src.services.tracing import traced
 from src.repository import users as repository_users
 from src.conf.config import config
 
@@ -18,13 +21,12 @@ class Auth:
     pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
     SECRET_KEY = config.SECRET_KEY_JWT
     ALGORITHM = config.ALGORITHM
-    cache = redis.Redis(
-        host=config.REDIS_DOMAIN,
-        port=config.REDIS_PORT,
-        db=0,
-        password=config.REDIS_PASSWORD,
-    )
+    cache = redis_client
+    user_cache = LocalCache(ttl=300)
+    user_flight = SingleFlight("user", redis_client, config.SINGLEFLIGHT_LOCK_TTL)
+    session_factory = sessionmanager.session
 
+    @traced("bcrypt")
     def verify_password(self, plain_password, hashed_password):
         """
         The verify_password function takes a plain-text password and the hashed version of that password,
@@ -40,6 +42,7 @@ class Auth:
         return self.pwd_context.verify(plain_password, hashed_password)
 
 
+    @traced("bcrypt")
     def get_password_hash(self, password: str):
         """
         The get_password_hash function takes a plain-text password and returns the hashed version of that password.
@@ -102,33 +105,49 @@ class Auth:
     async def decode_refresh_token(self, refresh_token: str):
         """
         The decode_refresh_token function takes a refresh token and decodes it.
-            If the scope is 'refresh_token', then we return the email address of the user.
+            If the scope is 'refresh_token', then we return its payload: the email address of the user ('sub'),
+            the session id ('sid') and the token id ('jti').
             Otherwise, we raise an HTTPException with status code 401 (UNAUTHORIZED) and detail message 'Invalid scope for token'.
         
         
         :param self: Represent the instance of the class
         :param refresh_token: str: Pass the refresh token to the function
-        :return: The email of the user if the refresh token is valid
+        :return: The payload of the refresh token if it is valid
         :doc-author: Trelent
         """
         try:
             payload = jwt.decode(refresh_token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
-            if payload["scope"] == "refresh_token":
-                email = payload["sub"]
-                return email
+            if payload["scope"] == "refresh_token" and "sid" in payload and "jti" in payload:
+                return payload
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid scope for token")
         except JWTError:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
 
 
-    async def get_current_user(self, token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    def get_subject(self, token: str) -> str | None:
+        """
+        The get_subject function returns the email address of a valid access token without loading the user,
+            e.g. to scope data stored per user before the request is routed.
+
+        :param self: Represent the instance of the class
+        :param token: str: The access token
+        :return: The email address, or None if the token is not a valid access token
+        :doc-author: Trelent
+        """
+        try:
+            payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+        except JWTError:
+            return None
+        return payload.get("sub") if payload.get("scope") == "access_token" else None
+
+
+    async def get_current_user(self, token: str = Depends(oauth2_scheme)):
         """
         The get_current_user function is a dependency that will be used in the UserController class.
         It takes an OAuth2 token as input and returns the user object associated with it.
         
         :param self: Refer to the class itself
         :param token: str: Get the token from the authorization header
-        :param db: AsyncSession: Get the database connection, and the token: str parameter is used to pass in the access_token
         :return: The user object
         :doc-author: Trelent
         """
@@ -149,17 +168,69 @@ class Auth:
         except JWTError:
             raise credentials_exception
 
-        user_hash = str(email)
-        user = self.cache.get(user_hash)
-
+        user = self.user_cache.get(email)
         if user is None:
-            user = await repository_users.get_user_by_email(email, db)
+            version = invalidation_bus.version("user", email)
+            user = self.cached_user(email, version)
+            if user is None:
+                # only real misses take the lock of the flight
+                user = await self.user_flight.do(f"{email}:v{version}", self.load_user, email, version)
             if user is None:
                 raise credentials_exception
+            # a ban or role change committed while loading bumped the version and evicted the user already:
+            # caching the user read before it would keep it for the TTL
+            if invalidation_bus.version("user", email) == version:
+                self.user_cache.set(email, user)
+        else:
+            CACHE_REQUESTS.labels("user", "hit").inc()
+        if user.is_active is False:
+            raise credentials_exception
+        return user
+
+
+    def cached_user(self, email: str, version: int):
+        """
+        The cached_user function reads a version of a user from the Redis cache.
+
+        :param self: Represent the instance of the class
+        :param email: str: The email address of the user
+        :param version: int: The version of the user, from invalidation_bus
+        :return: The user object, or None on a miss
+        :doc-author: Trelent
+        """
+        user = self.cache.get(invalidation_bus.versioned_key("user", email, version))
+        if user is None:
+            return None
+        CACHE_REQUESTS.labels("user", "hit").inc()
+        return pickle.loads(user)
+
+    async def load_user(self, email: str, version: int):
+        """
+        The load_user function reads a user from the database and caches it in Redis under its version.
+            Concurrent misses of a user share one call through user_flight, across processes too,
+            so it reads the database with a session of its own rather than the session of one of the callers.
+            The caller that waited for the lock of another process finds the user cached by then.
+
+        :param self: Represent the instance of the class
+        :param email: str: The email address of the user
+        :param version: int: The version of the user read before the call, from invalidation_bus
+        :return: The user object, detached from any session, or None if there is no such user
+        :doc-author: Trelent
+        """
+        user = self.cached_user(email, version)
+        if user is not None:
+            return user
+        user_hash = invalidation_bus.versioned_key("user", email, version)
+        CACHE_REQUESTS.labels("user", "miss").inc()
+        async with self.session_factory() as db:
+            user = await repository_users.get_user_by_email(email, db)
+            if user is not None:
+                # the user outlives the session in user_cache and is shared by the callers: detach it,
+                # so that no later request refreshes it through the closed session
+                db.expunge(user)
+        if user is not None:
             self.cache.set(user_hash, pickle.dumps(user))
             self.cache.expire(user_hash, 300)
-        else:
-            user = pickle.loads(user)
         return user
 
 
@@ -202,3 +273,4 @@ class Auth:
 
 
 auth_service = Auth()
+invalidation_bus.subscribe("user", lambda email, payload: auth_service.user_cache.evict(email))
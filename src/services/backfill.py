@@ -0,0 +1,100 @@
+"""
+Resumable backfills of computed photo columns.
+
+Photos missing a value are processed in batches keyset-paginated by ID; the photos of a batch are processed
+concurrently and their values written in one bulk update. The last photo ID is checkpointed to a file after every
+batch, so an interrupted run resumes where it stopped. Photos that cannot be processed are skipped and counted.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Awaitable, Callable
+
+from sqlalchemy import ColumnElement, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.entity.models import Photo
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Backfill:
+    """
+    Fills columns of the existing photos, batch by batch, resuming from a checkpoint file.
+    """
+
+    def __init__(self, pending: ColumnElement[bool], process: Callable[[int, str], Awaitable[dict | None]],
+                 checkpoint: str, batch: int = 500, workers: int = 16):
+        """
+        :param pending: ColumnElement[bool]: Selects the photos still to process, e.g. ``Photo.width.is_(None)``
+        :param process: Callable: Computes the column values of a photo from its ID and URL, None if it cannot
+        :param checkpoint: str: The file storing the last photo processed
+        :param batch: int: The number of photos per batch, committed together
+        :param workers: int: The number of photos processed concurrently
+        """
+        self.pending = pending
+        self.process = process
+        self.checkpoint = checkpoint
+        self.batch = batch
+        self.workers = workers
+
+    def _resume(self) -> int:
+        try:
+            with open(self.checkpoint) as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def _save(self, last_id: int) -> None:
+        with open(f"{self.checkpoint}.tmp", "w") as f:
+            f.write(str(last_id))
+        os.replace(f"{self.checkpoint}.tmp", self.checkpoint)
+
+    async def _process(self, photos: list[tuple[int, str]]) -> list[dict]:
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def one(photo_id: int, url: str) -> dict | None:
+            async with semaphore:
+                try:
+                    values = await self.process(photo_id, url)
+                except Exception as err:
+                    logger.warning("Cannot process photo %d: %s", photo_id, err)
+                    return None
+            return {"id": photo_id, **values} if values else None
+
+        return [row for row in await asyncio.gather(*(one(*photo) for photo in photos)) if row]
+
+    async def run(self, db: AsyncSession, restart: bool = False) -> tuple[int, int]:
+        """
+        The run function processes the pending photos that come after the checkpoint.
+
+        :param db: AsyncSession: The database session
+        :param restart: bool: Ignore the checkpoint and start from the first photo
+        :return: The number of photos processed and the number of photos that could not be processed
+        """
+        last_id = 0 if restart else self._resume()
+        total = (await db.execute(select(func.count()).where(self.pending, Photo.id > last_id))).scalar_one()
+        logger.info("Backfilling %d photos after photo %d", total, last_id)
+        done = failed = 0
+        start = time.monotonic()
+        while True:
+            photos = (await db.execute(
+                select(Photo.id, Photo.url).where(self.pending, Photo.id > last_id).order_by(Photo.id).limit(self.batch)
+            )).all()
+            if not photos:
+                break
+            rows = await self._process(photos)
+            if rows:
+                await db.execute(update(Photo), rows)
+                await db.commit()
+            last_id = photos[-1][0]
+            self._save(last_id)
+            done += len(photos)
+            failed += len(photos) - len(rows)
+            rate = done / max(time.monotonic() - start, 1e-9)
+            logger.info("%d/%d photos (%.1f%%), %d failed, %.0f photos/s, %.0f s left", done, total,
+                        100 * done / max(total, 1), failed, rate, max(total - done, 0) / rate)
+        return done, failed
@@ -0,0 +1,171 @@
+import asyncio
+import logging
+from typing import BinaryIO
+
+from sqlalchemy import delete, event, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from src.entity.models import Blob, PhotoVariant
+from src.services.metrics import BLOBS_DELETED_BYTES, UPLOAD_BYTES, UPLOADS
+from src.services.storage import hash_file, object_key, storage
+
+
+logger = logging.getLogger(__name__)
+
+
+class BlobStore:
+    """
+    Content-addressed uploads: identical bytes are uploaded once and shared by every photo made from them.
+    Each blob counts the photos referencing it and its asset is deleted with the last one.
+
+    Storing new bytes and purging an asset lock the content hash until their transaction ends, so a purge
+    never deletes an asset uploaded again before its new blob row is committed.
+    """
+
+    def __init__(self):
+        # the process locks of the hashes, with the number of their holders and waiters
+        self._locks: dict[str, tuple[asyncio.Lock, list[int]]] = {}
+
+    async def store(self, file: BinaryIO, db: AsyncSession, content_type: str | None = None) -> Blob:
+        """
+        The store function returns the blob of the file content, uploading it only if these bytes are new.
+        The reference taken on the blob is committed with the photo that uses it.
+
+        :param file: BinaryIO: The uploaded file
+        :param db: AsyncSession: The database session
+        :param content_type: str: The MIME type of the file, which gives the extension of its key
+        :return: The blob, with its URL
+        """
+        sha256, size = await run_in_threadpool(hash_file, file)
+        locked = False
+        while True:
+            blob = await self._acquire(sha256, db)
+            if blob is not None:
+                UPLOADS.labels("deduplicated").inc()
+                UPLOAD_BYTES.labels("deduplicated").inc(size)
+                return blob
+            if not locked:
+                # a concurrent upload of the same bytes may commit its blob while we wait: look it up again
+                await self._lock(sha256, db)
+                locked = True
+                continue
+
+            file.seek(0)
+            url = await run_in_threadpool(storage.put, file, object_key(sha256, content_type), content_type)
+            blob = Blob(sha256=sha256, size=size, url=url, refcount=1)
+            try:
+                # a savepoint: a failed insert must not roll back the transaction of the caller
+                async with db.begin_nested():
+                    db.add(blob)
+            except IntegrityError:
+                # the same bytes were stored concurrently under the same key: share that blob, or store them
+                # again if its last reference went meanwhile
+                continue
+            UPLOADS.labels("stored").inc()
+            UPLOAD_BYTES.labels("stored").inc(size)
+            return blob
+
+    async def _lock(self, sha256: str, db: AsyncSession) -> None:
+        """
+        The _lock function locks a content hash until the transaction of the session ends:
+        a transaction-level advisory lock on PostgreSQL, a lock of this process on the other databases.
+
+        :param sha256: str: The content hash
+        :param db: AsyncSession: The database session
+        :return: None
+        """
+        if db.bind.dialect.name == "postgresql":
+            await db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": int(sha256[:15], 16)})
+            return
+        lock, users = self._locks.setdefault(sha256, (asyncio.Lock(), [0]))
+        users[0] += 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._forget(sha256, users)
+            raise
+        transaction = db.sync_session.get_transaction() or db.sync_session.begin()
+        db.sync_session.info.setdefault("blob_locks", []).append((transaction, sha256))
+
+    def _forget(self, sha256: str, users: list[int]) -> None:
+        users[0] -= 1
+        if not users[0]:
+            del self._locks[sha256]
+
+    def _unlock(self, session: Session, transaction) -> None:
+        # after_transaction_end of every session: releases the process locks taken in the transaction
+        held = session.info.get("blob_locks")
+        if not held:
+            return
+        for entry in [entry for entry in held if entry[0] is transaction]:
+            held.remove(entry)
+            lock, users = self._locks[entry[1]]
+            lock.release()
+            self._forget(entry[1], users)
+
+    async def _acquire(self, sha256: str, db: AsyncSession) -> Blob | None:
+        result = await db.execute(
+            update(Blob).where(Blob.sha256 == sha256).values(refcount=Blob.refcount + 1).returning(Blob.id)
+        )
+        blob_id = result.scalar_one_or_none()
+        if blob_id is None:
+            return None
+        return await db.get(Blob, blob_id, populate_existing=True)
+
+    async def release(self, blob_id: int, db: AsyncSession) -> Blob | None:
+        """
+        The release function drops the reference of a photo being deleted, in the transaction deleting it.
+        With the last reference, the blob and the variants of its image are deleted as well, so the deletion
+        of the photo must be flushed before.
+
+        :param blob_id: int: The blob of the photo
+        :param db: AsyncSession: The database session
+        :return: The blob if that was its last reference, to pass to purge once the deletion is committed
+        """
+        result = await db.execute(
+            update(Blob).where(Blob.id == blob_id).values(refcount=Blob.refcount - 1).returning(Blob.refcount)
+        )
+        refcount = result.scalar_one_or_none()
+        if refcount is None or refcount > 0:
+            return None
+        blob = await db.get(Blob, blob_id)
+        await db.execute(delete(PhotoVariant).where(PhotoVariant.source_url == blob.url))
+        await db.delete(blob)
+        return blob
+
+    async def purge(self, blob: Blob, db: AsyncSession) -> None:
+        """
+        The purge function deletes the stored asset of a blob that lost its last reference.
+        Keys are content hashes, so the asset is kept if the same bytes were uploaded again meanwhile:
+        the check and the deletion hold the lock of the hash, which an upload of these bytes keeps until
+        its blob is committed. A failed deletion is logged and leaves the asset in the storage.
+
+        :param blob: Blob: The blob returned by release, once its deletion is committed
+        :param db: AsyncSession: The database session, committed on return
+        :return: None
+        """
+        sha256, size, url = blob.sha256, blob.size, blob.url
+        await self._lock(sha256, db)
+        try:
+            if (await db.execute(select(Blob.id).filter_by(sha256=sha256))).first() is not None:
+                return
+            key = storage.key(url)
+            if key is None:
+                logger.error(f"Cannot delete {url}: not stored by the {storage.name} storage")
+                return
+            try:
+                await run_in_threadpool(storage.delete, key)
+            except Exception as err:
+                # the blob row is gone already: the asset stays orphaned rather than failing the deletion
+                logger.error(f"Error deleting {url}: {err}")
+                return
+            BLOBS_DELETED_BYTES.inc(size)
+        finally:
+            await db.commit()
+
+
+blob_store = BlobStore()
+event.listen(Session, "after_transaction_end", blob_store._unlock)
@@ -1,6 +1,13 @@
+import re
+
 import cloudinary
+import cloudinary.api
+import cloudinary.exceptions
 import cloudinary.uploader
+import cloudinary.utils
 from src.conf.config import config
+from src.services.metrics import timed
+from src.services.tracing import traced
 import logging
 
 logging.basicConfig(level=logging.ERROR)
@@ -12,25 +19,76 @@ cloudinary.config(
     api_secret=config.CLOUDINARY_API_SECRET
 )
 
+# /upload/, the transformation segments (e.g. c_fill,w_35), the version, then the public ID and the extension
+_public_id_pattern = re.compile(r"/upload/(?:[^/]*_[^/]*/)*(?:v\d+/)?(?P<public_id>.+?)(?:\.\w+)?$")
+
+
+def get_public_id(image_url: str):
+    """
+    The get_public_id function extracts the public ID of an image, including its folders, from its URL.
+
+    :param image_url: str: The URL of the image
+    :return: The public ID, or None if the URL is not a Cloudinary upload
+    """
+    match = _public_id_pattern.search(image_url)
+    return match["public_id"] if match else None
+
+
+def build_image_url(public_id: str):
+    """
+    The build_image_url function builds the secure URL of an uploaded image.
+
+    :param public_id: str: The public ID of the image
+    :return: The URL of the image
+    """
+    return cloudinary.utils.cloudinary_url(public_id, secure=True)[0]
+
 
-def upload_image(file):
+@traced("cloudinary")
+@timed("upload")
+def upload_image(file, public_id: str = None, timeout: float = None):
     """
     The upload_image function uploads an image file to Cloudinary and returns the secure URL of the uploaded image.
     
     :param file: The file object of the image to be uploaded
+    :param public_id: str: The public ID to store the image under, a random one if None
+    :param timeout: float: The timeout of the request in seconds, the SDK default if None
     :return: The secure URL of the uploaded image
     :doc-author: Trelent
     """
-    result = cloudinary.uploader.upload(file)
+    if public_id is None:
+        result = cloudinary.uploader.upload(file, timeout=timeout)
+    else:
+        result = cloudinary.uploader.upload(file, public_id=public_id, overwrite=False, timeout=timeout)
     return result['secure_url']
 
 
-def transform_image(image_url: str, transformation_params: dict):
+@traced("cloudinary")
+@timed("resource")
+def resource_info(public_id: str, timeout: float = None):
+    """
+    The resource_info function reads the size, format and version of an uploaded image.
+
+    :param public_id: str: The public ID of the image
+    :param timeout: float: The timeout of the request in seconds, the SDK default if None
+    :return: The resource details, or None if there is no such image
+    """
+    try:
+        return cloudinary.api.resource(public_id, timeout=timeout)
+    except cloudinary.exceptions.NotFound:
+        return None
+
+
+@traced("cloudinary")
+@timed("transform")
+def transform_image(image_url: str, transformation_params: dict, timeout: float = None):
     """
     The transform_image function applies transformations to an existing image on Cloudinary and returns the URL of the transformed image.
+    Errors are raised, to be retried or reported by the caller.
     
     :param image_url: str: The URL of the image to be transformed
     :param transformation_params: dict: The dictionary of transformation parameters to apply
+    :param timeout: float: The timeout of the request in seconds, the SDK default if None
     :return: The URL of the transformed image
     :doc-author: Trelent
     """
@@ -49,12 +107,23 @@ def transform_image(image_url: str, transformation_params: dict):
 
     logger.debug(f"Final transformation options: {params}")
 
-    try:
-        public_id = image_url.split('/')[-1].split('.')[0]
-        response = cloudinary.uploader.explicit(public_id, type="upload", eager=[params])
-        transformed_url = response['eager'][0]['secure_url']
-        logger.debug(f"Transformed image URL: {transformed_url}")
-        return transformed_url
-    except Exception as e:
-        logger.error(f"Error during image transformation: {e}")
-        return image_url
+    public_id = get_public_id(image_url) or image_url.split('/')[-1].split('.')[0]
+    response = cloudinary.uploader.explicit(public_id, type="upload", eager=[params], timeout=timeout)
+    transformed_url = response['eager'][0]['secure_url']
+    logger.debug(f"Transformed image URL: {transformed_url}")
+    return transformed_url
+
+
+@traced("cloudinary")
+@timed("destroy")
+def delete_image(image_url: str, timeout: float = None):
+    """
+    The delete_image function deletes an uploaded image from Cloudinary. Errors are raised, to be retried
+    or reported by the caller.
+
+    :param image_url: str: The URL of the image to delete
+    :param timeout: float: The timeout of the request in seconds, the SDK default if None
+    :return: None
+    """
+    public_id = get_public_id(image_url) or image_url.split('/')[-1].split('.')[0]
+    cloudinary.uploader.destroy(public_id, timeout=timeout)
@@ -0,0 +1,251 @@
+"""
+Streaming downloads of the original photos through the application.
+
+The original is read chunk by chunk, from the file of the local storage or from the storage service through a
+shared pool of keep-alive connections, and every chunk is sent before the next one is read, so a download holds
+one chunk in memory whatever the size of the file. Range requests get one range as ``206 Partial Content`` and
+several as ``multipart/byteranges``; overlapping ranges are coalesced, and too many ranges get the whole file.
+"""
+import asyncio
+import logging
+import secrets
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, NamedTuple
+
+import anyio
+import httpx
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, StreamingResponse
+
+from src.conf.config import config
+from src.services.metrics import DOWNLOAD_BYTES, DOWNLOADS
+from src.services.storage import LocalStorage, RangeFileResponse, Storage, parse_range, storage
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Source(NamedTuple):
+    url: str
+    key: str | None
+    path: str | None
+    size: int
+    content_type: str
+    etag: str
+    modified: float
+
+
+def coalesce(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """
+    The coalesce function merges the overlapping and adjacent byte ranges.
+
+    >>> coalesce([(500, 999), (0, 99), (50, 199), (200, 299)])
+    [(0, 299), (500, 999)]
+
+    :param ranges: list[tuple[int, int]]: The (first, last) byte positions, inclusive
+    :return: The merged ranges, in order
+    """
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+class Downloader:
+    """
+    Streams stored images to clients, with a connection pool to the storage service for each event loop.
+    """
+
+    def __init__(self, store: Storage = storage, max_connections: int = 100, chunk_size: int = 64 * 1024,
+                 max_ranges: int = 16, timeout: float = 30.0):
+        self.storage = store
+        self.max_connections = max_connections
+        self.chunk_size = chunk_size
+        self.max_ranges = max_ranges
+        self.timeout = timeout
+        self._http: httpx.AsyncClient | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def _client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._http = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.timeout),
+                follow_redirects=True,
+            )
+            self._loop = loop
+        return self._http
+
+    async def close(self) -> None:
+        """
+        The close function closes the pooled connections of the running event loop.
+
+        :return: None
+        """
+        if self._http is not None and self._loop is asyncio.get_running_loop():
+            await self._http.aclose()
+        self._http = self._loop = None
+
+    def _request(self, source: Source, method: str, headers: dict[str, str]) -> tuple[str, dict[str, str]]:
+        if source.key is not None:
+            return self.storage.request_for(method, source.key, headers)
+        return source.url, headers
+
+    async def open(self, url: str) -> Source | None:
+        """
+        The open function finds where an image is stored and reads its size, type and version.
+        URLs of another storage, e.g. uploaded before the driver changed, are read as public URLs.
+
+        :param url: str: The URL of the image
+        :return: The source of the image, or None if it does not exist
+        """
+        key = self.storage.key(url)
+        if key is not None and isinstance(self.storage, LocalStorage):
+            stat = await run_in_threadpool(self.storage.stat, key)
+            if stat is None:
+                return None
+            return Source(url, key, self.storage.path(key), stat.size, stat.content_type, stat.etag, stat.modified)
+        source = Source(url, key, None, 0, "", "", 0.0)
+        url, headers = self._request(source, "HEAD", {})
+        response = await self._client().head(url, headers=headers)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        modified = response.headers.get("last-modified")
+        return source._replace(
+            size=int(response.headers.get("content-length", 0)),
+            content_type=response.headers.get("content-type", "application/octet-stream"),
+            etag=response.headers.get("etag", ""),
+            modified=parsedate_to_datetime(modified).timestamp() if modified else datetime.now(timezone.utc).timestamp(),
+        )
+
+    async def read(self, source: Source, first: int, last: int) -> AsyncIterator[bytes]:
+        """
+        The read function reads a byte range of an image in chunks.
+
+        :param source: Source: The image, from open
+        :param first: int: The first byte to read
+        :param last: int: The last byte to read, inclusive
+        :return: An async iterator of chunks
+        """
+        remaining = last - first + 1
+        if source.path is not None:
+            async with await anyio.open_file(source.path, "rb") as f:
+                await f.seek(first)
+                while remaining > 0:
+                    chunk = await f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            return
+        url, headers = self._request(source, "GET", {"range": f"bytes={first}-{last}"})
+        async with self._client().stream("GET", url, headers=headers) as response:
+            response.raise_for_status()
+            # a server ignoring the Range header sends the whole content
+            skip = first if response.status_code == 200 else 0
+            async for chunk in response.aiter_bytes(self.chunk_size):
+                if skip:
+                    chunk, skip = chunk[skip:], max(skip - len(chunk), 0)
+                chunk = chunk[:remaining]
+                remaining -= len(chunk)
+                if chunk:
+                    yield chunk
+                if remaining <= 0:
+                    break
+
+    async def _metered(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        async for chunk in chunks:
+            DOWNLOAD_BYTES.inc(len(chunk))
+            yield chunk
+
+    async def _multipart(self, source: Source, ranges: list[tuple[int, int]], boundary: str) -> AsyncIterator[bytes]:
+        for i, (first, last) in enumerate(ranges):
+            yield self._part_header(source, first, last, boundary, i == 0)
+            async for chunk in self.read(source, first, last):
+                yield chunk
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    @staticmethod
+    def _part_header(source: Source, first: int, last: int, boundary: str, leading: bool) -> bytes:
+        separator = "" if leading else "\r\n"
+        return (f"{separator}--{boundary}\r\nContent-Type: {source.content_type}\r\n"
+                f"Content-Range: bytes {first}-{last}/{source.size}\r\n\r\n").encode()
+
+    def response(self, source: Source, range_header: str | None = None, method: str = "GET",
+                 headers: dict[str, str] | None = None) -> Response:
+        """
+        The response function builds the streaming response for a request of an image.
+
+        :param source: Source: The image, from open
+        :param range_header: str: The Range header of the request
+        :param method: str: The method of the request, no body is sent for HEAD
+        :param headers: dict: Extra response headers, e.g. Content-Disposition
+        :return: A 200, 206 or 416 response
+        """
+        ranges = parse_range(range_header, source.size)
+        if ranges:
+            ranges = coalesce(ranges)
+            if len(ranges) > self.max_ranges:
+                ranges = None
+        kind = "full" if ranges is None else "range" if len(ranges) <= 1 else "multipart"
+        DOWNLOADS.labels(kind).inc()
+        if source.path is not None and kind != "multipart":
+            # the file response parses the range again, give it the coalesced one
+            if ranges:
+                range_header = f"bytes={ranges[0][0]}-{ranges[0][1]}"
+            elif ranges is None:
+                range_header = None
+            response = RangeFileResponse(source.path, source, range_header, method, headers)
+            DOWNLOAD_BYTES.inc(int(response.headers["content-length"]) if method != "HEAD" else 0)
+            return response
+
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": source.etag,
+            "last-modified": formatdate(source.modified, usegmt=True),
+            **(headers or {}),
+        }
+        if ranges == []:
+            headers["content-range"] = f"bytes */{source.size}"
+            return Response(status_code=416, headers=headers)
+        if ranges is None or len(ranges) == 1:
+            first, last = ranges[0] if ranges else (0, source.size - 1)
+            if ranges:
+                headers["content-range"] = f"bytes {first}-{last}/{source.size}"
+            headers["content-length"] = str(last - first + 1)
+            body = self.read(source, first, last) if source.size else _empty()
+            status_code = 206 if ranges else 200
+            media_type = source.content_type
+        else:
+            boundary = secrets.token_hex(16)
+            length = sum(len(self._part_header(source, first, last, boundary, i == 0)) + last - first + 1
+                         for i, (first, last) in enumerate(ranges))
+            headers["content-length"] = str(length + len(f"\r\n--{boundary}--\r\n"))
+            body = self._multipart(source, ranges, boundary)
+            status_code = 206
+            media_type = f"multipart/byteranges; boundary={boundary}"
+        if method == "HEAD":
+            return Response(status_code=status_code, headers=headers, media_type=media_type)
+        return StreamingResponse(self._metered(body), status_code=status_code, headers=headers,
+                                 media_type=media_type)
+
+
+async def _empty() -> AsyncIterator[bytes]:
+    return
+    yield
+
+
+downloader = Downloader(
+    max_connections=config.DOWNLOAD_MAX_CONNECTIONS,
+    chunk_size=config.DOWNLOAD_CHUNK_SIZE,
+    max_ranges=config.DOWNLOAD_MAX_RANGES,
+    timeout=config.DOWNLOAD_TIMEOUT,
+)
@@ -0,0 +1,358 @@
+"""
+Idempotency keys for the endpoints that create or change data.
+
+A client retrying a request after a timeout sends the same ``Idempotency-Key`` header as the first attempt. The
+first request with a key executes and its response (status, headers and body) is stored in Redis for
+``IDEMPOTENCY_TTL`` seconds; later requests with the key get the stored response byte for byte, with an
+``Idempotent-Replayed: true`` header, instead of executing again. Keys are scoped to the user of the access token.
+
+While the first request runs, the key holds a marker for at most ``IDEMPOTENCY_LOCK_TTL`` seconds, so concurrent
+duplicates wait for its response rather than executing alongside it; duplicates in the same process are woken when
+it finishes, other processes poll. A duplicate gives up after ``IDEMPOTENCY_WAIT`` seconds with 409 and a
+Retry-After header, instead of holding its connection as long as the marker. The body of a waiting request is only
+read once the response is known, so if the first request fails with a 5xx (not stored) a waiting duplicate executes
+instead. A key reused for a different request (method, path, query or body) gets 422.
+
+Endpoints opt in with the ``idempotent`` decorator, below the route decorator. Requests without the header, without a
+valid access token, or while Redis is unavailable execute as usual.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import secrets
+import time
+from typing import NamedTuple
+
+from redis.exceptions import RedisError
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.services.auth import auth_service
+from src.services.metrics import IDEMPOTENT_REQUESTS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+HEADER = b"idempotency-key"
+REPLAYED_HEADER = (b"idempotent-replayed", b"true")
+UNSAFE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+_key_pattern = re.compile(r"^[\x21-\x7e]{1,255}$")
+
+# Replaces the marker of a running request with its response, or deletes it when the response is not stored,
+# unless the marker expired and another request claimed the key meanwhile.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return 1
+"""
+
+
+def idempotent(func):
+    """
+    The idempotent function makes an endpoint honour the Idempotency-Key header.
+    Put it below the route decorator:
+
+        @router.post("/")
+        @idempotent
+        async def create_comment(...):
+
+    :param func: The endpoint function
+    :return: The endpoint function
+    """
+    func.__idempotent__ = True
+    return func
+
+
+def route_endpoint(scope):
+    """
+    The route_endpoint function finds the endpoint function of the route serving a request.
+
+    :param scope: The ASGI scope of the request
+    :return: The endpoint or None
+    """
+    router = getattr(scope.get("app"), "router", None)
+    for route in getattr(router, "routes", ()):
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return child_scope.get("endpoint")
+    return None
+
+
+class StoredResponse(NamedTuple):
+    fingerprint: str
+    status: int
+    headers: list[tuple[bytes, bytes]]
+    body: bytes
+
+    def dumps(self) -> bytes:
+        header = {
+            "fingerprint": self.fingerprint,
+            "status": self.status,
+            "headers": [[name.decode("latin-1"), value.decode("latin-1")] for name, value in self.headers],
+        }
+        return json.dumps(header).encode() + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, data: bytes) -> "StoredResponse":
+        header, _, body = data.partition(b"\n")
+        header = json.loads(header)
+        headers = [(name.encode("latin-1"), value.encode("latin-1")) for name, value in header["headers"]]
+        return cls(header["fingerprint"], header["status"], headers, body)
+
+
+class IdempotencyStore:
+    """
+    Markers of the running requests and responses of the finished ones, one Redis key per idempotency key.
+    """
+    prefix = "idempotency"
+
+    def __init__(self, cache=redis_client, ttl: int = 24 * 3600, lock_ttl: int = 300, poll_interval: float = 0.05,
+                 max_body: int = 2 ** 20, max_wait: float = 30.0):
+        self.cache = cache
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.max_body = max_body
+        self._release = cache.register_script(RELEASE_SCRIPT)
+        self._running: dict[str, asyncio.Event] = {}
+
+    def key(self, subject: str, idempotency_key: str) -> str:
+        return f"{self.prefix}:{subject}:{idempotency_key}"
+
+    @staticmethod
+    def _marker(owner: str) -> bytes:
+        return b"running:" + owner.encode()
+
+    def claim(self, key: str, owner: str) -> bool:
+        """
+        The claim function marks a key as running, if no request holds it.
+
+        :param key: str: The key, from key
+        :param owner: str: A random token of the request
+        :return: True if the request claimed the key and must execute
+        """
+        claimed = bool(self.cache.set(key, self._marker(owner), nx=True, ex=self.lock_ttl))
+        if claimed:
+            self._running[key] = asyncio.Event()
+        return claimed
+
+    def load(self, key: str) -> StoredResponse | bool | None:
+        """
+        The load function reads the state of a key.
+
+        :param key: str: The key, from key
+        :return: The stored response, True while a request holds the key, or None if the key is free
+        """
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        if data.startswith(b"running:"):
+            return True
+        return StoredResponse.loads(data)
+
+    def release(self, key: str, owner: str, response: StoredResponse | None) -> None:
+        """
+        The release function stores the response of a request that claimed a key, or frees the key if None,
+        and wakes up the duplicates waiting in this process.
+
+        :param key: str: The key, from key
+        :param owner: str: The token the key was claimed with
+        :param response: StoredResponse | None: The response to replay
+        :return: None
+        """
+        try:
+            data = response.dumps() if response is not None else b""
+            self._release(keys=[key], args=[self._marker(owner), data, self.ttl])
+        finally:
+            event = self._running.pop(key, None)
+            if event is not None:
+                event.set()
+
+    async def wait(self, key: str, timeout: float) -> None:
+        """
+        The wait function waits for the request holding a key: until it finishes if it runs in this process,
+        otherwise for one poll interval, and at most for the timeout.
+
+        :param key: str: The key, from key
+        :param timeout: float: The longest wait in seconds
+        :return: None
+        """
+        event = self._running.get(key)
+        if event is None:
+            await asyncio.sleep(min(self.poll_interval, timeout))
+            return
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+idempotency_store = IdempotencyStore(ttl=config.IDEMPOTENCY_TTL, lock_ttl=config.IDEMPOTENCY_LOCK_TTL,
+                                     max_body=config.IDEMPOTENCY_MAX_BODY, max_wait=config.IDEMPOTENCY_WAIT)
+
+
+class Fingerprint:
+    """
+    A hash of a request: its method, path, query string and body. The boundary of a multipart body is left out,
+    since clients pick a new one when they retry.
+    """
+
+    def __init__(self, scope):
+        self.digest = hashlib.sha256(f'{scope["method"]} {scope["path"]}?{scope["query_string"].decode()}\n'.encode())
+        content_type = dict(scope["headers"]).get(b"content-type", b"")
+        boundary = re.search(rb"boundary=\"?([^\";]+)", content_type) if content_type.startswith(b"multipart/") else None
+        self.boundary = boundary.group(1) if boundary else b""
+        self._tail = b""
+
+    def update(self, data: bytes) -> None:
+        if not self.boundary:
+            self.digest.update(data)
+            return
+        # a boundary may be split between two chunks, the end of a chunk waits for the next one
+        data = (self._tail + data).replace(self.boundary, b"")
+        keep = min(len(self.boundary) - 1, len(data))
+        self._tail = data[len(data) - keep:]
+        self.digest.update(data[:len(data) - keep])
+
+    def hexdigest(self) -> str:
+        self.digest.update(self._tail)
+        self._tail = b""
+        return self.digest.hexdigest()
+
+
+def _has_body(scope) -> bool:
+    headers = dict(scope["headers"])
+    return b"transfer-encoding" in headers or headers.get(b"content-length", b"0") not in (b"", b"0")
+
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware executing the requests with an Idempotency-Key header at most once per key
+    on the endpoints marked with the idempotent decorator.
+    """
+
+    def __init__(self, app, store: IdempotencyStore = idempotency_store):
+        self.app = app
+        self.store = store
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in UNSAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        idempotency_key = headers.get(HEADER, b"").decode("latin-1")
+        if not idempotency_key or not getattr(route_endpoint(scope), "__idempotent__", False):
+            await self.app(scope, receive, send)
+            return
+        if not _key_pattern.match(idempotency_key):
+            response = JSONResponse({"detail": "Invalid Idempotency-Key"}, status_code=400)
+            await response(scope, receive, send)
+            return
+        scheme, _, token = headers.get(b"authorization", b"").decode("latin-1").partition(" ")
+        subject = auth_service.get_subject(token) if scheme.lower() == "bearer" else None
+        if subject is None:
+            # the route rejects the request
+            await self.app(scope, receive, send)
+            return
+        await self.handle(self.store.key(subject, idempotency_key), scope, receive, send)
+
+    async def handle(self, key: str, scope, receive, send) -> None:
+        owner = secrets.token_hex(8)
+        waited = False
+        give_up = time.monotonic() + self.store.max_wait
+        while True:
+            try:
+                claimed = self.store.claim(key, owner)
+                state = None if claimed else self.store.load(key)
+            except RedisError as err:
+                logger.warning("Redis unavailable, executing the request without its idempotency key: %s", err)
+                IDEMPOTENT_REQUESTS.labels("bypassed").inc()
+                await self.app(scope, receive, send)
+                return
+            if claimed:
+                IDEMPOTENT_REQUESTS.labels("coalesced" if waited else "executed").inc()
+                await self.execute(key, owner, scope, receive, send)
+                return
+            if isinstance(state, StoredResponse):
+                await self.replay(state, scope, receive, send)
+                return
+            if state:
+                remaining = give_up - time.monotonic()
+                if remaining <= 0:
+                    IDEMPOTENT_REQUESTS.labels("conflict").inc()
+                    conflict = JSONResponse({"detail": "A request with this Idempotency-Key is in progress"},
+                                            status_code=409, headers={"Retry-After": "1"})
+                    await conflict(scope, receive, send)
+                    return
+                waited = True
+                await self.store.wait(key, remaining)
+
+    async def execute(self, key: str, owner: str, scope, receive, send) -> None:
+        digest = Fingerprint(scope)
+        complete = not _has_body(scope)
+        start, body, size = None, [], 0
+
+        async def hashing_receive():
+            nonlocal complete
+            message = await receive()
+            if message["type"] == "http.request":
+                digest.update(message.get("body", b""))
+                complete = complete or not message.get("more_body", False)
+            return message
+
+        async def capturing_send(message):
+            nonlocal start, size
+            if message["type"] == "http.response.start":
+                start = message
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+                if size <= self.store.max_body:
+                    body.append(message.get("body", b""))
+            await send(message)
+
+        response = None
+        try:
+            await self.app(scope, hashing_receive, capturing_send)
+        finally:
+            # server errors and rate limits are not stored, the retry executes again
+            if start is not None and complete and size <= self.store.max_body \
+                    and start["status"] < 500 and start["status"] != 429:
+                response = StoredResponse(digest.hexdigest(), start["status"],
+                                          [tuple(header) for header in start.get("headers", [])], b"".join(body))
+            try:
+                self.store.release(key, owner, response)
+            except RedisError as err:
+                logger.warning("Redis unavailable, response of idempotency key not stored: %s", err)
+
+    async def replay(self, response: StoredResponse, scope, receive, send) -> None:
+        digest = Fingerprint(scope)
+        more_body = _has_body(scope)
+        while more_body:
+            message = await receive()
+            if message["type"] != "http.request":
+                return
+            digest.update(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        if digest.hexdigest() != response.fingerprint:
+            IDEMPOTENT_REQUESTS.labels("mismatch").inc()
+            mismatch = JSONResponse({"detail": "Idempotency-Key reused with a different request"}, status_code=422)
+            await mismatch(scope, receive, send)
+            return
+        IDEMPOTENT_REQUESTS.labels("replayed").inc()
+        await send({"type": "http.response.start", "status": response.status,
+                    "headers": response.headers + [REPLAYED_HEADER]})
+        await send({"type": "http.response.body", "body": response.body})
@@ -0,0 +1,250 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Callable
+
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from src.database.cache import redis_client
+from src.entity.models import User
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class LocalCache:
+    """
+    A small in-process cache with a TTL and a size bound, evicted by the invalidation bus.
+    """
+
+    def __init__(self, ttl: float = 300, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: dict[str, tuple[float, Any]] = {}
+
+    def get(self, key: str):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return None
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self._data.pop(key, None)
+        if len(self._data) >= self.maxsize:
+            self._data.pop(next(iter(self._data)), None)
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def evict(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+class InvalidationBus:
+    """
+    Cross-worker cache invalidation over Redis pub/sub.
+
+    Every entity key has a version counter in Redis; shared cache keys embed the version, so a write makes the old
+    entries unreachable at once. Each worker subscribes to the channel and runs the handlers registered for the
+    entity, e.g. to evict its in-process caches. Writes of tracked models are published automatically when the
+    database session commits.
+    """
+    channel = "invalidation"
+
+    def __init__(self, cache=redis_client):
+        self.cache = cache
+        self.origin = uuid.uuid4().hex
+        self._handlers: dict[str, list[Callable[[str, dict], None]]] = defaultdict(list)
+        self._tracked: dict[type, tuple[str, Callable[[Any], str]]] = {}
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._pubsub = None
+        self._thread = None
+        self.received = 0
+        self.lag_last = 0.0
+        self.lag_max = 0.0
+        self.lag_total = 0.0
+
+    def subscribe(self, entity: str, handler: Callable[[str, dict], None]) -> None:
+        """
+        The subscribe function registers a handler called with the key and the payload of every event of the entity,
+        both for local writes and for writes made by other workers.
+
+        :param entity: str: The entity name, e.g. "user"
+        :param handler: Callable: The function to call
+        :return: None
+        """
+        self._handlers[entity].append(handler)
+
+    def track(self, model: type, entity: str, key: Callable[[Any], str]) -> None:
+        """
+        The track function makes every committed insert, update or delete of the model publish an event.
+
+        :param model: type: The mapped class to watch
+        :param entity: str: The entity name to publish the events under
+        :param key: Callable: Returns the entity key of an instance
+        :return: None
+        """
+        self._tracked[model] = (entity, key)
+
+    def _version_key(self, entity: str, key: str) -> str:
+        return f"version:{entity}:{key}"
+
+    def version(self, entity: str, key: str) -> int:
+        """
+        The version function returns the current version of an entity key (0 if it was never written).
+
+        :param entity: str: The entity name
+        :param key: str: The entity key
+        :return: The version counter
+        """
+        try:
+            version = self.cache.get(self._version_key(entity, key))
+        except RedisError as err:
+            logger.warning("Redis unavailable while reading version of %s:%s: %s", entity, key, err)
+            return 0
+        return int(version) if version else 0
+
+    def versioned_key(self, entity: str, key: str, version: int | None = None) -> str:
+        """
+        The versioned_key function builds the shared cache key of a version of an entity.
+
+        :param entity: str: The entity name
+        :param key: str: The entity key
+        :param version: int: The version, the current one if None
+        :return: The cache key
+        """
+        return f"{entity}:{key}:v{self.version(entity, key) if version is None else version}"
+
+    def publish(self, entity: str, key: str, **payload) -> None:
+        """
+        The publish function bumps the version of an entity key and notifies every worker.
+        Local handlers run immediately, so a worker never serves its own stale entries.
+
+        :param entity: str: The entity name
+        :param key: str: The entity key
+        :param payload: Extra data passed to the handlers
+        :return: None
+        """
+        self._broadcast(entity, key, payload, versioned=True)
+
+    def notify(self, entity: str, key: str, **payload) -> None:
+        """
+        The notify function runs the handlers of an event on every worker without bumping a version,
+        for in-process state kept in sync by the events themselves, e.g. search indexes.
+
+        :param entity: str: The entity name
+        :param key: str: The entity key
+        :param payload: Extra data passed to the handlers
+        :return: None
+        """
+        self._broadcast(entity, key, payload, versioned=False)
+
+    def _broadcast(self, entity: str, key: str, payload: dict, versioned: bool) -> None:
+        self._dispatch(entity, key, payload)
+        message = {"entity": entity, "key": key, "origin": self.origin, "ts": time.time(), "payload": payload}
+        try:
+            pipe = self.cache.pipeline()
+            if versioned:
+                pipe.incr(self._version_key(entity, key))
+            pipe.publish(self.channel, json.dumps(message, default=str))
+            pipe.execute()
+        except RedisError as err:
+            logger.warning("Redis unavailable, invalidation of %s:%s stays local: %s", entity, key, err)
+
+    def _dispatch(self, entity: str, key: str, payload: dict) -> None:
+        for handler in self._handlers.get(entity, ()):
+            try:
+                handler(key, payload)
+            except Exception as err:
+                logger.error("Invalidation handler for %s failed: %s", entity, err)
+
+    def _on_message(self, message) -> None:
+        try:
+            data = json.loads(message["data"])
+        except (TypeError, ValueError):
+            return
+        if data.get("origin") == self.origin:
+            return
+        lag = max(time.time() - data.get("ts", time.time()), 0.0)
+        self.received += 1
+        self.lag_last = lag
+        self.lag_max = max(self.lag_max, lag)
+        self.lag_total += lag
+        args = (data["entity"], data["key"], data.get("payload") or {})
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._dispatch, *args)
+        else:
+            self._dispatch(*args)
+
+    def start(self, loop: asyncio.AbstractEventLoop | None = None) -> None:
+        """
+        The start function subscribes the worker to the invalidation channel in a background thread.
+        Handlers of remote events run on the given event loop.
+
+        :param loop: asyncio.AbstractEventLoop: The event loop of the worker
+        :return: None
+        """
+        self._loop = loop
+        try:
+            self._pubsub = self.cache.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{self.channel: self._on_message})
+            self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except RedisError as err:
+            logger.warning("Redis unavailable, cross-worker invalidation disabled: %s", err)
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._thread.stop()
+            # the thread may be reading from the connection closed below
+            self._thread.join(timeout=2)
+            self._thread = None
+        if self._pubsub is not None:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def stats(self) -> dict:
+        """
+        The stats function reports how many remote events this worker received and how long they took to arrive.
+
+        :return: A dictionary with the event count and the last, mean and max propagation latency in seconds
+        """
+        return {
+            "received": self.received,
+            "lag_last": self.lag_last,
+            "lag_mean": self.lag_total / self.received if self.received else 0.0,
+            "lag_max": self.lag_max,
+        }
+
+    def _collect(self, session: Session, flush_context) -> None:
+        pending = session.info.setdefault("invalidations", set())
+        for obj in (*session.new, *session.dirty, *session.deleted):
+            tracked = self._tracked.get(type(obj))
+            if tracked is not None:
+                entity, key = tracked
+                pending.add((entity, key(obj)))
+
+    def _flush(self, session: Session) -> None:
+        for entity, key in session.info.pop("invalidations", ()):
+            self.publish(entity, key)
+
+    def _discard(self, session: Session, *args) -> None:
+        session.info.pop("invalidations", None)
+
+
+invalidation_bus = InvalidationBus()
+invalidation_bus.track(User, "user", key=lambda user: user.email)
+
+event.listen(Session, "after_flush", invalidation_bus._collect)
+event.listen(Session, "after_commit", invalidation_bus._flush)
+event.listen(Session, "after_rollback", invalidation_bus._discard)
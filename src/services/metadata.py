@@ -0,0 +1,86 @@
+"""
+Image metadata of the photos: dimensions, format, byte size and EXIF capture time.
+
+Pillow opens images lazily: ``Image.open`` parses the header and the metadata segments but decodes no pixels, so
+reading the metadata of an upload costs a few kilobytes of parsing whatever the size of the image. The backfill of
+the photos uploaded before the columns existed reads only the beginning of each image from the storage.
+"""
+import io
+import logging
+import os
+from datetime import datetime
+from typing import BinaryIO, NamedTuple
+
+from PIL import ExifTags, Image
+from starlette.concurrency import run_in_threadpool
+
+from src.services.downloads import Downloader
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+HEAD_SIZE = 64 * 1024
+
+
+class ImageMetadata(NamedTuple):
+    width: int
+    height: int
+    format: str
+    size: int
+    taken_at: datetime | None
+
+
+def _taken_at(image: Image.Image) -> datetime | None:
+    # the EXIF of PNG images may follow the pixels, reading it would decode them
+    if "exif" not in image.info and image.format != "TIFF":
+        return None
+    exif = image.getexif()
+    value = exif.get_ifd(ExifTags.IFD.Exif).get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime)
+    try:
+        return datetime.strptime(str(value).strip("\x00 "), "%Y:%m:%d %H:%M:%S") if value else None
+    except ValueError:
+        return None
+
+
+def read_metadata(file: BinaryIO, size: int | None = None) -> ImageMetadata | None:
+    """
+    The read_metadata function reads the metadata of an image without decoding it.
+    The file is rewound afterwards.
+
+    :param file: BinaryIO: The image file, or its beginning
+    :param size: int: The byte size of the whole image, the size of the file if None
+    :return: The metadata, or None if the file is not an image
+    """
+    try:
+        if size is None:
+            size = file.seek(0, os.SEEK_END)
+            file.seek(0)
+        with Image.open(file) as image:
+            return ImageMetadata(image.width, image.height, image.format, size, _taken_at(image))
+    except (OSError, SyntaxError, ValueError) as err:
+        logger.warning("Cannot read image metadata: %s", err)
+        return None
+    finally:
+        file.seek(0)
+
+
+async def fetch_metadata(url: str, downloader: Downloader) -> ImageMetadata | None:
+    """
+    The fetch_metadata function reads the metadata of a stored image from its first bytes,
+    and from the whole image if the metadata does not fit in them.
+
+    :param url: str: The URL of the image
+    :param downloader: Downloader: Reads the image from the storage
+    :return: The metadata, or None if the image is missing or unreadable
+    """
+    source = await downloader.open(url)
+    if source is None:
+        return None
+    for length in (min(HEAD_SIZE, source.size), source.size):
+        data = b"".join([chunk async for chunk in downloader.read(source, 0, length - 1)]) if length else b""
+        metadata = await run_in_threadpool(read_metadata, io.BytesIO(data), source.size)
+        if metadata is not None or length == source.size:
+            return metadata
+    return None
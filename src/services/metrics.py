@@ -0,0 +1,514 @@
+import bisect
+import functools
+import glob
+import http.server
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Callable, Iterable
+
+from starlette.routing import Match
+
+from src.conf.config import config
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """
+    The set of metrics of the process, rendered in the Prometheus text exposition format.
+
+    With ``METRICS_MULTIPROC_DIR`` set, every worker process periodically dumps a snapshot of its metrics into
+    that directory and a scrape merges the snapshots of all workers: counters and histograms are summed over
+    every process that ever ran, gauges only over the live ones. A snapshot is named by the PID and the start
+    time of its process, so a worker reusing the PID of a dead one does not overwrite its counters.
+    """
+
+    def __init__(self, multiproc_dir: str | None = None):
+        self.metrics: dict[str, "Metric"] = {}
+        self.multiproc_dir = multiproc_dir
+        self._flusher = None
+        self._stopped = threading.Event()
+        self._process: tuple[int, int] | None = None
+
+    def register(self, metric: "Metric") -> None:
+        self.metrics[metric.name] = metric
+
+    def snapshot(self) -> dict:
+        """
+        The snapshot function collects the current values of every metric of this process.
+
+        :return: A dictionary mapping metric names to their type, help and samples keyed by label values
+        """
+        snapshot = {}
+        for name, metric in self.metrics.items():
+            snapshot[name] = {
+                "type": metric.type,
+                "help": metric.documentation,
+                "labelnames": list(metric.labelnames),
+                "samples": [[list(key), value] for key, value in metric.collect()],
+            }
+            if metric.type == "histogram":
+                snapshot[name]["buckets"] = list(metric.buckets)
+        return snapshot
+
+    def _snapshot_path(self) -> str:
+        pid = os.getpid()
+        if self._process is None or self._process[0] != pid:
+            # a forked worker inherits the registry of its parent: it gets a start time of its own
+            self._process = (pid, time.time_ns())
+        return os.path.join(self.multiproc_dir, f"{pid}-{self._process[1]}.json")
+
+    def flush(self) -> None:
+        """
+        The flush function writes the snapshot of this process into the multiprocess directory.
+
+        :return: None
+        """
+        if not self.multiproc_dir:
+            return
+        os.makedirs(self.multiproc_dir, exist_ok=True)
+        path = self._snapshot_path()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start(self, interval: float) -> None:
+        """
+        The start function flushes snapshots every interval seconds in a background thread.
+
+        :param interval: float: The flush interval in seconds
+        :return: None
+        """
+        if not self.multiproc_dir or self._flusher is not None:
+            return
+
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    self.flush()
+                except OSError as err:
+                    logger.error("Error writing metrics snapshot: %s", err)
+
+        self._flusher = threading.Thread(target=run, name="metrics-flusher", daemon=True)
+        self._flusher.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        try:
+            self.flush()
+        except OSError as err:
+            logger.error("Error writing metrics snapshot: %s", err)
+
+    def _merged(self) -> dict:
+        if not self.multiproc_dir:
+            return self.snapshot()
+        self.flush()
+        merged: dict = {}
+        for path in glob.glob(os.path.join(self.multiproc_dir, "*.json")):
+            pid = int(os.path.basename(path).split(".")[0].split("-")[0])
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            alive = _pid_alive(pid)
+            for name, data in snapshot.items():
+                if data["type"] == "gauge" and not alive:
+                    continue
+                target = merged.setdefault(name, {**data, "samples": {}})
+                if target["type"] != data["type"] or target.get("buckets") != data.get("buckets"):
+                    # a worker of another release of the metric: its samples cannot be added up
+                    logger.warning("Skipping metric %s of snapshot %s: type or buckets differ", name, path)
+                    continue
+                for key, value in data["samples"]:
+                    key = tuple(key)
+                    current = target["samples"].get(key)
+                    if current is None:
+                        target["samples"][key] = value
+                    elif data["type"] == "histogram":
+                        target["samples"][key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target["samples"][key] = current + value
+        for data in merged.values():
+            data["samples"] = list(data["samples"].items())
+        return merged
+
+    def exposition(self) -> str:
+        """
+        The exposition function renders the metrics of all workers in the Prometheus text format.
+
+        :return: The text to serve from /metrics
+        """
+        lines = []
+        for name, data in sorted(self._merged().items()):
+            lines.append(f"# HELP {name} {data['help']}")
+            lines.append(f"# TYPE {name} {data['type']}")
+            labelnames = data["labelnames"]
+            buckets = data.get("buckets", ())
+            for key, value in sorted(data["samples"], key=lambda sample: tuple(sample[0])):
+                labels = list(zip(labelnames, key))
+                if data["type"] != "histogram":
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip((*buckets, math.inf), value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', _number(bound))])} {_number(cumulative)}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {_number(value[-1])}")
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _labels(labels: list[tuple[str, str]]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+registry = Registry(config.METRICS_MULTIPROC_DIR)
+
+
+class Metric:
+    """
+    Base class of the metrics.
+
+    Samples are recorded into a per-thread shard, so recording never takes a lock and threads never race;
+    shards are summed when the metric is collected.
+    """
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), registry: Registry = registry):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        self._shards_lock = threading.Lock()
+        self._children: dict[tuple, "Child"] = {}
+        registry.register(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def labels(self, *values) -> "Child":
+        """
+        The labels function returns the child of the metric for the given label values.
+
+        :param values: The label values, in the order of the label names
+        :return: A child with the recording methods of the metric
+        """
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children[key] = Child(self, key)
+        return child
+
+    def collect(self) -> list[tuple[tuple, float]]:
+        totals: dict[tuple, float] = {}
+        for shard in list(self._shards):
+            for key, value in list(shard.items()):
+                totals[key] = totals.get(key, 0) + value
+        return list(totals.items())
+
+
+class Child:
+    __slots__ = ("metric", "key")
+
+    def __init__(self, metric: Metric, key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1) -> None:
+        shard = self.metric._shard()
+        shard[self.key] = shard.get(self.key, 0) + amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+    def observe(self, value: float) -> None:
+        self.metric._observe(self.key, value)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """
+    A gauge changed with inc/dec, or computed by a callback at collection time.
+    """
+    type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions: dict[tuple, Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1) -> None:
+        self.labels().dec(amount)
+
+    def set_function(self, function: Callable[[], float], *values) -> None:
+        """
+        The set_function function makes the gauge report the result of a callback for the given label values.
+
+        :param function: Callable: Returns the current value
+        :param values: The label values
+        :return: None
+        """
+        self._functions[tuple(str(value) for value in values)] = function
+
+    def collect(self) -> list[tuple[tuple, float]]:
+        samples = dict(super().collect())
+        for key, function in self._functions.items():
+            try:
+                samples[key] = function()
+            except Exception as err:
+                logger.error("Error collecting gauge %s: %s", self.name, err)
+        return list(samples.items())
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, *args, buckets: Iterable[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _observe(self, key: tuple, value: float) -> None:
+        shard = self._shard()
+        counts = shard.get(key)
+        if counts is None:
+            # one slot per bucket, one for +Inf, then sum and count
+            counts = shard[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def collect(self) -> list[tuple[tuple, list]]:
+        totals: dict[tuple, list] = {}
+        for shard in list(self._shards):
+            for key, counts in list(shard.items()):
+                current = totals.get(key)
+                totals[key] = list(counts) if current is None else [a + b for a, b in zip(current, counts)]
+        return list(totals.items())
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ["method", "route", "status"])
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route.", ["method", "route"])
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served by route.", ["method", "route"])
+DB_POOL = Gauge("db_pool_connections", "Database connection pool usage.", ["state"])
+CACHE_REQUESTS = Counter("cache_requests_total", "Cache lookups by cache and result.", ["cache", "result"])
+CLOUDINARY_LATENCY = Histogram("cloudinary_request_duration_seconds", "Cloudinary call latency.", ["operation"])
+CLOUDINARY_ERRORS = Counter("cloudinary_errors_total", "Failed Cloudinary calls.", ["operation"])
+STORAGE_LATENCY = Histogram("storage_request_duration_seconds", "Storage driver call latency.", ["operation"])
+STORAGE_ERRORS = Counter("storage_errors_total", "Failed storage driver calls.", ["operation"])
+BACKGROUND_TASKS = Gauge("background_tasks_queued", "Background tasks scheduled and not finished yet.")
+UPLOADS = Counter("uploads_total", "Uploaded images by result (stored or deduplicated).", ["result"])
+UPLOAD_BYTES = Counter("upload_bytes_total", "Uploaded image bytes by result (stored or deduplicated).", ["result"])
+BLOBS_DELETED_BYTES = Counter("blobs_deleted_bytes_total", "Bytes of stored images deleted with their last photo.")
+DOWNLOADS = Counter("photo_downloads_total", "Original photo downloads by kind (full, range, multipart).", ["kind"])
+DOWNLOAD_BYTES = Counter("photo_download_bytes_total", "Bytes of original photos streamed to clients.")
+IDEMPOTENT_REQUESTS = Counter("idempotent_requests_total",
+                              "Requests with an idempotency key by outcome (executed, coalesced, replayed, mismatch, "
+                              "conflict, bypassed).", ["outcome"])
+SINGLEFLIGHT_CALLS = Counter("singleflight_calls_total",
+                             "Single-flight calls by operation and result (executed, coalesced with a running call, "
+                             "waited for the lock of another process).", ["operation", "result"])
+CIRCUIT_STATE = Gauge("circuit_breaker_state", "Circuit breaker state by service (0 closed, 1 half-open, 2 open).",
+                      ["service"])
+CIRCUIT_REJECTED = Counter("circuit_breaker_rejected_total", "Calls failed fast by an open circuit breaker.",
+                           ["service"])
+REMOTE_RETRIES = Counter("remote_retries_total", "Retried calls to remote services by service and operation.",
+                         ["service", "operation"])
+
+
+def instrument_pool(pool) -> None:
+    """
+    The instrument_pool function exports the usage of a SQLAlchemy connection pool.
+
+    :param pool: Pool: The pool of the engine
+    :return: None
+    """
+    if hasattr(pool, "checkedout"):
+        DB_POOL.set_function(pool.checkedout, "checked_out")
+    if hasattr(pool, "size"):
+        DB_POOL.set_function(pool.size, "size")
+    if hasattr(pool, "overflow"):
+        DB_POOL.set_function(lambda: max(pool.overflow(), 0), "overflow")
+
+
+def timed(operation: str, histogram: Histogram = CLOUDINARY_LATENCY, errors: Counter = CLOUDINARY_ERRORS):
+    """
+    The timed function is a decorator observing the latency of every call and counting the calls that raised.
+
+    :param operation: str: The value of the operation label
+    :param histogram: Histogram: The latency histogram
+    :param errors: Counter: The error counter
+    :return: The decorator
+    """
+    def decorator(func):
+        latency = histogram.labels(operation)
+        failures = errors.labels(operation)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                failures.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+        return wrapper
+
+    return decorator
+
+
+def queued(func):
+    """
+    The queued function counts a background task as queued until it finishes.
+    Wrap the task when scheduling it: ``background_tasks.add_task(queued(send_email), ...)``.
+
+    :param func: The task function
+    :return: The wrapped task
+    """
+    BACKGROUND_TASKS.inc()
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                BACKGROUND_TASKS.dec()
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            BACKGROUND_TASKS.dec()
+    return wrapper
+
+
+def route_template(scope) -> str:
+    """
+    The route_template function finds the path template of the route serving a request,
+    so that e.g. every photo id is counted under ``/api/photos/{photo_id}``.
+
+    :param scope: The ASGI scope of the request
+    :return: The route path or "<unmatched>"
+    """
+    app = scope.get("app")
+    router = getattr(app, "router", None)
+    for route in getattr(router, "routes", ()):
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "<unmatched>")
+    return "<unmatched>"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording request counts, latency and in-flight requests per route.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        route = route_template(scope)
+        in_flight = HTTP_IN_FLIGHT.labels(method, route)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            HTTP_LATENCY.labels(method, route).observe(time.perf_counter() - start)
+            HTTP_REQUESTS.labels(method, route, status).inc()
+            in_flight.dec()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> None:
+    """
+    The start_metrics_server function serves the metrics on a separate port from a background thread.
+    With several workers only the first one binds the port; it serves the merged metrics of all of them.
+
+    :param port: int: The port to listen on
+    :return: None
+    """
+    try:
+        server = http.server.ThreadingHTTPServer(("0.0.0.0", port), _MetricsHandler)
+    except OSError as err:
+        logger.info("Metrics port %d is already served: %s", port, err)
+        return
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
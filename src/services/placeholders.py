@@ -0,0 +1,167 @@
+"""
+BlurHash placeholders of the photos, rendered by clients while the images load.
+
+A BlurHash is a few DCT components of the image packed into about 30 characters. The encoder works on a
+thumbnail of at most 32x32 pixels, which JPEG images decode at a fraction of their size (draft mode), and computes
+all the components at once with NumPy: one matrix product per axis instead of a loop over pixels and components.
+Placeholders are computed after the upload in a pool of worker threads, since decoding and NumPy release the GIL,
+and stored on the photo.
+"""
+import asyncio
+import io
+import logging
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import update
+
+from src.conf.config import config
+from src.database.db import sessionmanager
+from src.entity.models import Photo
+from src.services.downloads import Downloader, downloader
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+BASE83 = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~"
+THUMBNAIL_SIZE = 32
+
+
+def _base83(value: int, length: int) -> str:
+    return "".join(BASE83[value // 83 ** (length - i) % 83] for i in range(1, length + 1))
+
+
+def srgb_to_linear(values: np.ndarray) -> np.ndarray:
+    values = values / 255
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(values: np.ndarray) -> np.ndarray:
+    values = np.clip(values, 0, 1)
+    srgb = np.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+    return np.floor(srgb * 255 + 0.5).astype(np.int64)
+
+
+def blurhash(pixels: np.ndarray, x_components: int = 4, y_components: int = 3) -> str:
+    """
+    The blurhash function encodes an image as a BlurHash string.
+
+    :param pixels: np.ndarray: The (height, width, 3) sRGB pixels, 0 to 255
+    :param x_components: int: The number of horizontal components, 1 to 9
+    :param y_components: int: The number of vertical components, 1 to 9
+    :return: The BlurHash
+    """
+    height, width = pixels.shape[:2]
+    linear = srgb_to_linear(pixels.astype(np.float64))
+    basis_x = np.cos(np.pi * np.outer(np.arange(x_components), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(y_components), np.arange(height)) / height)
+    # factors[j, i, c] = sum over y, x of basis_y[j, y] * basis_x[i, x] * linear[y, x, c]
+    factors = np.tensordot(np.tensordot(basis_y, linear, (1, 0)), basis_x, (1, 1)).transpose(0, 2, 1)
+    factors = factors / (width * height)
+    factors[1:] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    result = _base83((x_components - 1) + (y_components - 1) * 9, 1)
+    if len(ac):
+        quantised_max = int(np.clip(math.floor(np.abs(ac).max() * 166 - 0.5), 0, 82))
+        max_value = (quantised_max + 1) / 166
+    else:
+        quantised_max, max_value = 0, 1
+    result += _base83(quantised_max, 1)
+    r, g, b = linear_to_srgb(dc)
+    result += _base83(int(r) << 16 | int(g) << 8 | int(b), 4)
+    scaled = ac / max_value
+    quantised = np.clip(np.floor(np.sign(scaled) * np.sqrt(np.abs(scaled)) * 9 + 9.5), 0, 18).astype(np.int64)
+    for value in quantised @ np.array([19 * 19, 19, 1]):
+        result += _base83(int(value), 2)
+    return result
+
+
+def encode_image(data: bytes, x_components: int = 4, y_components: int = 3) -> str | None:
+    """
+    The encode_image function computes the BlurHash of an image file.
+
+    :param data: bytes: The content of the image file
+    :param x_components: int: The number of horizontal components
+    :param y_components: int: The number of vertical components
+    :return: The BlurHash, or None if the data is not an image
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.draft("RGB", (THUMBNAIL_SIZE * 2, THUMBNAIL_SIZE * 2))
+            image = image.convert("RGB")
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            return blurhash(np.asarray(image), x_components, y_components)
+    except (OSError, SyntaxError, ValueError) as err:
+        logger.warning("Cannot compute placeholder: %s", err)
+        return None
+
+
+class PlaceholderStore:
+    """
+    Computes the placeholders of the photos in a pool of worker threads and stores them on the photos.
+    """
+
+    def __init__(self, reader: Downloader = downloader, workers: int = 4, components: tuple[int, int] = (4, 3),
+                 session_factory=sessionmanager.session):
+        self.reader = reader
+        self.workers = workers
+        self.components = components
+        self.session_factory = session_factory
+        self._executor: ThreadPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="placeholders")
+        return self._executor
+
+    async def compute(self, url: str) -> str | None:
+        """
+        The compute function reads a stored image and computes its placeholder in the worker pool.
+
+        :param url: str: The URL of the image
+        :return: The BlurHash, or None if the image is missing or unreadable
+        """
+        source = await self.reader.open(url)
+        if source is None:
+            return None
+        data = b"".join([chunk async for chunk in self.reader.read(source, 0, source.size - 1)])
+        return await asyncio.get_running_loop().run_in_executor(self.executor, encode_image, data, *self.components)
+
+    async def generate(self, photo_id: int, url: str) -> None:
+        """
+        The generate function computes the placeholder of a new photo and stores it. It runs as a background task.
+
+        :param photo_id: int: The photo
+        :param url: str: The URL of its image
+        :return: None
+        """
+        try:
+            placeholder = await self.compute(url)
+            if placeholder is None:
+                return
+            async with self.session_factory() as db:
+                await db.execute(update(Photo).where(Photo.id == photo_id).values(blurhash=placeholder))
+                await db.commit()
+        except Exception as err:
+            logger.error("Error computing the placeholder of photo %s: %s", photo_id, err)
+
+    def shutdown(self) -> None:
+        """
+        The shutdown function stops the worker threads once their work is done.
+
+        :return: None
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+placeholders = PlaceholderStore(workers=config.PLACEHOLDER_WORKERS)
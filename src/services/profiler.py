@@ -0,0 +1,237 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+from redis.exceptions import RedisError
+
+from src.conf.config import config
+from src.database.cache import redis_client
+
+
+logger = logging.getLogger(__name__)
+
+
+ASYNCIO_DIR = os.path.dirname(asyncio.__file__)
+# frames of the event loop itself, below the task or callback being run
+LOOP_FRAMES = {"_run", "_run_once", "run_forever", "run_until_complete", "__step", "__wakeup", "run"}
+
+
+def _label(frame) -> str:
+    code = frame.f_code
+    return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _stack(frame, task) -> tuple[str, ...]:
+    """
+    The _stack function turns the frames of the event loop thread into a stack rooted at the running task,
+    so time is attributed to coroutines instead of to the event loop.
+    """
+    if task is None and frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py"):
+        return ("<idle>",)
+    frames = []
+    while frame is not None:
+        if frame.f_code.co_filename.startswith(ASYNCIO_DIR) and frame.f_code.co_name in LOOP_FRAMES:
+            break
+        frames.append(_label(frame))
+        frame = frame.f_back
+    frames.reverse()
+    root = f"task {task.get_name()}" if task is not None else "<event loop>"
+    return (root, *frames)
+
+
+class Sampler:
+    """
+    Samples the stack of the event loop thread every interval seconds from a background thread.
+    With tasks given, only the samples taken while one of those tasks runs are kept.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, interval: float = config.PROFILER_INTERVAL, tasks=None):
+        self.loop = loop
+        self.interval = interval
+        self.tasks = tasks
+        self.thread_id = threading.get_ident()
+        self.samples: Counter = Counter()
+        self.started_at = None
+        self.duration = 0.0
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.duration = time.perf_counter() - self.started_at
+        return self.samples
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            task = asyncio.current_task(self.loop)
+            if self.tasks is not None and task not in self.tasks:
+                continue
+            self.samples[_stack(frame, task)] += 1
+
+
+def collapsed(samples: Counter) -> str:
+    """
+    The collapsed function renders samples in the collapsed-stack format read by flamegraph.pl and speedscope.
+
+    :param samples: Counter: Sample counts by stack
+    :return: One ``frame;frame;frame count`` line per stack
+    """
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in samples.most_common())
+
+
+def speedscope(samples: Counter, interval: float, name: str) -> dict:
+    """
+    The speedscope function renders samples as a speedscope sampled profile.
+
+    :param samples: Counter: Sample counts by stack
+    :param interval: float: The sampling interval in seconds, used as the weight of a sample
+    :param name: str: The name of the profile
+    :return: A dictionary following https://www.speedscope.app/file-format-schema.json
+    """
+    frames: dict[str, int] = {}
+    stacks, weights = [], []
+    for stack, count in samples.most_common():
+        stacks.append([frames.setdefault(label, len(frames)) for label in stack])
+        weights.append(count * interval)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "shared": {"frames": [{"name": label} for label in frames]},
+        "profiles": [{
+            "type": "sampled",
+            "name": name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": stacks,
+            "weights": weights,
+        }],
+        "name": name,
+        "exporter": "photoshare",
+    }
+
+
+def render(samples: Counter, interval: float, name: str, fmt: str) -> str:
+    if fmt == "speedscope":
+        return json.dumps(speedscope(samples, interval, name))
+    return collapsed(samples)
+
+
+class Profiler:
+    """
+    On-demand profiling of a live worker: either of the whole worker for a few seconds, or of single requests
+    carrying an ``X-Profile-Token`` header issued by :meth:`arm`. Nothing runs while no profile is requested.
+    """
+    header = b"x-profile-token"
+    prefix = "profile"
+
+    def __init__(self, cache=redis_client, interval: float = config.PROFILER_INTERVAL,
+                 max_seconds: float = config.PROFILER_MAX_SECONDS):
+        self.cache = cache
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._lock = asyncio.Lock()
+
+    async def profile_worker(self, seconds: float) -> tuple[Counter, float]:
+        """
+        The profile_worker function samples the current worker for the given number of seconds.
+
+        :param seconds: float: The duration of the profile, capped at PROFILER_MAX_SECONDS
+        :return: The sample counts by stack and the actual duration
+        """
+        async with self._lock:
+            sampler = Sampler(asyncio.get_running_loop(), self.interval)
+            sampler.start()
+            try:
+                await asyncio.sleep(min(seconds, self.max_seconds))
+            finally:
+                samples = sampler.stop()
+            return samples, sampler.duration
+
+    def arm(self, token: str) -> None:
+        """
+        The arm function allows one request carrying the token in its X-Profile-Token header to be profiled.
+        Tokens are shared through Redis, so the request may be served by any worker.
+
+        :param token: str: A random token
+        :return: None
+        """
+        self.cache.set(f"{self.prefix}:{token}", "armed", ex=int(self.max_seconds * 10))
+
+    def result(self, token: str) -> dict | None:
+        """
+        The result function returns the profile recorded for a token, once the flagged request finished.
+
+        :param token: str: The token given to arm
+        :return: A dictionary with the stacks, the interval and the request, or None if not recorded yet
+        """
+        data = self.cache.get(f"{self.prefix}:{token}")
+        if data is None or data == b"armed":
+            return None
+        return json.loads(data)
+
+    def _claim(self, token: str) -> bool:
+        try:
+            return self.cache.getdel(f"{self.prefix}:{token}") == b"armed"
+        except RedisError as err:
+            logger.error("Error claiming profile token: %s", err)
+            return False
+
+    def _store(self, token: str, request: str, samples: Counter) -> None:
+        data = {
+            "request": request,
+            "interval": self.interval,
+            "stacks": [[list(stack), count] for stack, count in samples.items()],
+        }
+        try:
+            self.cache.set(f"{self.prefix}:{token}", json.dumps(data), ex=int(self.max_seconds * 10))
+        except RedisError as err:
+            logger.error("Error storing profile: %s", err)
+
+
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+    """
+    ASGI middleware profiling the requests flagged with a valid X-Profile-Token header.
+    Unflagged requests only cost a scan of the request headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        token = None
+        for name, value in scope["headers"]:
+            if name == Profiler.header:
+                token = value.decode()
+                break
+        if token is None or not profiler._claim(token):
+            await self.app(scope, receive, send)
+            return
+
+        sampler = Sampler(asyncio.get_running_loop(), profiler.interval, tasks={asyncio.current_task()})
+        sampler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            samples = sampler.stop()
+            profiler._store(token, f'{scope["method"]} {scope["path"]}', samples)
@@ -0,0 +1,170 @@
+"""
+"More like this" recommendations from the tags of the photos.
+
+Every photo is a binary tag vector scaled to unit length, so the dot product of two photos is their cosine
+similarity. The vectors are stored transposed, one row per tag listing the photos carrying it (an inverted index
+in CSR form); scoring a query only reads the rows of its tags. The arrays are saved as ``.npy`` files and opened
+memory-mapped, so they stay out of the Python heap and are paged in on demand.
+
+Tag changes published by the photo repository go to a small in-memory overlay until the next rebuild.
+"""
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import config
+from src.database.db import sessionmanager
+from src.entity.models import photo_tags
+from src.services.invalidation import invalidation_bus
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+ARRAYS = ("indptr", "indices", "data", "photo_ids")
+
+
+def build_arrays(links: np.ndarray) -> dict[str, np.ndarray]:
+    """
+    The build_arrays function builds the tag-major matrix of unit photo vectors from (photo ID, tag ID) links.
+
+    :param links: np.ndarray: An (n, 2) array of links
+    :return: The CSR arrays (indptr, indices, data) and the photo ID of every column, sorted
+    """
+    photo_ids, columns = np.unique(links[:, 0], return_inverse=True)
+    tags = links[:, 1]
+    weights = (1 / np.sqrt(np.bincount(columns))).astype(np.float32)
+    order = np.lexsort((columns, tags))
+    indptr = np.zeros((tags.max() + 2) if len(tags) else 1, dtype=np.int64)
+    np.cumsum(np.bincount(tags, minlength=len(indptr) - 1), out=indptr[1:])
+    return {
+        "indptr": indptr,
+        "indices": columns[order].astype(np.int32),
+        "data": weights[columns[order]],
+        "photo_ids": photo_ids.astype(np.int64),
+    }
+
+
+def unit_vector(tag_lists: list[list[int]]) -> dict[int, float]:
+    """
+    The unit_vector function sums the unit tag vectors of some photos and scales the result to unit length.
+
+    :param tag_lists: list[list[int]]: The tag IDs of each photo
+    :return: A sparse vector as a dictionary from tag ID to weight
+    """
+    vector: dict[int, float] = {}
+    for tag_ids in tag_lists:
+        tag_ids = set(tag_ids)
+        for tag_id in tag_ids:
+            vector[tag_id] = vector.get(tag_id, 0.0) + 1 / np.sqrt(len(tag_ids))
+    norm = np.sqrt(sum(weight * weight for weight in vector.values()))
+    return {tag_id: weight / norm for tag_id, weight in vector.items()} if norm else {}
+
+
+class RecommendationIndex:
+    """
+    The memory-mapped tag vectors of all photos, with an overlay of the photos retagged since the last build.
+    """
+
+    def __init__(self, directory: str | None = None, max_overlay: int = 10000):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "photoshare-recommendations")
+        self.max_overlay = max_overlay
+        self.arrays = build_arrays(np.zeros((0, 2), dtype=np.int64))
+        self.overlay: dict[int, list[int]] = {}
+        self._path = None
+        self._rebuilding = False
+
+    def __len__(self) -> int:
+        return len(self.arrays["photo_ids"])
+
+    async def rebuild(self, db: AsyncSession) -> None:
+        """
+        The rebuild function builds the matrix from photo_tags, saves it and maps it, then clears the overlay.
+
+        :param db: AsyncSession: The database session
+        :return: None
+        """
+        overlay = dict(self.overlay)
+        links = np.array((await db.execute(select(photo_tags.c.photo_id, photo_tags.c.tag_id))).all(),
+                         dtype=np.int64).reshape(-1, 2)
+        arrays = await asyncio.to_thread(build_arrays, links)
+        path = os.path.join(self.directory, f"{os.getpid()}-{time.time_ns()}")
+        os.makedirs(path)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), arrays[name])
+        previous, self._path = self._path, path
+        self.arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in ARRAYS}
+        # keep the changes that arrived while the links were read
+        self.overlay = {photo_id: tags for photo_id, tags in self.overlay.items() if overlay.get(photo_id) != tags}
+        if previous:
+            shutil.rmtree(previous, ignore_errors=True)
+        logger.info("Recommendation index built with %d photos and %d links", len(self), len(links))
+
+    def _rows(self, photo_ids) -> np.ndarray:
+        photo_ids = np.fromiter(photo_ids, dtype=np.int64)
+        known = self.arrays["photo_ids"]
+        rows = np.searchsorted(known, photo_ids)
+        found = rows < len(known)
+        found[found] = known[rows[found]] == photo_ids[found]
+        return rows[found]
+
+    def recommend(self, tag_lists: list[list[int]], exclude: set[int], limit: int = 20) -> list[tuple[int, float]]:
+        """
+        The recommend function finds the photos whose tags are the most similar to the tags of some photos.
+
+        :param tag_lists: list[list[int]]: The tag IDs of each photo to match
+        :param exclude: set[int]: The photo IDs not to return, usually the photos matched
+        :param limit: int: The number of photos to return
+        :return: A list of (photo ID, cosine similarity), most similar first
+        """
+        query = unit_vector(tag_lists)
+        indptr, indices, data = self.arrays["indptr"], self.arrays["indices"], self.arrays["data"]
+        columns, weights = [], []
+        for tag_id, weight in query.items():
+            if tag_id + 1 < len(indptr):
+                start, end = indptr[tag_id], indptr[tag_id + 1]
+                columns.append(indices[start:end])
+                weights.append(data[start:end] * weight)
+        found: list[tuple[int, float]] = []
+        if columns:
+            scores = np.bincount(np.concatenate(columns), np.concatenate(weights), minlength=len(self))
+            scores[self._rows(exclude | self.overlay.keys())] = 0
+            count = min(limit, np.count_nonzero(scores))
+            if count:
+                top = np.argpartition(-scores, count - 1)[:count]
+                photo_ids = self.arrays["photo_ids"]
+                found = [(int(photo_ids[row]), float(scores[row])) for row in top]
+        for photo_id, tag_ids in self.overlay.items():
+            if photo_id not in exclude and tag_ids:
+                score = sum(query.get(tag_id, 0.0) for tag_id in tag_ids) / np.sqrt(len(tag_ids))
+                if score > 0:
+                    found.append((photo_id, float(score)))
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found[:limit]
+
+    def _on_event(self, key: str, payload: dict) -> None:
+        self.overlay[int(key)] = [tag_id for tag_id, _ in payload.get("new") or []]
+        if len(self.overlay) > self.max_overlay and not self._rebuilding:
+            self._rebuilding = True
+            asyncio.get_running_loop().create_task(self._rebuild_in_background())
+
+    async def _rebuild_in_background(self) -> None:
+        try:
+            async with sessionmanager.session() as db:
+                await self.rebuild(db)
+        except Exception as err:
+            logger.error("Error rebuilding the recommendation index: %s", err)
+        finally:
+            self._rebuilding = False
+
+
+recommendation_index = RecommendationIndex(config.RECOMMENDATIONS_DIR, config.RECOMMENDATIONS_MAX_OVERLAY)
+invalidation_bus.subscribe("photo_tags", recommendation_index._on_event)
@@ -0,0 +1,315 @@
+"""
+Resilience of the calls to remote services: request deadlines, timeouts, retries and circuit breakers.
+
+Every HTTP request gets a deadline, ``REQUEST_DEADLINE`` seconds after it starts; the timeout of a remote call is
+the time left, capped by the default timeout of the service, so a degraded service cannot hold a request (and its
+database session) longer than the deadline. Background tasks run after the response without a deadline.
+
+``ResiliencePolicy.call`` retries idempotent calls failing with a transient error (a connection error, a timeout,
+a 5xx or 429 response) with exponential back-off and full jitter, unless the back-off would overrun the deadline.
+Its circuit breaker counts the transient failures over a sliding window: when they exceed a share of the calls,
+the breaker opens and calls fail fast with CircuitOpenError, without reaching the service, for a cooling period.
+Then a single probe call is let through and its outcome closes or reopens the breaker. Errors answered by the
+service, e.g. a missing object, are successes for the breaker and are never retried.
+"""
+import collections
+import functools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable
+
+import httpx
+
+from src.services.metrics import CIRCUIT_REJECTED, CIRCUIT_STATE, REMOTE_RETRIES
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Unavailable(Exception):
+    """
+    A remote service cannot be called now; the request may be retried later.
+    """
+    retry_after: float | None = None
+
+
+class CircuitOpenError(Unavailable):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuit breaker {name} is open")
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Unavailable, TimeoutError):
+    pass
+
+
+class Deadline:
+    """
+    The time by which a request must be answered.
+    """
+
+    def __init__(self, seconds: float | None):
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self) -> float | None:
+        return self.expires - time.monotonic() if self.expires is not None else None
+
+    def clear(self) -> None:
+        self.expires = None
+
+
+current_deadline: ContextVar[Deadline | None] = ContextVar("current_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float | None):
+    """
+    The deadline function sets the deadline of the calls made inside its block; a deadline already set
+    and earlier is kept.
+
+        with deadline(2.0):
+            storage.stat(key)
+
+    :param seconds: float | None: The time allowed, None for no deadline
+    :return: A context manager yielding the Deadline
+    """
+    outer = current_deadline.get()
+    inner = Deadline(seconds)
+    if outer is not None and outer.expires is not None and (inner.expires is None or outer.expires < inner.expires):
+        inner.expires = outer.expires
+    token = current_deadline.set(inner)
+    try:
+        yield inner
+    finally:
+        current_deadline.reset(token)
+
+
+def call_timeout(default: float) -> float:
+    """
+    The call_timeout function returns the timeout of a remote call: the time left before the deadline,
+    at most the default timeout.
+
+    :param default: float: The timeout without a deadline
+    :return: The timeout in seconds; DeadlineExceeded is raised if the deadline passed
+    """
+    current = current_deadline.get()
+    remaining = current.remaining() if current is not None else None
+    if remaining is None:
+        return default
+    if remaining <= 0:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return min(default, remaining)
+
+
+def is_transient(err: BaseException) -> bool:
+    """
+    The is_transient function tells whether an error may not happen again: a failed connection, a timeout,
+    or a 5xx or 429 response.
+
+    :param err: BaseException: The error
+    :return: True if the call may be retried
+    """
+    if isinstance(err, Unavailable):
+        return False
+    if isinstance(err, httpx.HTTPStatusError):
+        return err.response.status_code >= 500 or err.response.status_code == 429
+    return isinstance(err, (httpx.TransportError, ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service for a while. States are exported as 0 (closed), 1 (half-open) and 2 (open).
+    """
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 10, window: float = 30.0,
+                 open_for: float = 15.0):
+        """
+        :param name: str: The service, for the metrics
+        :param failure_rate: float: The share of failed calls over the window opening the breaker
+        :param min_calls: int: The number of calls over the window below which the breaker stays closed
+        :param window: float: The sliding window in seconds
+        :param open_for: float: The time in seconds the breaker stays open before a probe call
+        """
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_for = open_for
+        self.state = self.CLOSED
+        self._calls: collections.deque[tuple[float, bool]] = collections.deque()
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.set_function(lambda: self.state, name)
+
+    def _set(self, state: int) -> None:
+        if state != self.state:
+            logger.warning("Circuit breaker %s: %s -> %s", self.name, *(
+                ("closed", "half-open", "open")[value] for value in (self.state, state)))
+        self.state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if state != self.HALF_OPEN:
+            self._probing = False
+        self._calls.clear()
+        self._failures = 0
+
+    def allow(self) -> None:
+        """
+        The allow function lets a call through, or raises CircuitOpenError while the breaker is open
+        or a probe call is running.
+
+        :return: None
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                retry_after = self._opened_at + self.open_for - time.monotonic()
+                if retry_after > 0:
+                    CIRCUIT_REJECTED.labels(self.name).inc()
+                    raise CircuitOpenError(self.name, retry_after)
+                self._set(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    CIRCUIT_REJECTED.labels(self.name).inc()
+                    raise CircuitOpenError(self.name, self.open_for)
+                self._probing = True
+
+    def release(self) -> None:
+        """
+        The release function ends a call let through that has no outcome, e.g. an interrupted one,
+        so that the next call probes the service instead of being rejected.
+
+        :return: None
+        """
+        with self._lock:
+            self._probing = False
+
+    def record(self, success: bool) -> None:
+        """
+        The record function counts the outcome of a call let through.
+
+        :param success: bool: False if the call failed with a transient error
+        :return: None
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._set(self.CLOSED if success else self.OPEN)
+                return
+            if self.state == self.OPEN:
+                return
+            now = time.monotonic()
+            self._calls.append((now, success))
+            self._failures += not success
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._failures -= not self._calls.popleft()[1]
+            if len(self._calls) >= self.min_calls and self._failures >= self.failure_rate * len(self._calls):
+                self._set(self.OPEN)
+
+
+class ResiliencePolicy:
+    """
+    Timeouts, retries and a circuit breaker for the calls to one service.
+    """
+
+    def __init__(self, name: str, timeout: float = 10.0, retries: int = 2, backoff: float = 0.1,
+                 max_backoff: float = 2.0, breaker: CircuitBreaker | None = None,
+                 transient: Callable[[BaseException], bool] = is_transient):
+        """
+        :param name: str: The service, for the metrics
+        :param timeout: float: The timeout of a call without a deadline, see call_timeout
+        :param retries: int: The number of retries of an idempotent call
+        :param backoff: float: The back-off before the first retry in seconds, doubled for every retry
+        :param max_backoff: float: The longest back-off in seconds
+        :param breaker: CircuitBreaker: The circuit breaker, a default one if None
+        :param transient: Callable: Tells whether an error may be retried and counts as a failure
+        """
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker(name)
+        self.transient = transient
+
+    def call(self, operation: str, func: Callable[..., Any], *args, idempotent: bool = False, **kwargs) -> Any:
+        """
+        The call function calls the service through the breaker, retrying transient failures of idempotent calls.
+        The function reads its timeout with call_timeout.
+
+        :param operation: str: The operation, for the metrics
+        :param func: Callable: The function calling the service
+        :param idempotent: bool: Whether the call can be repeated safely
+        :return: The result of the function
+        """
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            call_timeout(self.timeout)
+            self.breaker.allow()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                transient = self.transient(err)
+                self.breaker.record(not transient)
+                if not transient or attempt == attempts - 1:
+                    raise
+                delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+                current = current_deadline.get()
+                remaining = current.remaining() if current is not None else None
+                if remaining is not None and delay >= remaining:
+                    raise DeadlineExceeded("Request deadline exceeded") from err
+                REMOTE_RETRIES.labels(self.name, operation).inc()
+                logger.info("Retrying %s %s in %.2f s: %s", self.name, operation, delay, err)
+                time.sleep(delay)
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record(True)
+                return result
+
+    def wrap(self, operation: str, idempotent: bool = False):
+        """
+        The wrap function is a decorator calling the decorated function through call.
+
+        :param operation: str: The operation, for the metrics
+        :param idempotent: bool: Whether the call can be repeated safely
+        :return: The decorator
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                return self.call(operation, func, *args, idempotent=idempotent, **kwargs)
+            return wrapper
+
+        return decorator
+
+
+class DeadlineMiddleware:
+    """
+    ASGI middleware giving every HTTP request a deadline, cleared once the response is sent
+    so that the background tasks run without it.
+    """
+
+    def __init__(self, app, seconds: float):
+        self.app = app
+        self.seconds = seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        with deadline(self.seconds) as request_deadline:
+            async def send_and_clear(message):
+                await send(message)
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    request_deadline.clear()
+
+            await self.app(scope, receive, send_and_clear)
@@ -0,0 +1,169 @@
+import logging
+import secrets
+from datetime import datetime, timedelta
+
+from redis.exceptions import RedisError
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.entity.models import RefreshSession, User
+from src.services.metrics import CACHE_REQUESTS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Compare-and-swap of the current token id of a session, renewing the TTL of the session and of the set of sessions
+# of its user (KEYS[2]), which revoke_user reads.
+# Returns 1 on rotation, 0 when a stale token was replayed (the family is dropped) and -1 for unknown sessions.
+ROTATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], 'jti')
+if not current then
+    return -1
+end
+if current ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    return 0
+end
+redis.call('HSET', KEYS[1], 'jti', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('SADD', KEYS[2], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return 1
+"""
+
+
+class SessionStore:
+    """
+    Refresh-token sessions, one per login (a token family).
+
+    Every session lives in a Redis hash ``refresh_session:<sid>`` with a TTL; the SQL table ``refresh_sessions``
+    is used when Redis is unavailable. Refreshing only touches the session record, never the ``users`` row.
+    """
+    prefix = "refresh_session"
+
+    def __init__(self, cache=redis_client, ttl: int = config.REFRESH_SESSION_TTL):
+        self.cache = cache
+        self.ttl = ttl
+        self._rotate = cache.register_script(ROTATE_SCRIPT)
+
+    def _key(self, sid: str) -> str:
+        return f"{self.prefix}:{sid}"
+
+    def _user_key(self, user_id: int) -> str:
+        return f"{self.prefix}s:{user_id}"
+
+    async def open(self, user: User, db: AsyncSession) -> tuple[str, str]:
+        """
+        The open function starts a new session (token family) for the user.
+
+        :param user: User: The user who logged in
+        :param db: AsyncSession: The database session used when Redis is unavailable
+        :return: A tuple of the session id and the id of its first refresh token
+        """
+        sid = secrets.token_hex(16)
+        jti = secrets.token_hex(16)
+        try:
+            pipe = self.cache.pipeline()
+            pipe.hset(self._key(sid), mapping={"user_id": user.id, "jti": jti})
+            pipe.expire(self._key(sid), self.ttl)
+            pipe.sadd(self._user_key(user.id), sid)
+            pipe.expire(self._user_key(user.id), self.ttl)
+            pipe.execute()
+        except RedisError as err:
+            logger.warning("Redis unavailable, storing session in the database: %s", err)
+            db.add(RefreshSession(
+                id=sid,
+                user_id=user.id,
+                jti=jti,
+                expires_at=datetime.utcnow() + timedelta(seconds=self.ttl),
+            ))
+            await db.commit()
+        return sid, jti
+
+    async def rotate(self, sid: str, jti: str, user: User, db: AsyncSession) -> str | None:
+        """
+        The rotate function replaces the current refresh token of a session with a new one.
+        Presenting a token that was already rotated away is treated as reuse and revokes the whole family.
+
+        :param sid: str: The session id from the refresh token
+        :param jti: str: The token id from the refresh token
+        :param user: User: The user of the refresh token
+        :param db: AsyncSession: The database session used for sessions stored in SQL
+        :return: The id of the new refresh token or None if the token is not valid
+        """
+        new_jti = secrets.token_hex(16)
+        try:
+            rotated = self._rotate(keys=[self._key(sid), self._user_key(user.id)], args=[jti, new_jti, self.ttl, sid])
+        except RedisError as err:
+            logger.warning("Redis unavailable, rotating session in the database: %s", err)
+            rotated = -1
+        if rotated == 1:
+            CACHE_REQUESTS.labels("token", "hit").inc()
+            return new_jti
+        if rotated == 0:
+            CACHE_REQUESTS.labels("token", "hit").inc()
+            logger.warning("Refresh token reuse detected, session %s revoked", sid)
+            return None
+
+        CACHE_REQUESTS.labels("token", "miss").inc()
+
+        result = await db.execute(
+            update(RefreshSession)
+            .where(
+                RefreshSession.id == sid,
+                RefreshSession.user_id == user.id,
+                RefreshSession.jti == jti,
+                RefreshSession.revoked.is_(False),
+                RefreshSession.expires_at > datetime.utcnow(),
+            )
+            .values(jti=new_jti)
+        )
+        if result.rowcount == 1:
+            await db.commit()
+            return new_jti
+        result = await db.execute(
+            update(RefreshSession).where(RefreshSession.id == sid).values(revoked=True)
+        )
+        await db.commit()
+        if result.rowcount:
+            logger.warning("Refresh token reuse detected, session %s revoked", sid)
+        return None
+
+    async def revoke(self, sid: str, db: AsyncSession) -> None:
+        """
+        The revoke function drops a session, invalidating every refresh token of its family.
+
+        :param sid: str: The session id to revoke
+        :param db: AsyncSession: The database session used for sessions stored in SQL
+        :return: None
+        """
+        try:
+            self.cache.delete(self._key(sid))
+        except RedisError as err:
+            logger.warning("Redis unavailable while revoking session %s: %s", sid, err)
+        await db.execute(update(RefreshSession).where(RefreshSession.id == sid).values(revoked=True))
+        await db.commit()
+
+    async def revoke_user(self, user_id: int, db: AsyncSession) -> None:
+        """
+        The revoke_user function drops every session of a user, e.g. when the user is banned.
+
+        :param user_id: int: The ID of the user
+        :param db: AsyncSession: The database session used for sessions stored in SQL
+        :return: None
+        """
+        try:
+            sids = self.cache.smembers(self._user_key(user_id))
+            keys = [self._key(sid.decode()) for sid in sids]
+            self.cache.delete(self._user_key(user_id), *keys)
+        except RedisError as err:
+            logger.warning("Redis unavailable while revoking sessions of user %d: %s", user_id, err)
+        await db.execute(update(RefreshSession).where(RefreshSession.user_id == user_id).values(revoked=True))
+        await db.commit()
+
+
+session_store = SessionStore()
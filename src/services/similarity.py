@@ -0,0 +1,160 @@
+"""
+Near-duplicate photo search on 64-bit difference hashes (dHash).
+
+The index is a multi-index hash table: each hash is split into four 16-bit chunks, one table per chunk.
+Two hashes within Hamming distance ``r`` share at least one chunk within distance ``r // 4``, so a query only
+probes the buckets around its own chunks and checks the few photos found there, instead of every hash.
+The number of buckets probed grows combinatorially with ``r // 4``: 548 up to MAX_DISTANCE (11), 2788 at 12
+and 27540 at 20, so searches are bounded to MAX_DISTANCE.
+"""
+import itertools
+import logging
+from typing import BinaryIO
+
+from PIL import Image
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.entity.models import Photo
+from src.services.invalidation import invalidation_bus
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+HASH_BITS = 64
+CHUNKS = 4
+CHUNK_BITS = HASH_BITS // CHUNKS
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# the farthest search probing the chunks at most 2 bits away
+MAX_DISTANCE = 3 * CHUNKS - 1
+
+
+def dhash(file: BinaryIO) -> int:
+    """
+    The dhash function computes the difference hash of an image: the image is shrunk to 9x8 grey pixels
+    and every bit tells whether a pixel is brighter than its right neighbour.
+    The file is rewound afterwards.
+
+    :param file: BinaryIO: The image file
+    :return: The 64-bit hash
+    """
+    with Image.open(file) as image:
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    file.seek(0)
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = value << 1 | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def photo_hash(file: BinaryIO) -> str | None:
+    """
+    The photo_hash function returns the hex difference hash of an uploaded image, or None if it is not an image.
+
+    :param file: BinaryIO: The image file
+    :return: The hash as 16 hex digits or None
+    """
+    try:
+        return f"{dhash(file):016x}"
+    except OSError as err:
+        logger.warning("Cannot hash uploaded image: %s", err)
+        file.seek(0)
+        return None
+
+
+def _neighbours(chunk: int, radius: int):
+    yield chunk
+    for distance in range(1, radius + 1):
+        for bits in itertools.combinations(range(CHUNK_BITS), distance):
+            flipped = chunk
+            for bit in bits:
+                flipped ^= 1 << bit
+            yield flipped
+
+
+class SimilarityIndex:
+    """
+    In-memory multi-index hash table of the photo hashes of this worker.
+    """
+
+    def __init__(self):
+        self.hashes: dict[int, int] = {}
+        self.tables: list[dict[int, list[int]]] = [{} for _ in range(CHUNKS)]
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def add(self, photo_id: int, value: int) -> None:
+        if photo_id in self.hashes:
+            self.remove(photo_id)
+        self.hashes[photo_id] = value
+        for i, table in enumerate(self.tables):
+            table.setdefault(value >> (i * CHUNK_BITS) & CHUNK_MASK, []).append(photo_id)
+
+    def remove(self, photo_id: int) -> None:
+        value = self.hashes.pop(photo_id, None)
+        if value is None:
+            return
+        for i, table in enumerate(self.tables):
+            chunk = value >> (i * CHUNK_BITS) & CHUNK_MASK
+            bucket = table[chunk]
+            bucket.remove(photo_id)
+            if not bucket:
+                del table[chunk]
+
+    def search(self, value: int, distance: int, limit: int | None = None) -> list[tuple[int, int]]:
+        """
+        The search function finds the photos whose hash is within a Hamming distance of the given hash.
+
+        :param value: int: The hash to search around
+        :param distance: int: The maximal number of differing bits, at most MAX_DISTANCE
+        :param limit: int: The maximal number of results
+        :return: A list of (photo ID, distance), closest first
+        """
+        if distance > MAX_DISTANCE:
+            raise ValueError(f"Search distance {distance} exceeds {MAX_DISTANCE}")
+        radius = distance // CHUNKS
+        seen = set()
+        found = []
+        for i, table in enumerate(self.tables):
+            for chunk in _neighbours(value >> (i * CHUNK_BITS) & CHUNK_MASK, radius):
+                for photo_id in table.get(chunk, ()):
+                    if photo_id in seen:
+                        continue
+                    seen.add(photo_id)
+                    d = (self.hashes[photo_id] ^ value).bit_count()
+                    if d <= distance:
+                        found.append((photo_id, d))
+        found.sort(key=lambda item: (item[1], item[0]))
+        return found[:limit] if limit else found
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        The load function fills the index with the hashes stored on the photos.
+
+        :param db: AsyncSession: The database session
+        :return: None
+        """
+        result = await db.stream(select(Photo.id, Photo.dhash).where(Photo.dhash.is_not(None)))
+        async for photo_id, value in result:
+            self.add(photo_id, int(value, 16))
+        logger.info("Similarity index loaded with %d photos", len(self))
+
+    def _on_event(self, key: str, payload: dict) -> None:
+        if payload.get("dhash"):
+            self.add(int(key), int(payload["dhash"], 16))
+        else:
+            self.remove(int(key))
+
+    def publish_added(self, photo_id: int, value: str) -> None:
+        invalidation_bus.notify("photo_hash", str(photo_id), dhash=value)
+
+    def publish_removed(self, photo_id: int) -> None:
+        invalidation_bus.notify("photo_hash", str(photo_id))
+
+
+similarity_index = SimilarityIndex()
+invalidation_bus.subscribe("photo_hash", similarity_index._on_event)
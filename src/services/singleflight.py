@@ -0,0 +1,104 @@
+"""
+Single-flight calls: concurrent callers of the same operation with the same key share one execution.
+
+When a cached value expires under load, every request missing it at once would recompute it (a thundering herd).
+With ``SingleFlight.do`` the first caller of a key runs the function and the callers arriving before it finishes
+await its result, or its exception, instead of running it again. The function runs in its own task, so a caller
+that is cancelled, e.g. by a client disconnecting, does not cancel it for the others.
+
+A flight given a Redis client is also single across processes: the caller running the function holds a short
+Redis lock on the key, and callers of other processes wait for the lock before running the function themselves.
+The function is expected to find the value cached by then, so it must check the cache first.
+"""
+import asyncio
+import logging
+import secrets
+import time
+from typing import Any, Awaitable, Callable, Hashable
+
+from redis.exceptions import RedisError
+
+from src.services.metrics import SINGLEFLIGHT_CALLS
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Deletes a lock only if it is still held with the token of the caller.
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class SingleFlight:
+    """
+    Coalesces the concurrent calls of one operation by key.
+    """
+    prefix = "singleflight"
+
+    def __init__(self, name: str, cache=None, lock_ttl: float = 10.0, poll_interval: float = 0.02):
+        """
+        :param name: str: The operation, for the metrics and the Redis locks
+        :param cache: redis.Redis: The Redis client for the locks across processes, None for this process only
+        :param lock_ttl: float: The longest time in seconds a lock is held, and callers of other processes wait
+        :param poll_interval: float: The interval in seconds between two attempts to take a held lock
+        """
+        self.name = name
+        self.cache = cache
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+        self._unlock = cache.register_script(UNLOCK_SCRIPT) if cache is not None else None
+        self._calls: dict[Hashable, asyncio.Task] = {}
+
+    async def do(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        The do function calls func, unless a call with the same key is running: then it awaits that call.
+
+        :param key: Hashable: Identifies the call, e.g. the arguments of the operation
+        :param func: Callable: The coroutine function
+        :return: The result of the call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            SINGLEFLIGHT_CALLS.labels(self.name, "executed").inc()
+            task = asyncio.get_running_loop().create_task(self._run(key, func, *args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._done(key, done))
+        else:
+            SINGLEFLIGHT_CALLS.labels(self.name, "coalesced").inc()
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # retrieved, so that no caller left does not log it as never retrieved
+            task.exception()
+
+    async def _run(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        if self.cache is None:
+            return await func(*args, **kwargs)
+        lock, token = f"{self.prefix}:{self.name}:{key}", secrets.token_hex(8)
+        deadline = time.monotonic() + self.lock_ttl
+        try:
+            locked = bool(self.cache.set(lock, token, nx=True, px=int(self.lock_ttl * 1000)))
+            if not locked:
+                SINGLEFLIGHT_CALLS.labels(self.name, "waited").inc()
+            while not locked and time.monotonic() < deadline:
+                await asyncio.sleep(self.poll_interval)
+                locked = bool(self.cache.set(lock, token, nx=True, px=int(self.lock_ttl * 1000)))
+        except RedisError as err:
+            logger.warning("Redis unavailable, %s runs without lock: %s", self.name, err)
+            locked = False
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            if locked:
+                try:
+                    self._unlock(keys=[lock], args=[token])
+                except RedisError as err:
+                    logger.warning("Redis unavailable, lock of %s expires by itself: %s", self.name, err)
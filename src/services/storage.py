@@ -0,0 +1,641 @@
+"""
+Pluggable storage of the uploaded images.
+
+Objects are addressed by keys made of the SHA-256 of their content, optionally under a namespace, e.g.
+``avatars/<sha256>.png``. The driver is chosen by STORAGE_DRIVER:
+
+* ``cloudinary``: the Cloudinary account, the only driver supporting transformations;
+* ``local``: a directory sharded by the first characters of the hash, served by ``GET /api/storage/{key}``
+  with Range support and zero-copy sends when the server offers them;
+* ``s3``: any S3-compatible store (AWS, MinIO, ...) with path-style requests signed with AWS Signature V4.
+
+The calls of the remote drivers go through a ResiliencePolicy (see src.services.resilience): their timeout is
+bounded by the request deadline, transient failures are retried and a circuit breaker fails fast during outages.
+"""
+import abc
+import hashlib
+import hmac
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from email.utils import formatdate
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple
+from urllib.parse import quote, urlsplit
+
+import anyio
+import cloudinary.exceptions
+import httpx
+from starlette.responses import Response
+
+from src.conf.config import config
+from src.services.cloudinary import (
+    build_image_url, delete_image, get_public_id, resource_info, transform_image, upload_image
+)
+from src.services.metrics import STORAGE_ERRORS, STORAGE_LATENCY, timed
+from src.services.resilience import CircuitBreaker, ResiliencePolicy, call_timeout, is_transient
+from src.services.tracing import traced
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+_key_pattern = re.compile(r"^(?:[A-Za-z0-9_-]+/)*[A-Za-z0-9_-][A-Za-z0-9._-]*$")
+
+
+def hash_file(file: BinaryIO) -> tuple[str, int]:
+    """
+    The hash_file function computes the SHA-256 and the length of a file chunk by chunk,
+    then rewinds it so it can still be uploaded.
+
+    :param file: BinaryIO: The file object
+    :return: The hex digest and the size in bytes
+    """
+    digest = hashlib.sha256()
+    size = 0
+    while chunk := file.read(CHUNK_SIZE):
+        digest.update(chunk)
+        size += len(chunk)
+    file.seek(0)
+    return digest.hexdigest(), size
+
+
+def object_key(sha256: str, content_type: str | None = None, namespace: str | None = None) -> str:
+    """
+    The object_key function builds the key of some content: its hash with the extension of its type.
+
+    >>> object_key("ab" * 32, "image/png", "avatars")[-12:]
+    'abababab.png'
+
+    :param sha256: str: The hex digest of the content
+    :param content_type: str: The MIME type of the content, if known
+    :param namespace: str: A directory for the key, e.g. "avatars"
+    :return: The key
+    """
+    extension = mimetypes.guess_extension(content_type or "") or ""
+    key = f"{sha256}{extension}"
+    return f"{namespace}/{key}" if namespace else key
+
+
+def check_key(key: str) -> str:
+    if not _key_pattern.match(key):
+        raise ValueError(f"Invalid storage key: {key!r}")
+    return key
+
+
+class StoredObject(NamedTuple):
+    key: str
+    size: int
+    content_type: str
+    etag: str
+    modified: float
+
+
+class Storage(abc.ABC):
+    """
+    The storage interface. Drivers implement the abstract methods; the public ones are traced and timed,
+    and call the underscored ones through the resilience policy of the driver, if any.
+    """
+    name = "storage"
+    policy: ResiliencePolicy | None = None
+    # whether _transform is implemented; without it images have no variants
+    transforms = False
+
+    def _call(self, operation: str, func: Callable[..., Any], *args) -> Any:
+        # every operation of the interface is idempotent: keys are content hashes, deleting twice is not an error
+        if self.policy is None:
+            return func(*args)
+        return self.policy.call(operation, func, *args, idempotent=True)
+
+    @traced("storage")
+    @timed("put", STORAGE_LATENCY, STORAGE_ERRORS)
+    def put(self, file: BinaryIO, key: str, content_type: str | None = None) -> str:
+        """
+        The put function stores a file under a key. Storing the same key again keeps a single object.
+
+        :param file: BinaryIO: The content, read from its current position
+        :param key: str: The object key
+        :param content_type: str: The MIME type of the content
+        :return: The URL of the object
+        """
+        check_key(key)
+        start = file.tell()
+
+        def attempt() -> str:
+            file.seek(start)
+            return self._put(file, key, content_type)
+
+        return self._call("put", attempt)
+
+    def get(self, key: str, offset: int = 0, length: int | None = None) -> Iterator[bytes]:
+        """
+        The get function reads an object, or a byte range of it, in chunks.
+
+        :param key: str: The object key
+        :param offset: int: The first byte to read
+        :param length: int: The number of bytes to read, all the remaining bytes if None
+        :return: An iterator of chunks; FileNotFoundError is raised if the object does not exist
+        """
+        return self._call("get", self._get, check_key(key), offset, length)
+
+    @traced("storage")
+    @timed("delete", STORAGE_LATENCY, STORAGE_ERRORS)
+    def delete(self, key: str) -> None:
+        """
+        The delete function deletes an object; deleting a missing object is not an error.
+
+        :param key: str: The object key
+        :return: None
+        """
+        self._call("delete", self._delete, check_key(key))
+
+    @traced("storage")
+    @timed("stat", STORAGE_LATENCY, STORAGE_ERRORS)
+    def stat(self, key: str) -> StoredObject | None:
+        """
+        The stat function reads the size, type and version of an object.
+
+        :param key: str: The object key
+        :return: The object metadata, or None if it does not exist
+        """
+        return self._call("stat", self._stat, check_key(key))
+
+    @abc.abstractmethod
+    def url(self, key: str) -> str:
+        """
+        The url function returns the public URL of an object.
+
+        :param key: str: The object key
+        :return: The URL
+        """
+
+    @abc.abstractmethod
+    def key(self, url: str) -> str | None:
+        """
+        The key function returns the key of an object from its URL, the inverse of url.
+
+        :param url: str: The URL
+        :return: The key, or None if the URL does not belong to this storage
+        """
+
+    def request_for(self, method: str, key: str, headers: dict[str, str] | None = None) -> tuple[str, dict[str, str]]:
+        """
+        The request_for function returns the URL and the headers of an HTTP request reading an object,
+        for callers streaming it with their own client.
+
+        :param method: str: The HTTP method, GET or HEAD
+        :param key: str: The object key
+        :param headers: dict: Extra headers, e.g. Range
+        :return: The URL and the headers, signed if the driver needs it
+        """
+        return self.url(check_key(key)), dict(headers or {})
+
+    def transform(self, url: str, params: dict) -> str | None:
+        """
+        The transform function returns the URL of a transformed image, if the driver can transform images.
+        A failed transformation is logged, callers fall back to the source image.
+
+        :param url: str: The URL of the source image
+        :param params: dict: The transformation parameters
+        :return: The URL of the transformed image, or None
+        """
+        try:
+            return self._call("transform", self._transform, url, params)
+        except Exception as err:
+            logger.error("Error transforming %s with %s: %s", url, params, err)
+            return None
+
+    def _transform(self, url: str, params: dict) -> str | None:
+        return None
+
+    @abc.abstractmethod
+    def _put(self, file: BinaryIO, key: str, content_type: str | None) -> str:
+        ...
+
+    @abc.abstractmethod
+    def _get(self, key: str, offset: int, length: int | None) -> Iterator[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def _delete(self, key: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    def _stat(self, key: str) -> StoredObject | None:
+        ...
+
+
+class LocalStorage(Storage):
+    """
+    Objects stored as files under a root directory, two levels of directories named after the start of the hash.
+    """
+    name = "local"
+
+    def __init__(self, root: str, base_url: str):
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+
+    def path(self, key: str) -> str:
+        """
+        The path function returns the file of an object, e.g. ``<root>/avatars/ab/cd/abcd....png``.
+
+        :param key: str: The object key
+        :return: The file path; ValueError is raised for invalid keys
+        """
+        directory, name = os.path.split(check_key(key))
+        shard = (name[:2], name[2:4]) if len(name) > 4 else ()
+        return os.path.join(self.root, directory, *shard, name)
+
+    def _put(self, file: BinaryIO, key: str, content_type: str | None) -> str:
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    shutil.copyfileobj(file, out, CHUNK_SIZE)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return self.url(key)
+
+    def _get(self, key: str, offset: int, length: int | None) -> Iterator[bytes]:
+        f = open(self.path(key), "rb")
+
+        def read():
+            with f:
+                f.seek(offset)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        return
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+
+        return read()
+
+    def _delete(self, key: str) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _stat(self, key: str) -> StoredObject | None:
+        try:
+            st = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        content_type = mimetypes.guess_type(key)[0] or "application/octet-stream"
+        return StoredObject(key, st.st_size, content_type, f'"{st.st_size:x}-{st.st_mtime_ns:x}"', st.st_mtime)
+
+    def url(self, key: str) -> str:
+        return f"{self.base_url}/{key}"
+
+    def key(self, url: str) -> str | None:
+        prefix = f"{self.base_url}/"
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+
+class S3Storage(Storage):
+    """
+    Objects stored in a bucket of an S3-compatible service, with path-style requests signed with Signature V4.
+    """
+    name = "s3"
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str | None, secret_key: str | None,
+                 region: str = "us-east-1", public_url: str | None = None, timeout: float = 30.0,
+                 policy: ResiliencePolicy | None = None):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.public_url = (public_url or f"{self.endpoint}/{bucket}").rstrip("/")
+        self.timeout = timeout
+        self.policy = policy
+        self.client = httpx.Client(timeout=timeout)
+
+    def _path(self, key: str) -> str:
+        return quote(f"/{self.bucket}/{key}" if key else f"/{self.bucket}", safe="/-_.~")
+
+    def _signed(self, method: str, key: str, headers: dict[str, str]) -> dict[str, str]:
+        now = datetime.now(timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        headers = {name.lower(): value for name, value in headers.items()}
+        headers.update({
+            "host": urlsplit(self.endpoint).netloc,
+            "x-amz-date": amz_date,
+            "x-amz-content-sha256": "UNSIGNED-PAYLOAD",
+        })
+        if not self.access_key:
+            return headers
+        signed = sorted(headers)
+        canonical = "\n".join([
+            method,
+            self._path(key),
+            "",
+            "".join(f"{name}:{headers[name].strip()}\n" for name in signed),
+            ";".join(signed),
+            "UNSIGNED-PAYLOAD",
+        ])
+        scope = f"{amz_date[:8]}/{self.region}/s3/aws4_request"
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical.encode()).hexdigest()
+        ])
+        signing_key = f"AWS4{self.secret_key}".encode()
+        for part in (amz_date[:8], self.region, "s3", "aws4_request"):
+            signing_key = hmac.new(signing_key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(signing_key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+        headers["authorization"] = (
+            f"AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, "
+            f"SignedHeaders={';'.join(signed)}, Signature={signature}"
+        )
+        return headers
+
+    def _request(self, method: str, key: str, headers: dict[str, str] | None = None, **kwargs) -> httpx.Response:
+        return self.client.request(method, f"{self.endpoint}{self._path(key)}",
+                                   headers=self._signed(method, key, headers or {}),
+                                   timeout=call_timeout(self.timeout), **kwargs)
+
+    def request_for(self, method: str, key: str, headers: dict[str, str] | None = None) -> tuple[str, dict[str, str]]:
+        return f"{self.endpoint}{self._path(check_key(key))}", self._signed(method, key, headers or {})
+
+    def _put(self, file: BinaryIO, key: str, content_type: str | None) -> str:
+        start = file.tell()
+        size = file.seek(0, os.SEEK_END) - start
+        headers = {"content-length": str(size), "content-type": content_type or "application/octet-stream"}
+        for attempt in range(2):
+            file.seek(start)
+            response = self._request("PUT", key, headers, content=iter(lambda: file.read(CHUNK_SIZE), b""))
+            if response.status_code == 404 and b"NoSuchBucket" in response.content and not attempt:
+                # a fresh MinIO has no bucket yet
+                self._request("PUT", "", {"content-length": "0"}).raise_for_status()
+                continue
+            response.raise_for_status()
+            return self.url(key)
+
+    def _get(self, key: str, offset: int, length: int | None) -> Iterator[bytes]:
+        headers = {}
+        if offset or length is not None:
+            headers["range"] = f"bytes={offset}-{'' if length is None else offset + length - 1}"
+        request = self.client.build_request("GET", f"{self.endpoint}{self._path(key)}",
+                                            headers=self._signed("GET", key, headers),
+                                            timeout=call_timeout(self.timeout))
+        response = self.client.send(request, stream=True)
+        if response.status_code == 404:
+            response.close()
+            raise FileNotFoundError(key)
+        if response.is_error:
+            response.read()
+            response.raise_for_status()
+
+        def read():
+            try:
+                yield from response.iter_bytes(CHUNK_SIZE)
+            finally:
+                response.close()
+
+        return read()
+
+    def _delete(self, key: str) -> None:
+        response = self._request("DELETE", key)
+        if response.status_code != 404:
+            response.raise_for_status()
+
+    def _stat(self, key: str) -> StoredObject | None:
+        response = self._request("HEAD", key)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        modified = response.headers.get("last-modified")
+        return StoredObject(
+            key,
+            int(response.headers.get("content-length", 0)),
+            response.headers.get("content-type", "application/octet-stream"),
+            response.headers.get("etag", ""),
+            datetime.strptime(modified, "%a, %d %b %Y %H:%M:%S GMT").replace(tzinfo=timezone.utc).timestamp()
+            if modified else 0.0,
+        )
+
+    def url(self, key: str) -> str:
+        return f"{self.public_url}/{key}"
+
+    def key(self, url: str) -> str | None:
+        prefix = f"{self.public_url}/"
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+
+class CloudinaryStorage(Storage):
+    """
+    Objects stored as Cloudinary assets; the public ID of an object is its key without the extension.
+    """
+    name = "cloudinary"
+    transforms = True
+
+    def __init__(self, timeout: float = 30.0, policy: ResiliencePolicy | None = None):
+        self.timeout = timeout
+        self.policy = policy
+        self.client = httpx.Client(timeout=timeout, follow_redirects=True)
+
+    def _put(self, file: BinaryIO, key: str, content_type: str | None) -> str:
+        return upload_image(file, public_id=os.path.splitext(key)[0], timeout=call_timeout(self.timeout))
+
+    def _get(self, key: str, offset: int, length: int | None) -> Iterator[bytes]:
+        headers = {}
+        if offset or length is not None:
+            headers["range"] = f"bytes={offset}-{'' if length is None else offset + length - 1}"
+        request = self.client.build_request("GET", self.url(key), headers=headers, timeout=call_timeout(self.timeout))
+        response = self.client.send(request, stream=True)
+        if response.status_code == 404:
+            response.close()
+            raise FileNotFoundError(key)
+        if response.is_error:
+            response.read()
+            response.raise_for_status()
+
+        def read():
+            try:
+                yield from response.iter_bytes(CHUNK_SIZE)
+            finally:
+                response.close()
+
+        return read()
+
+    def _delete(self, key: str) -> None:
+        delete_image(self.url(key), timeout=call_timeout(self.timeout))
+
+    def _stat(self, key: str) -> StoredObject | None:
+        info = resource_info(os.path.splitext(key)[0], timeout=call_timeout(self.timeout))
+        if info is None:
+            return None
+        modified = datetime.strptime(info["created_at"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+        return StoredObject(key, info["bytes"], f"{info['resource_type']}/{info['format']}",
+                            f'"{info["etag"]}"', modified.timestamp())
+
+    def url(self, key: str) -> str:
+        return build_image_url(os.path.splitext(key)[0])
+
+    def key(self, url: str) -> str | None:
+        return get_public_id(url)
+
+    def _transform(self, url: str, params: dict) -> str | None:
+        return transform_image(url, params, timeout=call_timeout(self.timeout))
+
+
+def is_cloudinary_transient(err: BaseException) -> bool:
+    """
+    The is_cloudinary_transient function tells whether a Cloudinary call may be retried: besides the errors of
+    is_transient, the SDK raises GeneralError for failed connections and 5xx responses, RateLimited for 420.
+
+    :param err: BaseException: The error
+    :return: True if the call may be retried
+    """
+    return is_transient(err) or isinstance(err, (cloudinary.exceptions.GeneralError,
+                                                 cloudinary.exceptions.RateLimited))
+
+
+def resilience_policy(name: str, transient: Callable[[BaseException], bool] = is_transient) -> ResiliencePolicy:
+    """
+    The resilience_policy function builds the policy of a remote driver from the configuration.
+
+    :param name: str: The driver, for the metrics
+    :param transient: Callable: Tells whether an error of the driver may be retried
+    :return: The policy
+    """
+    breaker = CircuitBreaker(name, config.BREAKER_FAILURE_RATE, config.BREAKER_MIN_CALLS, config.BREAKER_WINDOW,
+                             config.BREAKER_OPEN_FOR)
+    return ResiliencePolicy(name, config.STORAGE_TIMEOUT, config.STORAGE_RETRIES, config.STORAGE_RETRY_BACKOFF,
+                            breaker=breaker, transient=transient)
+
+
+def create_storage(driver: str) -> Storage:
+    """
+    The create_storage function builds the driver named in the configuration.
+
+    :param driver: str: "cloudinary", "local" or "s3"
+    :return: The storage
+    """
+    if driver == "local":
+        return LocalStorage(config.LOCAL_STORAGE_ROOT, config.LOCAL_STORAGE_URL)
+    if driver == "s3":
+        return S3Storage(config.S3_ENDPOINT, config.S3_BUCKET, config.S3_ACCESS_KEY, config.S3_SECRET_KEY,
+                         config.S3_REGION, config.S3_PUBLIC_URL, config.STORAGE_TIMEOUT, resilience_policy("s3"))
+    if driver == "cloudinary":
+        return CloudinaryStorage(config.STORAGE_TIMEOUT, resilience_policy("cloudinary", is_cloudinary_transient))
+    raise ValueError(f"Unknown storage driver: {driver!r}")
+
+
+storage = create_storage(config.STORAGE_DRIVER)
+
+
+def upload(file: BinaryIO, content_type: str | None = None, namespace: str | None = None) -> str:
+    """
+    The upload function stores a file under the hash of its content.
+
+    :param file: BinaryIO: The file, rewound after hashing
+    :param content_type: str: The MIME type of the file
+    :param namespace: str: A directory for the key, e.g. "avatars"
+    :return: The URL of the stored file
+    """
+    sha256, _ = hash_file(file)
+    return storage.put(file, object_key(sha256, content_type, namespace), content_type)
+
+
+def parse_range(header: str | None, size: int) -> list[tuple[int, int]] | None:
+    """
+    The parse_range function reads the byte ranges of a Range header.
+
+    >>> parse_range("bytes=0-99,-10,500-", 1000)
+    [(0, 99), (990, 999), (500, 999)]
+    >>> parse_range("bytes=2000-", 1000)
+    []
+
+    :param header: str: The value of the Range header
+    :param size: int: The size of the content
+    :return: The (first, last) byte positions, inclusive; an empty list if no range is satisfiable,
+        None if there is no header or it is malformed, in which case the whole content is sent
+    """
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    for part in header[6:].split(","):
+        first, dash, last = part.strip().partition("-")
+        if not dash or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) \
+                or (last and not last.isdigit()):
+            return None
+        if not first:
+            if int(last) == 0:
+                continue
+            first, last = max(size - int(last), 0), size - 1
+        else:
+            first, last = int(first), min(int(last), size - 1) if last else size - 1
+            if first > last:
+                if first < size:
+                    return None
+                continue
+        ranges.append((first, last))
+    return ranges
+
+
+class RangeFileResponse(Response):
+    """
+    A file response honouring a single byte range (several ranges get the whole file), sent with the ASGI
+    zero-copy extension when the server supports it, otherwise read in chunks.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, stat: StoredObject, range_header: str | None = None, method: str = "GET",
+                 headers: dict[str, str] | None = None):
+        self.path = path
+        self.background = None
+        self.send_body = method != "HEAD"
+        self.media_type = stat.content_type
+        self.start, self.length = 0, stat.size
+        ranges = parse_range(range_header, stat.size)
+        headers = {
+            "accept-ranges": "bytes",
+            "etag": stat.etag,
+            "last-modified": formatdate(stat.modified, usegmt=True),
+            **(headers or {}),
+        }
+        if ranges == []:
+            self.status_code, self.length = 416, 0
+            headers["content-range"] = f"bytes */{stat.size}"
+        elif ranges is not None and len(ranges) == 1:
+            first, last = ranges[0]
+            self.status_code, self.start, self.length = 206, first, last - first + 1
+            headers["content-range"] = f"bytes {first}-{last}/{stat.size}"
+        else:
+            self.status_code = 200
+        headers["content-length"] = str(self.length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if not self.send_body or not self.length:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        if "http.response.zerocopysend" in scope.get("extensions", {}):
+            with open(self.path, "rb") as f:
+                await send({"type": "http.response.zerocopysend", "file": f, "offset": self.start,
+                            "count": self.length, "more_body": False})
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            await f.seek(self.start)
+            remaining = self.length
+            while remaining > 0:
+                chunk = await f.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+        if remaining > 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,186 @@
+"""
+Tag co-occurrence graph for related tags and tag suggestions.
+
+The graph is the sparse matrix ``C = Aᵀ·A`` where ``A`` is the photo × tag incidence matrix of ``photo_tags``:
+``C[i, j]`` counts the photos carrying both tags and the diagonal counts the photos of each tag.
+Tag links changed through the photo repository are applied as sparse deltas on every worker.
+"""
+import logging
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.entity.models import Tag, photo_tags
+from src.services.invalidation import invalidation_bus
+from src.services.tag_index import tag_index
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+METRICS = ("jaccard", "pmi")
+
+
+def cooccurrence(links: np.ndarray, size: int) -> tuple[sparse.csr_matrix, int]:
+    """
+    The cooccurrence function builds the tag co-occurrence matrix from (photo ID, tag ID) links.
+
+    :param links: np.ndarray: An (n, 2) array of links
+    :param size: int: The number of rows and columns, greater than the largest tag ID
+    :return: The matrix and the number of tagged photos
+    """
+    if not len(links):
+        return sparse.csr_matrix((size, size), dtype=np.int64), 0
+    photos, rows = np.unique(links[:, 0], return_inverse=True)
+    incidence = sparse.csr_matrix(
+        (np.ones(len(links), dtype=np.int64), (rows, links[:, 1])), shape=(len(photos), size)
+    )
+    return (incidence.T @ incidence).tocsr(), len(photos)
+
+
+class TagGraph:
+    """
+    The tag co-occurrence matrix of this worker, with Jaccard and PMI scores computed on whole rows at once.
+    """
+
+    def __init__(self):
+        self.ids: dict[str, int] = {}
+        self.names: dict[int, str] = {}
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.int64)
+        self.photos = 0
+        self._pending: list[tuple[np.ndarray, int]] = []
+
+    async def load(self, db: AsyncSession) -> None:
+        """
+        The load function builds the matrix from the tags and the photo_tags table.
+
+        :param db: AsyncSession: The database session
+        :return: None
+        """
+        for tag_id, name in await db.execute(select(Tag.id, Tag.name)):
+            self._register(tag_id, name)
+        links = np.array((await db.execute(select(photo_tags.c.photo_id, photo_tags.c.tag_id))).all(),
+                         dtype=np.int64).reshape(-1, 2)
+        self.matrix, self.photos = cooccurrence(links, max(self.names, default=-1) + 1)
+        self._pending.clear()
+        logger.info("Tag graph loaded with %d tags and %d links", len(self.names), len(links))
+
+    def _register(self, tag_id: int, name: str | None) -> None:
+        if name is not None and self.names.get(tag_id) != name:
+            self.names[tag_id] = name
+            self.ids[name] = tag_id
+
+    def apply(self, old: list, new: list) -> None:
+        """
+        The apply function records that the tags of a photo changed; the matrix is updated on the next read.
+
+        :param old: list: The (ID, name) pairs of the tags before the change
+        :param new: list: The (ID, name) pairs of the tags after the change
+        :return: None
+        """
+        for tag_id, name in new:
+            self._register(tag_id, name)
+        for tags, sign in ((old, -1), (new, 1)):
+            if tags:
+                self._pending.append((np.array([tag_id for tag_id, _ in tags], dtype=np.int64), sign))
+        self.photos += bool(new) - bool(old)
+
+    def _merge(self) -> None:
+        size = max(self.matrix.shape[0], max(self.names, default=-1) + 1)
+        if self.matrix.shape[0] < size:
+            self.matrix.resize((size, size))
+        if not self._pending:
+            return
+        # every changed photo contributes the outer product of its tag set, with sign -1 or +1
+        rows = np.concatenate([np.repeat(ids, len(ids)) for ids, _ in self._pending])
+        cols = np.concatenate([np.tile(ids, len(ids)) for ids, _ in self._pending])
+        values = np.concatenate([np.full(len(ids) ** 2, sign, dtype=np.int64) for ids, sign in self._pending])
+        self._pending.clear()
+        delta = sparse.csr_matrix((values, (rows, cols)), shape=(size, size))
+        self.matrix = (self.matrix + delta).tocsr()
+        self.matrix.eliminate_zeros()
+
+    def _scores(self, tag_id: int, columns: np.ndarray, together: np.ndarray, metric: str) -> np.ndarray:
+        counts = self.matrix.diagonal()
+        own, other = counts[tag_id], counts[columns]
+        if metric == "pmi":
+            return np.log(together * max(self.photos, 1) / np.maximum(own * other, 1))
+        return together / np.maximum(own + other - together, 1)
+
+    def related(self, name: str, limit: int = 10, metric: str = "jaccard") -> list[dict] | None:
+        """
+        The related function lists the tags used on the same photos as a tag, best score first.
+
+        :param name: str: The tag name
+        :param limit: int: The number of tags to return
+        :param metric: str: "jaccard" or "pmi"
+        :return: A list of dictionaries with the name, the score and the number of shared photos,
+            or None if the tag does not exist
+        """
+        tag_id = self.ids.get(name)
+        if tag_id is None:
+            return None
+        self._merge()
+        row = self.matrix.getrow(tag_id)
+        keep = (row.indices != tag_id) & (row.data > 0)
+        columns, together = row.indices[keep], row.data[keep]
+        if not len(columns):
+            return []
+        scores = self._scores(tag_id, columns, together, metric)
+        top = np.argsort(-scores, kind="stable")[:limit]
+        return [
+            {"name": self.names[int(columns[i])], "score": float(scores[i]), "count": int(together[i])}
+            for i in top
+        ]
+
+    def suggest(self, prefix: str, context: list[str] = (), limit: int = 10) -> list[dict]:
+        """
+        The suggest function completes a tag prefix. Candidates are ranked by their Jaccard scores with the tags
+        already chosen, then by the number of photos using them. Only the tags used with the chosen ones can score,
+        so the candidates are those tags plus the most used tags of the prefix index.
+
+        :param prefix: str: The beginning of the tag
+        :param context: list[str]: The tags already on the photo
+        :param limit: int: The number of tags to return
+        :return: A list of dictionaries with the name, the score and the number of photos
+        """
+        self._merge()
+        context_ids = np.array([self.ids[name] for name in context if name in self.ids], dtype=np.int64)
+        candidates = np.array([tag_id for tag_id, _, _ in tag_index.top(prefix, limit + len(context_ids))],
+                              dtype=np.int64)
+        if len(context_ids):
+            together = np.unique(self.matrix[context_ids].indices)
+            candidates = np.union1d(candidates, together[tag_index.matches(prefix, together)])
+        candidates = candidates[~np.isin(candidates, context_ids)]
+        counts = self.matrix.diagonal()
+        popularity = tag_index.count(candidates)
+        scores = np.zeros(len(candidates))
+        if len(context_ids) and len(candidates):
+            together = self.matrix[context_ids][:, candidates].toarray()
+            union = counts[context_ids][:, None] + counts[candidates][None, :] - together
+            scores = (together / np.maximum(union, 1)).sum(axis=0)
+        names = [self.names[int(tag_id)] for tag_id in candidates]
+        top = np.lexsort((np.array(names, dtype=str), -popularity, -scores))[:limit]
+        return [{"name": names[i], "score": float(scores[i]), "count": int(popularity[i])} for i in top]
+
+    def _on_event(self, key: str, payload: dict) -> None:
+        self.apply(payload.get("old") or [], payload.get("new") or [])
+
+    def publish(self, photo_id: int, old: list[tuple[int, str]], new: list[tuple[int, str]]) -> None:
+        """
+        The publish function applies a change of the tags of a photo on every worker.
+
+        :param photo_id: int: The photo
+        :param old: list: The (ID, name) pairs of the tags before the change
+        :param new: list: The (ID, name) pairs of the tags after the change
+        :return: None
+        """
+        if sorted(old) != sorted(new):
+            invalidation_bus.notify("photo_tags", str(photo_id), old=old, new=new)
+
+
+tag_graph = TagGraph()
+invalidation_bus.subscribe("photo_tags", tag_graph._on_event)
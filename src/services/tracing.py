@@ -0,0 +1,318 @@
+"""
+Lightweight request tracing: spans of SQL statements, Redis commands, Cloudinary calls and bcrypt.
+
+A sample of the requests (TRACE_SAMPLE_RATE) is traced, as well as the requests carrying the header
+``X-Debug-Trace: <TRACE_DEBUG_TOKEN>``. Only those responses carry a ``Server-Timing`` header; their traces are
+exported as OTLP/JSON when TRACE_EXPORT_PATH or TRACE_OTLP_ENDPOINT is set.
+"""
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from src.conf.config import config
+
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    The spans recorded while serving one request.
+
+    Spans are kept as plain tuples ``(category, name, start_ns, duration_ns)`` to keep recording cheap;
+    they are only turned into Server-Timing entries or OTLP JSON once the response has started.
+    """
+    __slots__ = ("trace_id", "name", "start_ns", "wall_start_ns", "end_ns", "spans", "status")
+
+    def __init__(self, name: str):
+        self.trace_id = os.urandom(16).hex()
+        self.name = name
+        self.start_ns = time.perf_counter_ns()
+        self.wall_start_ns = time.time_ns()
+        self.end_ns = None
+        self.spans = []
+        self.status = None
+
+    def add(self, category: str, name: str, start_ns: int, duration_ns: int) -> None:
+        self.spans.append((category, name, start_ns, duration_ns))
+
+    def totals(self) -> dict[str, tuple[int, int]]:
+        """
+        The totals function sums the spans of the trace by category.
+
+        :return: A dictionary mapping each category to its span count and total duration in nanoseconds
+        """
+        totals = {}
+        for category, _, _, duration in self.spans:
+            count, total = totals.get(category, (0, 0))
+            totals[category] = (count + 1, total + duration)
+        return totals
+
+    def server_timing(self) -> str:
+        """
+        The server_timing function renders the trace as a Server-Timing header value.
+
+        :return: The header value, e.g. ``db;dur=3.1;desc="2 calls", total;dur=9.8``
+        """
+        entries = [
+            f'{category};dur={total / 1e6:.2f};desc="{count} calls"'
+            for category, (count, total) in self.totals().items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter_ns() - self.start_ns) / 1e6:.2f}")
+        return ", ".join(entries)
+
+    def to_otlp(self) -> dict:
+        """
+        The to_otlp function converts the trace into an OTLP/JSON ``ExportTraceServiceRequest``.
+
+        :return: A dictionary ready to be serialized as JSON
+        """
+        def wall(ns):
+            return str(self.wall_start_ns + ns - self.start_ns)
+
+        root_id = os.urandom(8).hex()
+        spans = [{
+            "traceId": self.trace_id,
+            "spanId": root_id,
+            "name": self.name,
+            "kind": 2,
+            "startTimeUnixNano": wall(self.start_ns),
+            "endTimeUnixNano": wall(self.end_ns or time.perf_counter_ns()),
+            "attributes": [{"key": "http.status_code", "value": {"intValue": str(self.status or 0)}}],
+        }]
+        for category, name, start, duration in self.spans:
+            spans.append({
+                "traceId": self.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 3,
+                "startTimeUnixNano": wall(start),
+                "endTimeUnixNano": wall(start + duration),
+                "attributes": [{"key": "component", "value": {"stringValue": category}}],
+            })
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": config.TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+        }]}
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+
+
+@contextmanager
+def span(category: str, name: str | None = None):
+    """
+    The span function records the time spent in its block on the current trace, if any.
+
+    :param category: str: The Server-Timing category, e.g. "db", "redis", "cloudinary" or "bcrypt"
+    :param name: str: The span name, defaults to the category
+    :return: A context manager
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        trace.add(category, name or category, start, time.perf_counter_ns() - start)
+
+
+def traced(category: str):
+    """
+    The traced function is a decorator recording every call of a sync or async function as a span.
+
+    :param category: str: The Server-Timing category of the span
+    :return: The decorator
+    """
+    def decorator(func):
+        name = func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                trace = current_trace.get()
+                if trace is None:
+                    return await func(*args, **kwargs)
+                start = time.perf_counter_ns()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    trace.add(category, name, start, time.perf_counter_ns() - start)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current_trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(category, name, start, time.perf_counter_ns() - start)
+        return wrapper
+
+    return decorator
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    The instrument_engine function records every statement executed by the engine as a "db" span.
+
+    :param engine: AsyncEngine: The engine to instrument
+    :return: None
+    """
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_trace.get() is not None:
+            conn.info.setdefault("trace_start", []).append(time.perf_counter_ns())
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        trace = current_trace.get()
+        if trace is None or not conn.info.get("trace_start"):
+            return
+        start = conn.info["trace_start"].pop()
+        trace.add("db", statement.split(None, 1)[0].upper(), start, time.perf_counter_ns() - start)
+
+
+def instrument_redis(client) -> None:
+    """
+    The instrument_redis function records the commands and pipelines of a synchronous Redis client
+    as "redis" spans.
+
+    :param client: redis.Redis: The client to instrument
+    :return: None
+    """
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    @functools.wraps(execute_command)
+    def traced_execute_command(*args, **kwargs):
+        with span("redis", str(args[0]) if args else None):
+            return execute_command(*args, **kwargs)
+
+    @functools.wraps(pipeline)
+    def traced_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def traced_execute(*a, **kw):
+            with span("redis", "PIPELINE"):
+                return execute(*a, **kw)
+
+        pipe.execute = traced_execute
+        return pipe
+
+    client.execute_command = traced_execute_command
+    client.pipeline = traced_pipeline
+
+
+class TraceExporter:
+    """
+    Ships finished traces as OTLP/JSON to a local file (one request per line) and/or an OTLP/HTTP collector.
+    Exporting happens in a background thread so it never delays a response.
+    """
+
+    def __init__(self, path: str | None = None, endpoint: str | None = None, maxsize: int = 1000):
+        self.path = path
+        self.endpoint = endpoint
+        self._queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path or self.endpoint)
+
+    def submit(self, trace: Trace) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning("Trace export queue is full, dropping trace %s", trace.trace_id)
+
+    def _run(self) -> None:
+        while True:
+            trace = self._queue.get()
+            try:
+                body = json.dumps(trace.to_otlp())
+                if self.path:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(body + "\n")
+                if self.endpoint:
+                    request = urllib.request.Request(
+                        self.endpoint.rstrip("/") + "/v1/traces",
+                        data=body.encode(),
+                        headers={"Content-Type": "application/json"},
+                    )
+                    urllib.request.urlopen(request, timeout=5).close()
+            except Exception as err:
+                logger.error("Error exporting trace %s: %s", trace.trace_id, err)
+
+
+exporter = TraceExporter(path=config.TRACE_EXPORT_PATH, endpoint=config.TRACE_OTLP_ENDPOINT)
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware tracing a sample of the HTTP requests, and the debug requests.
+    Traced responses carry a ``Server-Timing`` header with the time spent per category, the others are untouched.
+    """
+    debug_header = b"x-debug-trace"
+
+    def __init__(self, app, sample_rate: float = config.TRACE_SAMPLE_RATE,
+                 debug_token: str | None = config.TRACE_DEBUG_TOKEN):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.debug_token = debug_token.encode() if debug_token else None
+
+    def _debug(self, scope) -> bool:
+        if self.debug_token is None:
+            return False
+        for name, value in scope.get("headers", ()):
+            if name == self.debug_header:
+                return hmac.compare_digest(value, self.debug_token)
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not (
+                self.sample_rate > 0 and random.random() < self.sample_rate or self._debug(scope)):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f'{scope["method"]} {scope["path"]}')
+        token = current_trace.set(trace)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                trace.status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", trace.server_timing().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            trace.end_ns = time.perf_counter_ns()
+            current_trace.reset(token)
+            if exporter.enabled:
+                exporter.submit(trace)
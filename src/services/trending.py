@@ -0,0 +1,151 @@
+"""
+Trending photos: comments and views with an exponentially decaying weight.
+
+Scores use forward decay: an event at time ``t`` adds ``weight · exp((t - epoch) / tau)`` to the photo, so older
+events weigh relatively less without touching them, and the order of the set is the order of the decayed scores.
+When the exponent grows too large, the write that notices it rescales every score once and moves the epoch to now;
+there is no periodic recompute. Scores live in a Redis sorted set, or in a heap-ranked dictionary of the worker
+when Redis is unavailable.
+"""
+import heapq
+import logging
+import math
+import time
+
+from redis.exceptions import RedisError
+
+from src.conf.config import config
+from src.database.cache import redis_client
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+# Adds a decayed weight to a member of the sorted set, rescaling the set first when the exponent is too large,
+# and trims the set to its maximal size. Returns the number of entries rescaled.
+RECORD_SCRIPT = """
+local now = tonumber(ARGV[1])
+local tau = tonumber(ARGV[4])
+local epoch = tonumber(redis.call('GET', KEYS[2]))
+local rescaled = 0
+if not epoch then
+    epoch = now
+    redis.call('SET', KEYS[2], ARGV[1])
+elseif (now - epoch) / tau > tonumber(ARGV[5]) then
+    rescaled = redis.call('ZCARD', KEYS[1])
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', tostring(math.exp((epoch - now) / tau)))
+    epoch = now
+    redis.call('SET', KEYS[2], ARGV[1])
+end
+redis.call('ZINCRBY', KEYS[1], tonumber(ARGV[3]) * math.exp((now - epoch) / tau), ARGV[2])
+if redis.call('ZCARD', KEYS[1]) > tonumber(ARGV[6]) then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -tonumber(ARGV[6]) - 1)
+end
+return rescaled
+"""
+
+MAX_EXPONENT = 30
+
+
+class Trending:
+    """
+    Decayed popularity scores of the photos, in Redis or, as a fallback or without a cache, in this worker.
+    """
+    key = "trending"
+
+    def __init__(self, cache=redis_client, half_life: float = 6 * 3600, weights: dict[str, float] | None = None,
+                 maxsize: int = 10000):
+        self.cache = cache
+        self.tau = half_life / math.log(2)
+        self.weights = weights or {"comment": 1.0, "view": 0.1}
+        self.maxsize = maxsize
+        self.writes = 0
+        self.scores: dict[int, float] = {}
+        self.epoch: float | None = None
+        self._record = cache.register_script(RECORD_SCRIPT) if cache is not None else None
+
+    def record(self, photo_id: int, event: str, now: float | None = None) -> None:
+        """
+        The record function adds an event to the score of a photo.
+
+        :param photo_id: int: The photo
+        :param event: str: The kind of event, a key of the weights, e.g. "comment" or "view"
+        :param now: float: The time of the event, defaults to the current time
+        :return: None
+        """
+        now = time.time() if now is None else now
+        weight = self.weights[event]
+        if self.cache is None:
+            rescaled = self._record_local(photo_id, weight, now)
+        else:
+            try:
+                rescaled = self._record(keys=[self.key, f"{self.key}:epoch"],
+                                        args=[now, photo_id, weight, self.tau, MAX_EXPONENT, self.maxsize])
+            except RedisError as err:
+                logger.warning("Redis unavailable, recording trending event in memory: %s", err)
+                rescaled = self._record_local(photo_id, weight, now)
+        self.writes += 1 + int(rescaled)
+
+    def _record_local(self, photo_id: int, weight: float, now: float) -> int:
+        rescaled = 0
+        if self.epoch is None:
+            self.epoch = now
+        elif (now - self.epoch) / self.tau > MAX_EXPONENT:
+            factor = math.exp((self.epoch - now) / self.tau)
+            self.scores = {key: score * factor for key, score in self.scores.items()}
+            rescaled, self.epoch = len(self.scores), now
+        self.scores[photo_id] = self.scores.get(photo_id, 0.0) + weight * math.exp((now - self.epoch) / self.tau)
+        if len(self.scores) > 2 * self.maxsize:
+            self.scores = dict(heapq.nlargest(self.maxsize, self.scores.items(), key=lambda item: item[1]))
+        return rescaled
+
+    def top(self, offset: int = 0, limit: int = 20, now: float | None = None) -> list[tuple[int, float]]:
+        """
+        The top function reads a page of the trending photos.
+
+        :param offset: int: The number of photos to skip
+        :param limit: int: The number of photos to return
+        :param now: float: The time the scores are decayed to, defaults to the current time
+        :return: A list of (photo ID, score), highest score first; the score is in weighted events
+        """
+        now = time.time() if now is None else now
+        epoch, page = self.epoch, None
+        if self.cache is not None:
+            try:
+                pipe = self.cache.pipeline()
+                pipe.get(f"{self.key}:epoch")
+                pipe.zrevrange(self.key, offset, offset + limit - 1, withscores=True)
+                epoch, page = pipe.execute()
+                page = [(int(member), score) for member, score in page]
+            except RedisError as err:
+                logger.warning("Redis unavailable, reading trending photos from memory: %s", err)
+                epoch = self.epoch
+        if page is None:
+            page = heapq.nlargest(offset + limit, self.scores.items(), key=lambda item: item[1])[offset:]
+        if epoch is None:
+            return []
+        decay = math.exp((float(epoch) - now) / self.tau)
+        return [(photo_id, score * decay) for photo_id, score in page]
+
+    def remove(self, photo_id: int) -> None:
+        """
+        The remove function drops a deleted photo from the trending photos.
+
+        :param photo_id: int: The photo
+        :return: None
+        """
+        self.scores.pop(photo_id, None)
+        if self.cache is None:
+            return
+        try:
+            self.cache.zrem(self.key, photo_id)
+        except RedisError as err:
+            logger.warning("Redis unavailable, cannot remove trending photo: %s", err)
+
+
+trending = Trending(
+    half_life=config.TRENDING_HALF_LIFE,
+    weights={"comment": config.TRENDING_COMMENT_WEIGHT, "view": config.TRENDING_VIEW_WEIGHT},
+    maxsize=config.TRENDING_MAX_SIZE,
+)
@@ -0,0 +1,258 @@
+"""
+Resumable uploads in the style of the tus protocol (https://tus.io/protocols/resumable-upload).
+
+A client creates an upload with the total length of the file, then sends the bytes in PATCH requests starting at
+the current offset. Received bytes are appended to a staging file as they arrive, so when a connection drops the
+bytes already received are kept and the client asks for the offset (HEAD) and continues from there. The offset is
+the size of the staging file; nothing before it is read again until the upload is finalized into a photo.
+
+Every upload is a data file and a JSON file of its owner, length and metadata in the staging directory; a lock on
+the data file keeps two requests from appending at once, and finalizing renames it first, so that a single request
+creates the photo of an upload. Uploads untouched for longer than their TTL are deleted.
+Workers of a host share the staging directory; several hosts need it on a shared volume or sticky sessions.
+"""
+import asyncio
+import base64
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, BinaryIO
+
+import anyio
+from fastapi import HTTPException, status
+
+from src.conf.config import config
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+_id_pattern = re.compile(r"^[0-9a-f]{32}$")
+
+
+def parse_metadata(header: str | None) -> dict[str, str]:
+    """
+    The parse_metadata function decodes an Upload-Metadata header: comma-separated keys and base64 values.
+
+    >>> parse_metadata("filename cGhvdG8uanBn,is_private")
+    {'filename': 'photo.jpg', 'is_private': ''}
+
+    :param header: str: The header value
+    :return: The metadata
+    """
+    metadata = {}
+    for pair in (header or "").split(","):
+        key, _, value = pair.strip().partition(" ")
+        if key:
+            try:
+                metadata[key] = base64.b64decode(value, validate=True).decode() if value else ""
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid metadata: {key}")
+    return metadata
+
+
+@dataclass
+class Upload:
+    id: str
+    user_id: int
+    length: int
+    metadata: dict[str, str] = field(default_factory=dict)
+    offset: int = 0
+    expires: float = 0.0
+
+
+class UploadStore:
+    """
+    Staging files of the resumable uploads.
+    """
+
+    def __init__(self, directory: str | None = None, max_size: int = 100 * 2 ** 20, ttl: float = 24 * 3600,
+                 interval: float = 600):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "photoshare-uploads")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def _path(self, upload_id: str, suffix: str = "") -> str:
+        return os.path.join(self.directory, f"{upload_id}{suffix}")
+
+    def create(self, user_id: int, length: int, metadata: dict[str, str]) -> Upload:
+        """
+        The create function starts an upload with an empty staging file.
+
+        :param user_id: int: The user uploading
+        :param length: int: The total size of the file in bytes
+        :param metadata: dict: The metadata of the file, e.g. filename, filetype, description and tags
+        :return: The upload
+        """
+        if length > self.max_size:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                detail=f"Uploads are limited to {self.max_size} bytes")
+        os.makedirs(self.directory, exist_ok=True)
+        upload = Upload(uuid.uuid4().hex, user_id, length, metadata)
+        open(self._path(upload.id), "xb").close()
+        with open(self._path(upload.id, ".json.tmp"), "w") as f:
+            json.dump(asdict(upload), f)
+        os.replace(self._path(upload.id, ".json.tmp"), self._path(upload.id, ".json"))
+        upload.expires = time.time() + self.ttl
+        return upload
+
+    def get(self, upload_id: str, user_id: int | None = None) -> Upload:
+        """
+        The get function reads the state of an upload; its offset is the size of the staging file.
+
+        :param upload_id: str: The upload
+        :param user_id: int: The user who must own the upload, any user if None
+        :return: The upload; HTTPException 404 is raised if it does not exist, expired or belongs to another user
+        """
+        try:
+            if not _id_pattern.match(upload_id):
+                raise FileNotFoundError(upload_id)
+            with open(self._path(upload_id, ".json")) as f:
+                upload = Upload(**json.load(f))
+            stat = os.stat(self._path(upload_id))
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+        upload.offset, upload.expires = stat.st_size, stat.st_mtime + self.ttl
+        if (user_id is not None and upload.user_id != user_id) or upload.expires < time.time():
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Upload not found")
+        return upload
+
+    async def append(self, upload: Upload, offset: int, chunks: AsyncIterator[bytes]) -> int:
+        """
+        The append function writes received bytes at the end of the staging file as they arrive.
+        If the transfer fails midway the bytes written so far are kept and the exception is raised.
+
+        :param upload: Upload: The upload, from get
+        :param offset: int: The offset the client sends from, it must be the current offset
+        :param chunks: AsyncIterator[bytes]: The bytes received
+        :return: The new offset
+        """
+        async with await anyio.open_file(self._path(upload.id), "ab") as f:
+            try:
+                fcntl.flock(f.wrapped.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise HTTPException(status_code=status.HTTP_423_LOCKED, detail="Upload in progress")
+            current = os.fstat(f.wrapped.fileno()).st_size
+            if offset != current:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail=f"Offset mismatch, the upload is at {current}")
+            try:
+                async for chunk in chunks:
+                    room = upload.length - current
+                    await f.write(chunk[:room])
+                    current += min(len(chunk), room)
+                    if len(chunk) > room:
+                        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                                            detail="Data exceeds the upload length")
+            finally:
+                await f.flush()
+        upload.offset, upload.expires = current, time.time() + self.ttl
+        return current
+
+    def claim(self, upload: Upload) -> BinaryIO:
+        """
+        The claim function opens the complete file of an upload for a single caller: the staging file is renamed
+        atomically, so a concurrent claim of the same upload fails and the upload accepts no more bytes.
+
+        :param upload: Upload: The upload, from get
+        :return: The file object, to close by the caller; HTTPException 409 is raised if the upload is incomplete
+                 or claimed already
+        """
+        if upload.offset != upload.length:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"Upload incomplete, {upload.offset} of {upload.length} bytes received")
+        try:
+            os.rename(self._path(upload.id), self._path(upload.id, ".claimed"))
+        except FileNotFoundError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload finalized already")
+        return open(self._path(upload.id, ".claimed"), "rb")
+
+    def restore(self, upload: Upload) -> None:
+        """
+        The restore function gives back a claimed upload whose finalization failed, so that it can be retried.
+
+        :param upload: Upload: The upload, from claim
+        :return: None
+        """
+        try:
+            os.rename(self._path(upload.id, ".claimed"), self._path(upload.id))
+        except FileNotFoundError:
+            pass
+
+    def delete(self, upload_id: str) -> None:
+        """
+        The delete function removes the staging files of an upload.
+
+        :param upload_id: str: The upload
+        :return: None
+        """
+        for suffix in (".json", ".json.tmp", ".claimed", ""):
+            try:
+                os.unlink(self._path(upload_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def collect(self) -> int:
+        """
+        The collect function deletes the uploads untouched for longer than the TTL.
+
+        :return: The number of uploads deleted
+        """
+        deadline, deleted = time.time() - self.ttl, 0
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            upload_id = name.split(".")[0]
+            if not _id_pattern.match(upload_id) or name != upload_id and os.path.exists(self._path(upload_id)):
+                continue
+            try:
+                if os.stat(self._path(name)).st_mtime < deadline:
+                    self.delete(upload_id)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+        if deleted:
+            logger.info("Deleted %d expired uploads", deleted)
+        return deleted
+
+    def start(self) -> None:
+        """
+        The start function collects the expired uploads every interval seconds in a task of the running event loop.
+
+        :return: None
+        """
+        async def run():
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    await anyio.to_thread.run_sync(self.collect)
+                except Exception as err:
+                    logger.error("Error collecting expired uploads: %s", err)
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(run())
+
+    def stop(self) -> None:
+        """
+        The stop function stops the periodic collection.
+
+        :return: None
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+upload_store = UploadStore(config.UPLOAD_STAGING_DIR, config.UPLOAD_MAX_SIZE, config.UPLOAD_TTL,
+                           config.UPLOAD_GC_INTERVAL)
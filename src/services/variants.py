@@ -0,0 +1,281 @@
+"""
+Preset and custom variants of the images, transformed by the storage driver and stored once.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.database.db import sessionmanager
+from src.entity.models import PhotoVariant
+from src.services.metrics import CACHE_REQUESTS
+from src.services.singleflight import SingleFlight
+from src.services.storage import Storage, storage
+
+
+logger = logging.getLogger(__name__)
+
+
+AVATAR_PRESETS = ("avatar_35", "avatar_200")
+PHOTO_PRESETS = ("post",)
+
+
+def params_hash(params: dict) -> str:
+    """
+    The params_hash function identifies a set of transformation parameters, whatever their order.
+
+    :param params: dict: The transformation parameters
+    :return: A short hex digest
+    """
+    params = {key: value for key, value in params.items() if value is not None}
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class VariantStore:
+    """
+    Transformed images materialized once in the photo_variants table.
+
+    Variants are keyed by the source image URL and the hash of their parameters. Named presets come from
+    TRANSFORM_PRESETS; changing a preset changes its hash, so the old variants stop matching and are regenerated.
+    Concurrent transforms of an image with the same parameters share one call to the storage, across processes too.
+    """
+
+    def __init__(self, presets: dict[str, dict], session_factory=sessionmanager.session, backend: Storage = storage):
+        self.presets = presets
+        self.hashes = {name: params_hash(params) for name, params in presets.items()}
+        self.session_factory = session_factory
+        self.backend = backend
+        self._pending: set[tuple[str, str]] = set()
+        self.flight = SingleFlight("transform", redis_client, config.SINGLEFLIGHT_LOCK_TTL)
+
+    @property
+    def enabled(self) -> bool:
+        """
+        The enabled property tells whether the backend transforms images. Without it, as with the local and S3
+        drivers, images have no variants: callers skip the lookups, transforms and background generation.
+
+        :return: True if variants can be made
+        """
+        return self.backend.transforms
+
+    async def lookup(self, sources: Iterable[str | None], presets: Iterable[str],
+                     db: AsyncSession) -> dict[tuple[str, str], str]:
+        """
+        The lookup function reads the variants of several images in one query.
+
+        :param sources: Iterable[str]: The URLs of the source images
+        :param presets: Iterable[str]: The names of the presets
+        :param db: AsyncSession: The database session
+        :return: A dictionary mapping (source URL, preset) to the variant URL, without the missing variants
+        """
+        sources = {source for source in sources if source}
+        presets = {self.hashes[name]: name for name in presets}
+        if not sources or not presets:
+            return {}
+        result = await db.execute(
+            select(PhotoVariant.source_url, PhotoVariant.params_hash, PhotoVariant.url)
+            .where(PhotoVariant.source_url.in_(sources), PhotoVariant.params_hash.in_(presets))
+        )
+        found = {(source, presets[digest]): url for source, digest, url in result}
+        CACHE_REQUESTS.labels("transform", "hit").inc(len(found))
+        CACHE_REQUESTS.labels("transform", "miss").inc(len(sources) * len(presets) - len(found))
+        return found
+
+    async def generate(self, source_url: str, presets: Iterable[str], photo_id: int | None = None) -> None:
+        """
+        The generate function materializes the presets of an image; it runs as a background task with its own session.
+        Presets already stored, e.g. for an image uploaded twice, or being generated by this worker are skipped.
+
+        :param source_url: str: The URL of the source image
+        :param presets: Iterable[str]: The names of the presets
+        :param photo_id: int: The photo the image belongs to, if any
+        :return: None
+        """
+        if not self.enabled:
+            return
+        presets = [name for name in presets if (source_url, name) not in self._pending]
+        self._pending.update((source_url, name) for name in presets)
+        try:
+            async with self.session_factory() as db:
+                stored = set((await db.execute(
+                    select(PhotoVariant.params_hash).filter_by(source_url=source_url)
+                )).scalars())
+                for name in presets:
+                    if self.hashes[name] not in stored:
+                        await self._materialize(source_url, self.presets[name], name, photo_id, db)
+        except Exception as err:
+            logger.error("Error generating variants of %s: %s", source_url, err)
+        finally:
+            self._pending.difference_update((source_url, name) for name in presets)
+
+    async def transform(self, source_url: str, params: dict, db: AsyncSession, photo_id: int | None = None) -> str:
+        """
+        The transform function returns the variant of an image for arbitrary parameters, creating it on first use.
+
+        :param source_url: str: The URL of the source image
+        :param params: dict: The transformation parameters
+        :param db: AsyncSession: The database session
+        :param photo_id: int: The photo the image belongs to, if any
+        :return: The URL of the variant, or the source URL if the transformation failed
+        """
+        if not self.enabled:
+            return source_url
+        digest = params_hash(params)
+        url = await self._stored(source_url, digest, db)
+        if url is not None:
+            CACHE_REQUESTS.labels("transform", "hit").inc()
+            return url
+        CACHE_REQUESTS.labels("transform", "miss").inc()
+        return await self.flight.do((source_url, digest), self._create, source_url, params, photo_id) or source_url
+
+    @staticmethod
+    async def _stored(source_url: str, digest: str, db: AsyncSession) -> str | None:
+        return (await db.execute(
+            select(PhotoVariant.url).filter_by(source_url=source_url, params_hash=digest)
+        )).scalar_one_or_none()
+
+    async def _create(self, source_url: str, params: dict, photo_id: int | None) -> str | None:
+        # shared by the concurrent callers: the call has its own session, which outlives none of them
+        async with self.session_factory() as db:
+            # another process may have stored the variant while this call waited for its lock
+            url = await self._stored(source_url, params_hash(params), db)
+            return url if url is not None else await self._materialize(source_url, params, None, photo_id, db)
+
+    async def _materialize(self, source_url: str, params: dict, preset: str | None, photo_id: int | None,
+                           db: AsyncSession) -> str | None:
+        url = await run_in_threadpool(self.backend.transform, source_url, params)
+        return await self._save(source_url, params, preset, photo_id, url, db)
+
+    async def _save(self, source_url: str, params: dict, preset: str | None, photo_id: int | None, url: str | None,
+                    db: AsyncSession) -> str | None:
+        if not url or url == source_url:
+            return None
+        digest = params_hash(params)
+        stmt = select(PhotoVariant).filter_by(source_url=source_url)
+        stmt = stmt.filter_by(preset=preset) if preset else stmt.filter_by(params_hash=digest)
+        variant = (await db.execute(stmt)).scalars().first()
+        if variant is None:
+            variant = PhotoVariant(source_url=source_url, preset=preset)
+            db.add(variant)
+        variant.params_hash = digest
+        variant.url = url
+        variant.photo_id = photo_id or variant.photo_id
+        try:
+            await db.commit()
+        except IntegrityError:
+            # another worker stored the same variant first
+            await db.rollback()
+        return url
+
+    def fan_out(self, variants: dict[tuple[str, str], int | None], concurrency: int) -> "PendingVariants":
+        """
+        The fan_out function starts transforming several preset variants concurrently, e.g. the missing variants
+        of a feed. Nothing is stored until PendingVariants.save.
+
+        :param variants: dict: Maps (source URL, preset) to the photo the image belongs to, if any
+        :param concurrency: int: The number of transforms running at once
+        :return: The running transforms
+        """
+        return PendingVariants(self, variants, concurrency)
+
+    async def stale(self, db: AsyncSession) -> list[tuple[str, str, int | None]]:
+        """
+        The stale function lists the preset variants generated from an outdated preset definition.
+        Variants of presets removed from the configuration are deleted.
+
+        :param db: AsyncSession: The database session
+        :return: A list of (source URL, preset, photo ID) to regenerate
+        """
+        result = await db.execute(select(PhotoVariant).where(PhotoVariant.preset.is_not(None)))
+        outdated = []
+        for variant in result.scalars():
+            if variant.preset not in self.presets:
+                await db.delete(variant)
+            elif variant.params_hash != self.hashes[variant.preset]:
+                outdated.append((variant.source_url, variant.preset, variant.photo_id))
+        await db.commit()
+        return outdated
+
+
+class PendingVariants:
+    """
+    Preset variants being transformed concurrently for one request, each transform once, at most
+    ``concurrency`` at a time. The request uses the variants done before its deadline; a background task
+    waits for the others and stores them all.
+    """
+
+    def __init__(self, store: VariantStore, variants: dict[tuple[str, str], int | None], concurrency: int):
+        self.store = store
+        self.variants = variants
+        self._semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        self._tasks = {key: loop.create_task(self._transform(*key)) for key in variants}
+
+    async def _transform(self, source_url: str, preset: str) -> str | None:
+        params = self.store.presets[preset]
+        async with self._semaphore:
+            # keyed like VariantStore.transform: both calls yield the URL of the same variant
+            return await self.store.flight.do((source_url, self.store.hashes[preset]), run_in_threadpool,
+                                              self.store.backend.transform, source_url, params)
+
+    def _done(self) -> dict[tuple[str, str], str]:
+        done = {}
+        for (source_url, preset), task in self._tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None:
+                url = task.result()
+                if url and url != source_url:
+                    done[(source_url, preset)] = url
+        return done
+
+    async def wait(self, timeout: float) -> dict[tuple[str, str], str]:
+        """
+        The wait function waits for the transforms, at most timeout seconds.
+
+        :param timeout: float: The deadline in seconds
+        :return: A dictionary mapping (source URL, preset) to the variant URL, for the transforms done in time
+        """
+        if self._tasks and timeout > 0:
+            await asyncio.wait(self._tasks.values(), timeout=timeout)
+        return self._done()
+
+    def cancel(self) -> None:
+        """
+        The cancel function stops waiting for the transforms not done, when the request fails before scheduling save.
+        Transforms queued behind the concurrency limit never start; a running one still finishes for the other
+        callers of its single flight.
+
+        :return: None
+        """
+        for task in self._tasks.values():
+            task.cancel()
+
+    async def save(self) -> None:
+        """
+        The save function waits for all the transforms and stores the variants; it runs as a background task.
+
+        :return: None
+        """
+        if not self._tasks:
+            return
+        await asyncio.wait(self._tasks.values())
+        for (source_url, preset), task in self._tasks.items():
+            if not task.cancelled() and task.exception() is not None:
+                logger.error("Error generating variant %s of %s: %s", preset, source_url, task.exception())
+        try:
+            async with self.store.session_factory() as db:
+                for (source_url, preset), url in self._done().items():
+                    await self.store._save(source_url, self.store.presets[preset], preset,
+                                           self.variants[(source_url, preset)], url, db)
+        except Exception as err:
+            logger.error("Error storing variants: %s", err)
+
+
+variant_store = VariantStore(config.TRANSFORM_PRESETS)
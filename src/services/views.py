@@ -0,0 +1,200 @@
+"""
+Write-behind view counters of the photos.
+
+A view only increments in-process buffers. Every flush interval each worker moves its buffers to Redis: ``INCRBY``
+on the pending count of the photo and ``PFADD`` of the viewers to its HyperLogLog of unique viewers. Then one worker
+at a time drains the pending counts and applies them to the ``photo_stats`` table in batched upserts.
+
+A crash loses at most the views buffered by the worker since its last flush, plus the batch being written if the
+database write fails after Redis was drained. Without Redis, buffers go straight to the database and unique views
+are counted per flush interval, so a viewer coming back later is counted again.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from redis.exceptions import RedisError
+from sqlalchemy import case, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.database.db import sessionmanager
+from src.entity.models import Photo, PhotoStats
+from src.services.metrics import Counter
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+VIEWS_DROPPED = Counter("photo_views_dropped_total", "Photo views lost because a flush to the database failed.")
+
+
+class ViewCounter:
+    """
+    Total and unique views of the photos, buffered in the worker and in Redis, stored in photo_stats.
+    """
+    prefix = "photo_views"
+
+    def __init__(self, cache=redis_client, interval: float = 10.0, batch: int = 1000):
+        self.cache = cache
+        self.interval = interval
+        self.batch = batch
+        self._views: dict[int, int] = defaultdict(int)
+        self._viewers: dict[int, set[str]] = defaultdict(set)
+        self._task: asyncio.Task | None = None
+
+    def record(self, photo_id: int, viewer: str) -> None:
+        """
+        The record function counts a view of a photo. It only touches memory.
+
+        :param photo_id: int: The photo viewed
+        :param viewer: str: Identifies the viewer for the unique count, e.g. the user ID or the client address
+        :return: None
+        """
+        self._views[photo_id] += 1
+        self._viewers[photo_id].add(viewer)
+
+    def _take(self) -> tuple[dict[int, int], dict[int, set[str]]]:
+        views, viewers = self._views, self._viewers
+        self._views, self._viewers = defaultdict(int), defaultdict(set)
+        return views, viewers
+
+    def _push(self, views: dict[int, int], viewers: dict[int, set[str]]) -> None:
+        pipe = self.cache.pipeline()
+        for photo_id, count in views.items():
+            pipe.incrby(f"{self.prefix}:{photo_id}", count)
+            pipe.pfadd(f"{self.prefix}:{photo_id}:viewers", *viewers[photo_id])
+        pipe.sadd(f"{self.prefix}:dirty", *views)
+        pipe.execute()
+
+    def _drain(self) -> list[tuple[int, int, int]]:
+        photo_ids = [int(photo_id) for photo_id in self.cache.spop(f"{self.prefix}:dirty", self.batch) or []]
+        if not photo_ids:
+            return []
+        pipe = self.cache.pipeline()
+        for photo_id in photo_ids:
+            pipe.get(f"{self.prefix}:{photo_id}")
+            pipe.delete(f"{self.prefix}:{photo_id}")
+            pipe.pfcount(f"{self.prefix}:{photo_id}:viewers")
+        results = pipe.execute()
+        return [
+            (photo_id, int(results[i * 3] or 0), results[i * 3 + 2])
+            for i, photo_id in enumerate(photo_ids)
+        ]
+
+    async def store(self, rows: list[tuple[int, int, int]], db: AsyncSession, unique_is_total: bool = True) -> None:
+        """
+        The store function adds pending views to photo_stats in one upsert. Photos deleted meanwhile are skipped.
+
+        :param rows: list: The (photo ID, new views, unique views) to store
+        :param db: AsyncSession: The database session
+        :param unique_is_total: bool: Whether the unique views are the running total (from Redis)
+            rather than the unique views since the last flush
+        :return: None
+        """
+        known = set((await db.execute(select(Photo.id).where(Photo.id.in_([row[0] for row in rows])))).scalars())
+        values = [
+            {"photo_id": photo_id, "views": views, "unique_views": unique}
+            for photo_id, views, unique in rows if photo_id in known
+        ]
+        if not values:
+            return
+        dialect = postgresql if db.bind.dialect.name == "postgresql" else sqlite
+        stmt = dialect.insert(PhotoStats).values(values)
+        if unique_is_total:
+            # the HyperLogLog estimate may drop if Redis lost the key, keep the largest
+            unique_views = case((stmt.excluded.unique_views > PhotoStats.unique_views, stmt.excluded.unique_views),
+                                else_=PhotoStats.unique_views)
+        else:
+            unique_views = PhotoStats.unique_views + stmt.excluded.unique_views
+        await db.execute(stmt.on_conflict_do_update(
+            index_elements=[PhotoStats.photo_id],
+            set_={"views": PhotoStats.views + stmt.excluded.views, "unique_views": unique_views},
+        ))
+        await db.commit()
+
+    async def flush(self, db: AsyncSession) -> None:
+        """
+        The flush function moves the buffers of this worker to Redis and, if no other worker is doing it,
+        the pending views in Redis to the database.
+
+        :param db: AsyncSession: The database session
+        :return: None
+        """
+        views, viewers = self._take()
+        if views:
+            try:
+                self._push(views, viewers)
+            except RedisError as err:
+                logger.warning("Redis unavailable, writing views to the database: %s", err)
+                await self._store_or_drop(
+                    [(photo_id, count, len(viewers[photo_id])) for photo_id, count in views.items()], db, False
+                )
+        try:
+            if not self.cache.set(f"{self.prefix}:lock", 1, nx=True, ex=max(int(self.interval), 1)):
+                return
+            try:
+                while rows := self._drain():
+                    await self._store_or_drop(rows, db, True)
+            finally:
+                self.cache.delete(f"{self.prefix}:lock")
+        except RedisError as err:
+            logger.warning("Redis unavailable, cannot store pending views: %s", err)
+
+    async def _store_or_drop(self, rows: list[tuple[int, int, int]], db: AsyncSession, unique_is_total: bool):
+        try:
+            await self.store(rows, db, unique_is_total)
+        except Exception as err:
+            await db.rollback()
+            VIEWS_DROPPED.inc(sum(views for _, views, _ in rows))
+            logger.error("Error storing %d photo view counts: %s", len(rows), err)
+
+    def start(self) -> None:
+        """
+        The start function flushes the views every interval seconds in a task of the running event loop.
+
+        :return: None
+        """
+        async def run():
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    async with sessionmanager.session() as db:
+                        await self.flush(db)
+                except Exception as err:
+                    logger.error("Error flushing photo views: %s", err)
+
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(run())
+
+    async def stop(self) -> None:
+        """
+        The stop function stops the periodic flush and flushes the buffers one last time.
+
+        :return: None
+        """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        async with sessionmanager.session() as db:
+            await self.flush(db)
+
+    def forget(self, photo_id: int) -> None:
+        """
+        The forget function drops the buffered views and the unique viewers of a deleted photo.
+
+        :param photo_id: int: The photo
+        :return: None
+        """
+        self._views.pop(photo_id, None)
+        self._viewers.pop(photo_id, None)
+        try:
+            self.cache.delete(f"{self.prefix}:{photo_id}", f"{self.prefix}:{photo_id}:viewers")
+        except RedisError as err:
+            logger.warning("Redis unavailable, cannot drop views of photo %s: %s", photo_id, err)
+
+
+view_counter = ViewCounter(interval=config.VIEW_FLUSH_INTERVAL, batch=config.VIEW_FLUSH_BATCH)
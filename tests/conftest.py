@@ -1,15 +1,27 @@
 import asyncio
+import os
+import tempfile
 
+# images are stored in a temporary directory: no test calls Cloudinary
+os.environ["STORAGE_DRIVER"] = "local"
+os.environ["LOCAL_STORAGE_ROOT"] = tempfile.mkdtemp(prefix="photoshare-storage-")
+
+import fakeredis
 import pytest
 import pytest_asyncio
 from fastapi.testclient import TestClient
+from sqlalchemy import event
 from sqlalchemy.pool import StaticPool
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 
 from main import app
+from src.database.cache import redis_client
 from src.entity.models import Base, User
 from src.database.db import get_db
+from src.database.queries import budgets, install_query_recorder
 from src.services.auth import auth_service
+from src.services.placeholders import placeholders
+from src.services.variants import variant_store
 
 SQLALCHEMY_DATABASE_URL = "sqlite+aiosqlite:///./test.db"
 
@@ -17,7 +29,20 @@ engine = create_async_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, poolclass=StaticPool
 )
 
-TestingSessionLocal = async_sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
+
+@event.listens_for(engine.sync_engine, "connect")
+def enable_foreign_keys(dbapi_connection, connection_record):
+    # SQLite ignores foreign keys unless asked to; PostgreSQL always enforces them
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+TestingSessionLocal = async_sessionmaker(autocommit=False, autoflush=False, bind=engine)
+install_query_recorder(engine)
+
+# the services share redis_client: point its connections to an in-memory Redis
+redis_client.connection_pool = fakeredis.FakeRedis().connection_pool
 
 test_user = {"username": "deadpool", "email": "deadpool@example.com", "password": "12345678"}
 
@@ -53,6 +78,12 @@ def client():
             await session.close()
 
     app.dependency_overrides[get_db] = override_get_db
+    # background tasks and the loads shared by concurrent requests open their own sessions
+    auth_service.session_factory = TestingSessionLocal
+    variant_store.session_factory = TestingSessionLocal
+    placeholders.session_factory = TestingSessionLocal
+    # requests exceeding the query budget of their endpoint fail the test
+    budgets.mode = "raise"
 
     yield TestClient(app)
 
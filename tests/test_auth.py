@@ -0,0 +1,79 @@
+import asyncio
+
+from sqlalchemy import select, update
+
+from conftest import TestingSessionLocal, test_user
+from src.database.cache import redis_client
+from src.entity.models import User
+from src.services.sessions import session_store
+
+
+def login(client) -> dict:
+    response = client.post("/api/auth/login",
+                           data={"username": test_user["email"], "password": test_user["password"]})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def refresh(client, tokens: dict):
+    return client.get("/api/auth/refresh_token", headers={"Authorization": f"Bearer {tokens['refresh_token']}"})
+
+
+def user_id() -> int:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return (await session.execute(select(User.id).filter_by(email=test_user["email"]))).scalar_one()
+
+    return asyncio.run(read())
+
+
+def set_active(active: bool) -> None:
+    async def write():
+        async with TestingSessionLocal() as session:
+            await session.execute(update(User).filter_by(email=test_user["email"]).values(is_active=active))
+            await session.commit()
+
+    asyncio.run(write())
+
+
+def test_refresh_rotates_and_detects_reuse(client):
+    first = login(client)
+    response = refresh(client, first)
+    assert response.status_code == 200, response.text
+    second = response.json()
+    assert second["refresh_token"] != first["refresh_token"]
+
+    # replaying the rotated token revokes the whole family, the newest token included
+    assert refresh(client, first).status_code == 401
+    assert refresh(client, second).status_code == 401
+
+
+def test_refresh_renews_sessions_of_user(client):
+    tokens = login(client)
+    key = session_store._user_key(user_id())
+    redis_client.delete(key)
+
+    response = refresh(client, tokens)
+    assert response.status_code == 200, response.text
+    assert redis_client.ttl(key) > 0
+    assert len(redis_client.smembers(key)) == 1
+
+    # a ban revokes the session found through the renewed set
+    asyncio.run(revoke_user(user_id()))
+    assert refresh(client, response.json()).status_code == 401
+
+
+async def revoke_user(uid: int) -> None:
+    async with TestingSessionLocal() as session:
+        await session_store.revoke_user(uid, session)
+
+
+def test_refresh_rejects_inactive_user(client):
+    tokens = login(client)
+    set_active(False)
+    try:
+        assert refresh(client, tokens).status_code == 401
+    finally:
+        set_active(True)
+    # the session was not rotated by the rejected request
+    assert refresh(client, tokens).status_code == 200
@@ -0,0 +1,140 @@
+import asyncio
+import io
+import os
+
+import pytest
+
+from sqlalchemy import select
+
+from conftest import TestingSessionLocal
+from scripts.storage import serve_standin
+from src.entity.models import Tag
+from src.services import blobs
+from src.services.blobs import blob_store
+from src.services.storage import LocalStorage, S3Storage, object_key
+
+
+@pytest.fixture(scope="module", params=["local", "s3"])
+def driver(request, tmp_path_factory):
+    root = str(tmp_path_factory.mktemp(request.param))
+    if request.param == "local":
+        yield LocalStorage(root, "/api/storage")
+        return
+    server, thread, port = serve_standin(root)
+    yield S3Storage(f"http://127.0.0.1:{port}", "blobs", None, None)
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture
+def storage(driver, monkeypatch):
+    monkeypatch.setattr(blobs, "storage", driver)
+    return driver
+
+
+def test_driver_objects(driver):
+    content = os.urandom(4096)
+    key = object_key("ab" * 32, "image/png", "tests")
+    url = driver.put(io.BytesIO(content), key, "image/png")
+    assert driver.key(url) == key
+    assert driver.stat(key).size == len(content)
+    assert b"".join(driver.get(key)) == content
+    assert b"".join(driver.get(key, 100, 50)) == content[100:150]
+    driver.delete(key)
+    driver.delete(key)
+    assert driver.stat(key) is None
+
+
+async def store(content: bytes) -> int:
+    async with TestingSessionLocal() as db:
+        blob = await blob_store.store(io.BytesIO(content), db, "image/png")
+        blob_id = blob.id
+        await db.commit()
+    return blob_id
+
+
+async def release(blob_id: int):
+    async with TestingSessionLocal() as db:
+        orphan = await blob_store.release(blob_id, db)
+        await db.commit()
+    return orphan
+
+
+def test_purge_deletes_asset(storage):
+    content = os.urandom(1024)
+
+    async def scenario():
+        orphan = await release(await store(content))
+        async with TestingSessionLocal() as db:
+            await blob_store.purge(orphan, db)
+        return storage.key(orphan.url)
+
+    assert storage.stat(asyncio.run(scenario())) is None
+
+
+def test_purge_keeps_asset_uploaded_again(storage):
+    content = os.urandom(1024)
+
+    async def scenario():
+        orphan = await release(await store(content))
+        async with TestingSessionLocal() as upload_db, TestingSessionLocal() as purge_db:
+            # the same bytes are stored again: their asset is put before the new blob row is committed
+            blob = await blob_store.store(io.BytesIO(content), upload_db, "image/png")
+            purge = asyncio.create_task(blob_store.purge(orphan, purge_db))
+            await asyncio.sleep(0.2)
+            assert not purge.done()
+            blob_id = blob.id
+            await upload_db.commit()
+            await purge
+        return orphan, blob_id
+
+    orphan, blob_id = asyncio.run(scenario())
+    key = storage.key(orphan.url)
+    assert storage.stat(key) is not None
+
+    async def cleanup():
+        async with TestingSessionLocal() as db:
+            await blob_store.purge(await release(blob_id), db)
+
+    asyncio.run(cleanup())
+    assert storage.stat(key) is None
+
+
+def test_store_conflict_keeps_transaction(storage, monkeypatch):
+    content = os.urandom(1024)
+    acquire = blob_store._acquire
+    misses = []
+
+    async def stale_acquire(sha256, db):
+        # the blob stored by another upload is not seen until its insert conflicts
+        if len(misses) < 2:
+            misses.append(sha256)
+            return None
+        return await acquire(sha256, db)
+
+    async def scenario():
+        blob_id = await store(content)
+        monkeypatch.setattr(blob_store, "_acquire", stale_acquire)
+        async with TestingSessionLocal() as db:
+            db.add(Tag(name="blob-conflict"))
+            await db.flush()
+            blob = await blob_store.store(io.BytesIO(content), db, "image/png")
+            assert blob.id == blob_id
+            await db.commit()
+            assert not db.sync_session.info.get("blob_locks")
+        async with TestingSessionLocal() as db:
+            tag = await db.scalar(select(Tag).filter_by(name="blob-conflict"))
+            await db.delete(tag)
+            await db.commit()
+        monkeypatch.setattr(blob_store, "_acquire", acquire)
+        await release(blob_id)
+        return await release(blob_id)
+
+    orphan = asyncio.run(scenario())
+    assert orphan is not None and not blob_store._locks
+
+    async def cleanup():
+        async with TestingSessionLocal() as db:
+            await blob_store.purge(orphan, db)
+
+    asyncio.run(cleanup())
@@ -0,0 +1,115 @@
+import asyncio
+import io
+import secrets
+import time
+
+import httpx
+from fastapi import FastAPI
+from PIL import Image
+from sqlalchemy import func, select
+
+from conftest import TestingSessionLocal, test_user
+from src.entity.models import Comment, Photo
+from src.services.auth import auth_service
+from src.services.idempotency import IdempotencyMiddleware, IdempotencyStore, idempotent
+
+
+def counting_app(store: IdempotencyStore) -> tuple[FastAPI, list]:
+    app = FastAPI()
+    calls = []
+
+    @app.post("/items", status_code=201)
+    @idempotent
+    async def create_item(item: dict):
+        calls.append(item)
+        await asyncio.sleep(0.2)
+        return {"id": len(calls), **item}
+
+    app.add_middleware(IdempotencyMiddleware, store=store)
+    return app, calls
+
+
+def post_items(app: FastAPI, requests: list[tuple[dict, dict]]) -> list[httpx.Response]:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await asyncio.gather(*(client.post("/items", json=body, headers=headers)
+                                          for body, headers in requests))
+
+    return asyncio.run(run())
+
+
+def auth_headers(**extra) -> dict:
+    token = asyncio.run(auth_service.create_access_token({"sub": test_user["email"]}))
+    return {"Authorization": f"Bearer {token}", **extra}
+
+
+def test_concurrent_duplicates_coalesce():
+    app, calls = counting_app(IdempotencyStore())
+    headers = auth_headers(**{"Idempotency-Key": secrets.token_hex(8)})
+    responses = post_items(app, [({"name": "photo"}, headers)] * 5)
+
+    assert len(calls) == 1
+    assert {response.status_code for response in responses} == {201}
+    assert len({response.content for response in responses}) == 1
+    assert sum(response.headers.get("idempotent-replayed") == "true" for response in responses) == 4
+
+
+def test_duplicate_in_other_process_gives_up():
+    store = IdempotencyStore(max_wait=0.3)
+    app, calls = counting_app(store)
+    idempotency_key = secrets.token_hex(8)
+    # another process runs the first request: the key holds its marker and no local event wakes us
+    other = IdempotencyStore()
+    key = store.key(test_user["email"], idempotency_key)
+    assert other.claim(key, "other")
+
+    start = time.monotonic()
+    [response] = post_items(app, [({"name": "photo"}, auth_headers(**{"Idempotency-Key": idempotency_key}))])
+    assert response.status_code == 409
+    assert "retry-after" in response.headers
+    assert time.monotonic() - start < 2
+    assert calls == []
+
+    other.release(key, "other", None)
+    [response] = post_items(app, [({"name": "photo"}, auth_headers(**{"Idempotency-Key": idempotency_key}))])
+    assert response.status_code == 201
+    assert len(calls) == 1
+
+
+def comment_count() -> int:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return (await session.execute(select(func.count(Comment.id)))).scalar_one()
+
+    return asyncio.run(read())
+
+
+def photo_id() -> int:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return (await session.execute(select(Photo.id).order_by(Photo.id.desc()))).scalars().first()
+
+    return asyncio.run(read())
+
+
+def test_replay_and_mismatch(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), "purple").save(buffer, format="PNG")
+    response = client.post("/api/photos/", headers=headers, files={"file": ("photo.png", buffer.getvalue(), "image/png")})
+    assert response.status_code == 201, response.text
+    url = f"/api/comments/?photo_id={photo_id()}"
+    headers["Idempotency-Key"] = secrets.token_hex(8)
+    count = comment_count()
+
+    first = client.post(url, json={"content": "once"}, headers=headers)
+    assert first.status_code == 201, first.text
+    second = client.post(url, json={"content": "once"}, headers=headers)
+    assert second.status_code == 201
+    assert second.content == first.content
+    assert second.headers["idempotent-replayed"] == "true"
+    assert comment_count() == count + 1
+
+    mismatch = client.post(url, json={"content": "twice"}, headers=headers)
+    assert mismatch.status_code == 422
+    assert comment_count() == count + 1
@@ -0,0 +1,35 @@
+import json
+import os
+
+from src.services.metrics import Counter, Histogram, Registry
+
+
+def test_snapshots_of_reused_pid_are_kept(tmp_path):
+    registry = Registry(str(tmp_path))
+    requests = Counter("requests_total", "Requests.", registry=registry)
+    requests.inc(2)
+    registry.flush()
+    # a dead worker had the same PID before this process
+    dead = {"requests_total": {"type": "counter", "help": "Requests.", "labelnames": [], "samples": [[[], 3]]}}
+    with open(tmp_path / f"{os.getpid()}-1.json", "w", encoding="utf-8") as f:
+        json.dump(dead, f)
+
+    registry.flush()
+    assert len(os.listdir(tmp_path)) == 2
+    assert "requests_total 5\n" in registry.exposition()
+
+
+def test_histogram_buckets_from_snapshot(tmp_path):
+    registry = Registry(str(tmp_path))
+    latency = Histogram("latency_seconds", "Latency.", buckets=(1.0, 2.0), registry=registry)
+    latency.observe(1.5)
+    # a worker of another release exports a histogram this process does not define
+    other = {"queue_seconds": {"type": "histogram", "help": "Queue.", "labelnames": [], "buckets": [0.5],
+                               "samples": [[[], [1, 0, 0.25, 1]]]}}
+    with open(tmp_path / "1-1.json", "w", encoding="utf-8") as f:
+        json.dump(other, f)
+
+    text = registry.exposition()
+    assert 'latency_seconds_bucket{le="2"} 1' in text
+    assert 'queue_seconds_bucket{le="0.5"} 1' in text
+    assert 'queue_seconds_bucket{le="+Inf"} 1' in text
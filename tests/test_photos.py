@@ -0,0 +1,71 @@
+import asyncio
+import io
+
+import pytest
+from PIL import Image
+from sqlalchemy import select
+
+from conftest import TestingSessionLocal
+from src.entity.models import Blob, Photo
+from src.services.similarity import MAX_DISTANCE, similarity_index
+
+
+def png(color: str) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def upload(client, token: str, content: bytes):
+    response = client.post("/api/photos/", headers={"Authorization": f"Bearer {token}"},
+                           files={"file": ("photo.png", content, "image/png")})
+    assert response.status_code == 201, response.text
+    return response.json()
+
+
+def photo_ids() -> list[int]:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return list((await session.execute(select(Photo.id).order_by(Photo.id))).scalars())
+
+    return asyncio.run(read())
+
+
+def blobs() -> list[tuple[str, int]]:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return [tuple(row) for row in await session.execute(select(Blob.sha256, Blob.refcount))]
+
+    return asyncio.run(read())
+
+
+def test_delete_last_reference_of_blob(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    content = png("red")
+    first, second = upload(client, get_token, content), upload(client, get_token, content)
+    assert first["url"] == second["url"]
+    assert [refcount for _, refcount in blobs()] == [2]
+    first_id, second_id = photo_ids()[-2:]
+
+    assert client.delete(f"/api/photos/{first_id}", headers=headers).status_code == 204
+    assert [refcount for _, refcount in blobs()] == [1]
+    # the blob goes with its last photo, which must be deleted first with foreign keys enforced
+    assert client.delete(f"/api/photos/{second_id}", headers=headers).status_code == 204
+    assert blobs() == []
+
+
+def test_similar_photos_distance_is_bounded(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    # solid images have the same difference hash, whatever their color
+    upload(client, get_token, png("green"))
+    upload(client, get_token, png("blue"))
+    first_id, second_id = photo_ids()[-2:]
+
+    response = client.get(f"/api/photos/{first_id}/similar", params={"distance": MAX_DISTANCE}, headers=headers)
+    assert response.status_code == 200, response.text
+    assert second_id in [photo["id"] for photo in response.json()]
+
+    response = client.get(f"/api/photos/{first_id}/similar", params={"distance": MAX_DISTANCE + 1}, headers=headers)
+    assert response.status_code == 422
+    with pytest.raises(ValueError):
+        similarity_index.search(0, MAX_DISTANCE + 1)
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+from sqlalchemy import select, update
+
+from conftest import TestingSessionLocal, test_user
+from src.database.queries import QueryBudgetExceeded
+from src.entity.models import Comment, Photo, Tag, User
+from src.routes import posts
+
+PHOTOS = 5
+
+
+@pytest.fixture(scope="module")
+def photo_ids():
+    # several photos with tags and comments, so that a statement per photo exceeds every budget
+    async def seed():
+        async with TestingSessionLocal() as session:
+            user_id = (await session.execute(select(User.id).filter_by(email=test_user["email"]))).scalar_one()
+            await session.execute(update(User).filter_by(id=user_id).values(avatar="/api/storage/avatar.png"))
+            tags = [Tag(name=f"budget-{i}") for i in range(3)]
+            photos = []
+            for i in range(PHOTOS):
+                photo = Photo(url=f"/api/storage/budget-{i}.jpg", description=f"photo {i}", user_id=user_id,
+                              width=640, height=480, format="jpeg", size=1000 + i, tags=tags)
+                photo.comments = [Comment(content=f"comment {j}", user_id=user_id) for j in range(2)]
+                photos.append(photo)
+            session.add_all(photos)
+            await session.flush()
+            ids = [photo.id for photo in photos]
+            await session.commit()
+            return ids
+
+    return asyncio.run(seed())
+
+
+def test_posts_within_budget(client, get_token, photo_ids):
+    response = client.get("/api/posts/", headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == PHOTOS
+
+
+def test_photo_details_within_budget(client, photo_ids):
+    response = client.get(f"/api/photos/{photo_ids[0]}")
+    assert response.status_code == 200, response.text
+    assert response.json()["id"] == photo_ids[0]
+
+
+def test_photo_search_within_budget(client, get_token, photo_ids):
+    response = client.get("/api/photos/", params={"format": "jpeg", "min_width": 600, "sort": "size"},
+                          headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 200, response.text
+    assert len(response.json()) == PHOTOS
+
+
+def test_budget_overrun_fails(client, get_token, photo_ids, monkeypatch):
+    monkeypatch.setattr(posts.get_posts, "__query_budget__", 0)
+    with pytest.raises(QueryBudgetExceeded):
+        client.get("/api/posts/", headers={"Authorization": f"Bearer {get_token}"})
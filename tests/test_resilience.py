@@ -0,0 +1,117 @@
+import io
+import os
+import time
+
+import httpx
+import pytest
+
+from scripts.storage import Faults, serve_standin
+from src.services.resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, ResiliencePolicy, deadline
+from src.services.storage import S3Storage, object_key
+
+KEY = object_key("cd" * 32, "image/png", "faults")
+
+
+@pytest.fixture(scope="module")
+def standin(tmp_path_factory):
+    faults = Faults()
+    server, thread, port = serve_standin(str(tmp_path_factory.mktemp("faults")), faults)
+    endpoint = f"http://127.0.0.1:{port}"
+    S3Storage(endpoint, "faults", None, None).put(io.BytesIO(os.urandom(1024)), KEY, "image/png")
+    yield endpoint, faults
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture
+def faults(standin):
+    faults = standin[1]
+    faults.requests = 0
+    yield faults
+    faults.error_rate, faults.latency, faults.outage, faults.failures, faults.requests = 0.0, 0.0, False, 0, 0
+
+
+def driver(standin, retries: int = 2, min_calls: int = 100, open_for: float = 15.0) -> S3Storage:
+    breaker = CircuitBreaker("s3-test", failure_rate=0.5, min_calls=min_calls, window=10.0, open_for=open_for)
+    policy = ResiliencePolicy("s3-test", timeout=2.0, retries=retries, backoff=0.01, breaker=breaker)
+    return S3Storage(standin[0], "faults", None, None, timeout=2.0, policy=policy)
+
+
+def test_retries_transient_errors(standin, faults):
+    target = driver(standin)
+    faults.failures = 2
+    assert target.stat(KEY).size == 1024
+    assert faults.requests == 3
+
+    # once the retries are exhausted the error of the last attempt is raised
+    faults.failures, faults.requests = 3, 0
+    with pytest.raises(httpx.HTTPStatusError) as err:
+        target.stat(KEY)
+    assert err.value.response.status_code == 503
+    assert faults.requests == 3
+
+
+def test_breaker_opens_and_probes(standin, faults):
+    target = driver(standin, retries=0, min_calls=4, open_for=0.3)
+    faults.outage = True
+    for _ in range(4):
+        with pytest.raises(httpx.HTTPStatusError):
+            target.stat(KEY)
+    assert target.policy.breaker.state == CircuitBreaker.OPEN
+
+    # the open breaker fails fast, without reaching the store
+    requests = faults.requests
+    with pytest.raises(CircuitOpenError):
+        target.stat(KEY)
+    assert faults.requests == requests
+
+    # after the cooling period a failed probe opens the breaker again
+    time.sleep(0.3)
+    with pytest.raises(httpx.HTTPStatusError):
+        target.stat(KEY)
+    assert faults.requests == requests + 1
+    assert target.policy.breaker.state == CircuitBreaker.OPEN
+
+    # and a successful one closes it
+    faults.outage = False
+    time.sleep(0.3)
+    assert target.stat(KEY) is not None
+    assert target.policy.breaker.state == CircuitBreaker.CLOSED
+    assert target.stat(KEY) is not None
+
+
+def test_deadline_bounds_slow_calls(standin, faults):
+    target = driver(standin)
+    faults.latency = 1.0
+    start = time.monotonic()
+    with deadline(0.2):
+        with pytest.raises(DeadlineExceeded):
+            target.stat(KEY)
+    assert time.monotonic() - start < 0.5
+    # the deadline was not spent on retries
+    assert faults.requests == 1
+
+
+def test_interrupted_probe_releases_breaker():
+    class Interrupted(BaseException):
+        pass
+
+    def interrupted():
+        raise Interrupted()
+
+    def failed():
+        raise ConnectionResetError("connection reset")
+
+    policy = ResiliencePolicy("interrupted", retries=0,
+                              breaker=CircuitBreaker("interrupted", min_calls=1, open_for=0.1))
+    with pytest.raises(ConnectionResetError):
+        policy.call("stat", failed)
+    assert policy.breaker.state == CircuitBreaker.OPEN
+
+    # the probe is interrupted: it neither closes nor opens the breaker, and the next call probes again
+    time.sleep(0.1)
+    with pytest.raises(Interrupted):
+        policy.call("stat", interrupted)
+    assert policy.breaker.state == CircuitBreaker.HALF_OPEN
+    assert policy.call("stat", lambda: "ok") == "ok"
+    assert policy.breaker.state == CircuitBreaker.CLOSED
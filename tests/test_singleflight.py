@@ -0,0 +1,106 @@
+import asyncio
+import secrets
+
+import pytest
+from sqlalchemy import func, inspect, select
+
+from conftest import TestingSessionLocal, test_user
+from scripts.variants import SlowBackend
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.entity.models import PhotoVariant
+from src.repository import users as repository_users
+from src.services.auth import auth_service
+from src.services.invalidation import invalidation_bus
+from src.services.singleflight import SingleFlight
+from src.services.variants import VariantStore
+
+
+def test_concurrent_misses_load_once():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def load(key: str) -> dict:
+        calls.append(key)
+        await asyncio.sleep(0.05)
+        return {"key": key}
+
+    async def herd():
+        return await asyncio.gather(*(flight.do("key", load, "key") for _ in range(50)))
+
+    results = asyncio.run(herd())
+    assert calls == ["key"]
+    assert results == [{"key": "key"}] * 50
+
+
+def test_failed_load_reaches_every_caller():
+    flight = SingleFlight("test")
+    calls = []
+
+    async def load() -> None:
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise ValueError("unavailable")
+
+    async def herd():
+        return await asyncio.gather(*(flight.do("key", load) for _ in range(10)), return_exceptions=True)
+
+    assert all(isinstance(result, ValueError) for result in asyncio.run(herd()))
+    assert calls == [1]
+    # the failure is not cached: the next miss loads again
+    with pytest.raises(ValueError):
+        asyncio.run(flight.do("key", load))
+    assert calls == [1, 1]
+
+
+def test_concurrent_requests_load_user_once(client, get_token, monkeypatch):
+    loads = []
+    get_user_by_email = repository_users.get_user_by_email
+
+    async def counting(email, db):
+        loads.append(email)
+        await asyncio.sleep(0.05)
+        return await get_user_by_email(email, db)
+
+    monkeypatch.setattr(repository_users, "get_user_by_email", counting)
+    auth_service.user_cache.evict(test_user["email"])
+    redis_client.delete(invalidation_bus.versioned_key("user", test_user["email"]))
+
+    async def herd():
+        callers = [asyncio.create_task(auth_service.get_current_user(get_token)) for _ in range(20)]
+        await asyncio.sleep(0.01)
+        # the first caller goes away, e.g. its client disconnected: the others still get the user
+        callers[0].cancel()
+        return await asyncio.gather(*callers[1:])
+
+    users = asyncio.run(herd())
+    assert loads == [test_user["email"]]
+    for user in users:
+        assert inspect(user).detached
+        assert user.email == test_user["email"] and user.is_active is not False
+
+
+def test_concurrent_transforms_create_once():
+    store = VariantStore(config.TRANSFORM_PRESETS, session_factory=TestingSessionLocal,
+                         backend=SlowBackend(0.05, 0))
+    store.flight = SingleFlight("transform")
+    source_url = f"https://example.com/{secrets.token_hex(4)}.jpg"
+    params = {"width": 320, "crop": "fill"}
+
+    async def request() -> str:
+        async with TestingSessionLocal() as db:
+            return await store.transform(source_url, params, db)
+
+    async def herd():
+        return await asyncio.gather(*(request() for _ in range(10)))
+
+    async def variants() -> int:
+        async with TestingSessionLocal() as db:
+            return (await db.execute(
+                select(func.count(PhotoVariant.id)).filter_by(source_url=source_url)
+            )).scalar_one()
+
+    urls = asyncio.run(herd())
+    assert store.backend.calls == 1
+    assert len(set(urls)) == 1 and urls[0] != source_url
+    assert asyncio.run(variants()) == 1
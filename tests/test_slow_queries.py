@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from src.database.slow_queries import SlowQueryLog
+
+
+def test_failed_statement_pops_start_time():
+    log = SlowQueryLog(threshold_ms=0, explain=False)
+    engine = create_async_engine("sqlite+aiosqlite:///:memory:")
+    log.install(engine)
+
+    async def run():
+        async with engine.connect() as conn:
+            with pytest.raises(OperationalError):
+                await conn.execute(text("SELECT * FROM missing"))
+            await conn.execute(text("SELECT 1"))
+            starts = conn.sync_connection.info["slow_query_start"]
+        await engine.dispose()
+        return starts
+
+    assert asyncio.run(run()) == []
+    assert [entry["statement"] for entry in log.top()] == ["SELECT ?"]
+
+
+def test_plans_are_not_executed():
+    assert "ANALYZE" not in SlowQueryLog.explain_prefixes["postgresql"].upper()
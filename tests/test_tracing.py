@@ -0,0 +1,35 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from src.services.tracing import TracingMiddleware, span
+
+
+def traced_client(sample_rate: float, debug_token: str | None = None) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(TracingMiddleware, sample_rate=sample_rate, debug_token=debug_token)
+
+    @app.get("/work")
+    async def work():
+        with span("db", "SELECT"):
+            pass
+        return {}
+
+    return TestClient(app)
+
+
+def test_unsampled_requests_have_no_server_timing():
+    response = traced_client(0.0).get("/work")
+    assert response.status_code == 200
+    assert "server-timing" not in response.headers
+
+
+def test_sampled_requests_have_server_timing():
+    response = traced_client(1.0).get("/work")
+    assert 'db;dur=' in response.headers["server-timing"]
+    assert "total;dur=" in response.headers["server-timing"]
+
+
+def test_debug_requests_are_traced_with_the_token():
+    client = traced_client(0.0, debug_token="secret")
+    assert "server-timing" in client.get("/work", headers={"X-Debug-Trace": "secret"}).headers
+    assert "server-timing" not in client.get("/work", headers={"X-Debug-Trace": "guess"}).headers
@@ -0,0 +1,152 @@
+import asyncio
+import base64
+import hashlib
+import io
+import os
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from PIL import Image
+from sqlalchemy import func, select
+
+from conftest import TestingSessionLocal
+from main import app
+from src.entity.models import Photo
+from src.services.storage import storage
+from src.services.uploads import UploadStore
+
+
+def image() -> bytes:
+    buffer = io.BytesIO()
+    Image.frombytes("RGB", (64, 64), os.urandom(64 * 64 * 3)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def create(client, headers: dict, content: bytes) -> str:
+    metadata = ",".join(f"{key} {base64.b64encode(value.encode()).decode()}"
+                        for key, value in {"filetype": "image/png", "description": "resumed"}.items())
+    response = client.post("/api/uploads/", headers={**headers, "upload-length": str(len(content)),
+                                                     "upload-metadata": metadata})
+    assert response.status_code == 201, response.text
+    return response.headers["location"].rsplit("/", 1)[1]
+
+
+def patch(client, headers: dict, upload_id: str, offset: int, data: bytes):
+    return client.patch(f"/api/uploads/{upload_id}", content=data, headers={
+        **headers, "upload-offset": str(offset), "content-type": "application/offset+octet-stream"})
+
+
+def dropped_patch(token: str, upload_id: str, data: bytes, delivered: int) -> int:
+    # the connection drops after delivering part of the body: the server receives http.disconnect
+    messages = [{"type": "http.request", "body": data[:delivered], "more_body": True}, {"type": "http.disconnect"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "PATCH", "scheme": "http",
+        "path": f"/api/uploads/{upload_id}", "raw_path": f"/api/uploads/{upload_id}".encode(), "query_string": b"",
+        "root_path": "", "client": ("testclient", 50000), "server": ("testserver", 80),
+        "headers": [(b"authorization", f"Bearer {token}".encode()), (b"upload-offset", b"0"),
+                    (b"content-type", b"application/offset+octet-stream"),
+                    (b"content-length", str(len(data)).encode())],
+    }
+    asyncio.run(app(scope, receive, send))
+    return next(message["status"] for message in sent if message["type"] == "http.response.start")
+
+
+def photo_count() -> int:
+    async def read():
+        async with TestingSessionLocal() as session:
+            return (await session.execute(select(func.count(Photo.id)))).scalar_one()
+
+    return asyncio.run(read())
+
+
+def test_resume_after_dropped_patch(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    content = image()
+    upload_id = create(client, headers, content)
+
+    assert dropped_patch(get_token, upload_id, content, len(content) // 3) == 400
+    response = client.head(f"/api/uploads/{upload_id}", headers=headers)
+    assert response.status_code == 200
+    offset = int(response.headers["upload-offset"])
+    assert offset == len(content) // 3
+
+    response = patch(client, headers, upload_id, offset, content[offset:])
+    assert response.status_code == 204, response.text
+    assert int(response.headers["upload-offset"]) == len(content)
+
+    count = photo_count()
+    response = client.post(f"/api/uploads/{upload_id}/finalize", headers=headers)
+    assert response.status_code == 201, response.text
+    stored = b"".join(storage.get(storage.key(response.json()["url"])))
+    assert hashlib.sha256(stored).digest() == hashlib.sha256(content).digest()
+    assert photo_count() == count + 1
+
+    # the upload is gone with its photo: finalizing again creates nothing
+    assert client.post(f"/api/uploads/{upload_id}/finalize", headers=headers).status_code == 404
+    assert photo_count() == count + 1
+
+
+def test_concurrent_finalize_creates_one_photo(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    content = image()
+    upload_id = create(client, headers, content)
+    assert patch(client, headers, upload_id, 0, content).status_code == 204
+    count = photo_count()
+
+    async def finalize_twice():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+            responses = await asyncio.gather(*(http.post(f"/api/uploads/{upload_id}/finalize", headers=headers)
+                                               for _ in range(2)))
+        return sorted(response.status_code for response in responses)
+
+    statuses = asyncio.run(finalize_twice())
+    assert statuses[0] == 201 and statuses[1] in (404, 409)
+    assert photo_count() == count + 1
+
+
+def test_patch_at_wrong_offset(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    content = image()
+    upload_id = create(client, headers, content)
+    assert patch(client, headers, upload_id, 0, content[:100]).status_code == 204
+    assert patch(client, headers, upload_id, 0, content[:100]).status_code == 409
+    assert client.post(f"/api/uploads/{upload_id}/finalize", headers=headers).status_code == 409
+    assert client.delete(f"/api/uploads/{upload_id}", headers=headers).status_code == 204
+
+
+def test_single_claim_of_upload(tmp_path):
+    store = UploadStore(str(tmp_path))
+    content = image()
+
+    async def fill():
+        async def body():
+            yield content
+
+        upload = store.create(1, len(content), {})
+        await store.append(upload, 0, body())
+        return upload
+
+    upload = asyncio.run(fill())
+    first = store.get(upload.id)
+    second = store.get(upload.id)
+    with store.claim(first) as f:
+        assert f.read() == content
+        with pytest.raises(HTTPException) as err:
+            store.claim(second)
+        assert err.value.status_code == 409
+
+    # a failed finalization gives the upload back
+    store.restore(first)
+    with store.claim(store.get(upload.id)) as f:
+        assert f.read() == content
+    store.delete(upload.id)
+    assert os.listdir(tmp_path) == []
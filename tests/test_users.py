@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+
+from conftest import TestingSessionLocal, test_user
+from src.database.cache import redis_client
+from src.entity.models import User
+from src.repository import users as repository_users
+from src.services.auth import auth_service
+from src.services.invalidation import InvalidationBus, LocalCache, invalidation_bus
+
+
+def create_user(username: str) -> int:
+    async def create():
+        async with TestingSessionLocal() as session:
+            user = User(username=username, email=f"{username}@example.com",
+                        password=auth_service.get_password_hash("12345678"), confirmed=True)
+            session.add(user)
+            await session.flush()
+            user_id = user.id
+            await session.commit()
+            return user_id
+
+    return asyncio.run(create())
+
+
+def test_cached_user_survives_commits(client, get_token):
+    headers = {"Authorization": f"Bearer {get_token}"}
+    auth_service.user_cache.clear()
+    victim = create_user("victim")
+
+    # the first request loads the admin and commits; later requests read the cached admin
+    response = client.put(f"/api/users/admin/ban/{victim}", headers=headers)
+    assert response.status_code == 200, response.text
+    for _ in range(2):
+        response = client.get("/api/photos/", headers=headers)
+        assert response.status_code == 200, response.text
+
+
+def test_invalidation_reaches_every_worker():
+    # every worker has its own bus and in-process cache, sharing one Redis
+    workers = [InvalidationBus(redis_client) for _ in range(4)]
+    caches = [LocalCache() for _ in workers]
+    evicted = [threading.Event() for _ in workers]
+    for bus, cache, done in zip(workers, caches, evicted):
+        cache.set("alice@example.com", "stale")
+        bus.subscribe("user", lambda key, payload, cache=cache, done=done: (cache.evict(key), done.set()))
+        bus.start()
+    try:
+        time.sleep(0.1)
+        version = workers[0].version("user", "alice@example.com")
+        workers[0].publish("user", "alice@example.com")
+
+        for done in evicted:
+            assert done.wait(5)
+        assert all(cache.get("alice@example.com") is None for cache in caches)
+        assert workers[1].version("user", "alice@example.com") == version + 1
+        for bus in workers[1:]:
+            stats = bus.stats()
+            assert stats["received"] == 1
+            assert stats["lag_max"] < 5
+    finally:
+        for bus in workers:
+            bus.stop()
+
+
+def test_user_invalidated_while_loading_is_not_cached(client, get_token, monkeypatch):
+    email = test_user["email"]
+    auth_service.user_cache.clear()
+    redis_client.delete(invalidation_bus.versioned_key("user", email))
+    get_user_by_email = repository_users.get_user_by_email
+
+    async def banned_meanwhile(email, db):
+        user = await get_user_by_email(email, db)
+        # a ban commits after the read: the bus bumps the version and evicts the user
+        invalidation_bus.publish("user", email)
+        return user
+
+    monkeypatch.setattr(repository_users, "get_user_by_email", banned_meanwhile)
+    assert asyncio.run(auth_service.get_current_user(get_token)).email == email
+    assert auth_service.user_cache.get(email) is None
+
+    # the next miss loads the new version and caches it
+    monkeypatch.setattr(repository_users, "get_user_by_email", get_user_by_email)
+    asyncio.run(auth_service.get_current_user(get_token))
+    assert auth_service.user_cache.get(email) is not None
+
+
+def test_redis_hit_takes_no_lock(client, get_token, monkeypatch):
+    auth_service.user_cache.clear()
+    asyncio.run(auth_service.get_current_user(get_token))
+    auth_service.user_cache.clear()
+
+    async def locked(*args, **kwargs):
+        raise AssertionError("the user is in Redis")
+
+    monkeypatch.setattr(auth_service.user_flight, "do", locked)
+    assert asyncio.run(auth_service.get_current_user(get_token)).email == test_user["email"]
@@ -0,0 +1,150 @@
+import asyncio
+import tempfile
+import time
+
+import httpx
+import pytest
+from sqlalchemy import delete, select, update
+
+from conftest import TestingSessionLocal, test_user
+from main import app
+from src.conf.config import config
+from src.database.cache import redis_client
+from src.entity.models import Photo, PhotoVariant, User
+from src.routes import posts
+from src.services.auth import auth_service
+from src.services.invalidation import invalidation_bus
+from src.services.singleflight import SingleFlight
+from src.services.storage import LocalStorage
+from src.services.variants import AVATAR_PRESETS, VariantStore, params_hash, variant_store
+
+AVATAR = "https://example.com/avatar.png"
+
+
+class FeedBackend(LocalStorage):
+    # transforms after a latency, much longer for the images in slow
+    transforms = True
+
+    def __init__(self, latency: float = 0.02, slow: tuple[str, ...] = (), slow_latency: float = 0.5):
+        super().__init__(tempfile.gettempdir(), "")
+        self.latency = latency
+        self.slow = slow
+        self.slow_latency = slow_latency
+        self.calls = 0
+
+    def _transform(self, url: str, params: dict) -> str | None:
+        self.calls += 1
+        time.sleep(self.slow_latency if url in self.slow else self.latency)
+        return f"{url}?{params_hash(params)}"
+
+
+@pytest.fixture(scope="module")
+def feed():
+    async def seed():
+        async with TestingSessionLocal() as session:
+            user_id = (await session.execute(select(User.id).filter_by(email=test_user["email"]))).scalar_one()
+            await session.execute(update(User).filter_by(id=user_id).values(avatar=AVATAR))
+            session.add_all(Photo(url=f"https://example.com/feed-{i}.jpg", user_id=user_id) for i in range(4))
+            await session.commit()
+
+    asyncio.run(seed())
+    auth_service.user_cache.evict(test_user["email"])
+    redis_client.delete(invalidation_bus.versioned_key("user", test_user["email"]))
+    return [f"https://example.com/feed-{i}.jpg" for i in range(4)]
+
+
+async def delete_variants() -> None:
+    async with TestingSessionLocal() as session:
+        await session.execute(delete(PhotoVariant))
+        await session.commit()
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = FeedBackend()
+    monkeypatch.setattr(variant_store, "backend", backend)
+    monkeypatch.setattr(variant_store, "flight", SingleFlight("transform"))
+    monkeypatch.setattr(config, "FEED_TRANSFORM_DEADLINE", 0.2)
+    return backend
+
+
+def test_concurrent_feeds_transform_once():
+    backend = FeedBackend()
+    store = VariantStore(config.TRANSFORM_PRESETS, session_factory=TestingSessionLocal, backend=backend)
+    store.flight = SingleFlight("transform")
+    wanted = {(AVATAR, preset): None for preset in AVATAR_PRESETS}
+    wanted.update({(f"https://example.com/{i}.jpg", "post"): None for i in range(10)})
+
+    async def feeds():
+        # concurrent requests want the same variants: each is transformed once
+        pending = [store.fan_out(wanted, 4) for _ in range(3)]
+        return await asyncio.gather(*(p.wait(5) for p in pending))
+
+    results = asyncio.run(feeds())
+    assert backend.calls == len(wanted)
+    assert all(result.keys() == wanted.keys() for result in results)
+
+
+def test_feed_deadline_falls_back_to_original(client, get_token, feed, backend):
+    backend.slow = (feed[0],)
+    headers = {"Authorization": f"Bearer {get_token}"}
+
+    start = time.monotonic()
+    response = client.get("/api/posts/", headers=headers)
+    assert response.status_code == 200, response.text
+    # the response waits for the deadline, not for the straggler, which is stored in the background
+    assert time.monotonic() - start < backend.slow_latency + 0.2
+    images = {post["post"] for post in response.json()}
+    assert feed[0] in images
+    assert {image.split("?")[0] for image in images} == set(feed)
+
+    calls = backend.calls
+    response = client.get("/api/posts/", headers=headers)
+    assert response.status_code == 200
+    assert all(post["post"] != post["post"].split("?")[0] for post in response.json())
+    assert all("?" in ava for ava in response.json()[0]["ava"])
+    assert backend.calls == calls
+
+
+def test_failed_feed_cancels_transforms(get_token, feed, backend, monkeypatch):
+    asyncio.run(delete_variants())
+    backend.slow = (AVATAR, *feed)
+    created = []
+    fan_out = variant_store.fan_out
+
+    def recording(variants, concurrency):
+        created.append(fan_out(variants, 1))
+        return created[-1]
+
+    def failing(**kwargs):
+        raise RuntimeError("response failed")
+
+    monkeypatch.setattr(variant_store, "fan_out", recording)
+    monkeypatch.setattr(posts, "PostResponse", failing)
+
+    async def request():
+        transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            response = await http.get("/api/posts/", headers={"Authorization": f"Bearer {get_token}"})
+        await asyncio.sleep(0.1)
+        return response, [task.done() for task in created[0]._tasks.values()]
+
+    response, done = asyncio.run(request())
+    assert response.status_code == 500
+    assert all(done)
+    # one transform was running when the request failed, the queued ones never started
+    assert backend.calls == 1
+
+
+def test_feed_without_transforming_backend(client, get_token, feed, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("nothing to transform")
+
+    # the local driver of the tests cannot transform: the feed neither looks variants up nor fans out
+    assert not variant_store.enabled
+    monkeypatch.setattr(variant_store, "lookup", fail)
+    monkeypatch.setattr(variant_store, "fan_out", fail)
+    response = client.get("/api/posts/", headers={"Authorization": f"Bearer {get_token}"})
+    assert response.status_code == 200, response.text
+    assert {post["post"] for post in response.json()} == set(feed)
+    assert response.json()[0]["ava"] == [AVATAR, AVATAR]